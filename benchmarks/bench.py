@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for inoti-make. Every benchmark works on a tree generated inside --root (a tmpfs like /dev/shm by default, so
+the disk does not get in the way) and goes through the same code paths used when running an Inotifile:
+
+    setup       Time to add a glob (BetterInotify.add_watch, which creates and scans the watchers) for a * glob and a ** glob
+    throughput  Events per second read and transformed by BetterInotify.listen after a storm of creates and modifies
+    matching    Cost of BetterInotify._transform for a folder shared by many rules
+    latency     Time from writing a file to its action starting, for each executor (running the real bin/inoti-make)
+
+Usage:
+
+    python3 benchmarks/bench.py [--only setup,latency] [--output results.json]
+    python3 benchmarks/bench.py --compare baseline.json [results.json] [--threshold 10]
+
+Results are written as JSON. With --compare, the results (read from a file, or measured right away when none is given)
+are compared with the baseline, and the exit status is 1 when any of them is worse by more than threshold percent.
+"""
+import subprocess
+import statistics
+import platform
+import tempfile
+import getopt
+import shutil
+import signal
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+sys.path.insert( 0, ROOT )
+
+from inoti_make import BetterInotify, Inotify
+
+BENCHMARKS = ( 'setup', 'throughput', 'matching', 'latency' )
+
+# Actions that create a file named after the one that triggered them, written in the language of each executor. Executors
+# that support persistent workers are also measured with [persistent=yes]
+ACTIONS = {
+    'shell': ( [ '/bin/sh' ], True, ': > "{out}/$FILENAME"' ),
+    'python': ( [], False, "open( '{out}/' + FILENAME, 'w' ).close()" ),
+    'node': ( [ 'node' ], True, "require( 'fs' ).writeFileSync( '{out}/' + FILENAME, '' );" ),
+    'pwsh': ( [ 'pwsh-preview' ], True, 'New-Item -ItemType File -Force -Path "{out}/$FILENAME" | Out-Null' ),
+    'csharp': ( [ 'pwsh-preview' ], True, 'System.IO.File.WriteAllText( "{out}/" + FILENAME, "" );' ),
+}
+
+def default_root ():
+    if os.path.isdir( '/dev/shm' ) and os.access( '/dev/shm', os.W_OK ):
+        return '/dev/shm'
+
+    return tempfile.gettempdir()
+
+def generate_tree ( folder, depth, fanout, files = 1 ):
+    """
+    Creates a tree with fanout subfolders in each folder (down to depth levels), and files files in each of them.
+    Returns the list of folders created
+    """
+    folders = [ folder ]
+
+    level = [ folder ]
+
+    for _ in range( depth ):
+        following = []
+
+        for parent in level:
+            for index in range( fanout ):
+                child = os.path.join( parent, f'd{index}' )
+
+                os.mkdir( child )
+
+                following.append( child )
+
+        folders.extend( following )
+
+        level = following
+
+    for parent in folders:
+        for index in range( files ):
+            open( os.path.join( parent, f'f{index}.txt' ), 'w' ).close()
+
+    return folders
+
+def measure ( function, repeat ):
+    """
+    Runs the function repeat times, and returns the median of the values it returns
+    """
+    return statistics.median( function() for _ in range( repeat ) )
+
+def bench_setup ( workspace, options ):
+    folder = os.path.join( workspace, 'setup' )
+
+    os.mkdir( folder )
+
+    folders = generate_tree( folder, options[ 'depth' ], options[ 'fanout' ] )
+
+    globs = {
+        'star': os.path.join( folder, *( [ '*' ] * options[ 'depth' ] ), '*.txt' ),
+        'globstar': os.path.join( folder, '**', '*.txt' ),
+    }
+
+    results = dict()
+
+    for name, glob in globs.items():
+        def run ():
+            inotify = BetterInotify.BetterInotify()
+
+            try:
+                start = time.perf_counter()
+
+                inotify.add_watch( glob )
+
+                return time.perf_counter() - start
+            finally:
+                inotify.close()
+
+        results[ f'setup.{name}' ] = dict( value = measure( run, options[ 'repeat' ] ), unit = 's', better = 'lower', folders = len( folders ) )
+
+    return results
+
+def bench_throughput ( workspace, options ):
+    folder = os.path.join( workspace, 'throughput' )
+
+    os.mkdir( folder )
+
+    folders = generate_tree( folder, 2, options[ 'fanout' ], files = 0 )
+
+    files = options[ 'files' ]
+
+    def run ():
+        inotify = BetterInotify.BetterInotify()
+
+        try:
+            inotify.add_watch( os.path.join( folder, '**', '*.txt' ) )
+
+            paths = [ os.path.join( folders[ index % len( folders ) ], f's{index}.txt' ) for index in range( files ) ]
+
+            # The storm happens before reading anything, so the events wait in the kernel queue and the time measured is
+            # only the time listen takes to read and transform them (the queue holds 16384 events by default)
+            for path in paths:
+                os.close( os.open( path, os.O_CREAT | os.O_WRONLY ) )
+
+            for path in paths:
+                with open( path, 'a' ) as file:
+                    file.write( 'x' )
+
+            expected = len( paths ) * 2
+
+            received = 0
+
+            start = time.perf_counter()
+
+            for event in inotify.listen( timeout = 1 ):
+                if event is not None:
+                    received += 1
+                elif received >= expected or time.perf_counter() - start > 30:
+                    break
+
+            elapsed = time.perf_counter() - start
+
+            for path in paths:
+                os.remove( path )
+
+            return received / elapsed
+        finally:
+            inotify.close()
+
+    return { 'throughput.events': dict( value = measure( run, options[ 'repeat' ] ), unit = 'events/s', better = 'higher', files = files ) }
+
+def bench_matching ( workspace, options ):
+    folder = os.path.join( workspace, 'matching' )
+
+    os.mkdir( folder )
+
+    folders = generate_tree( folder, 2, options[ 'fanout' ] )
+
+    inotify = BetterInotify.BetterInotify()
+
+    try:
+        # Rules for different extensions, plus one that matches every event
+        for index in range( options[ 'rules' ] - 1 ):
+            inotify.add_watch( os.path.join( folder, '**', f'*.ext{index}' ) )
+
+        inotify.add_watch( os.path.join( folder, '**', '*.txt' ) )
+
+        leaves = [ watcher for watcher in inotify.watchers_id.values() if watcher.type == BetterInotify.InotifyWatcherChild ]
+
+        calls = options[ 'calls' ]
+
+        events = [ ( leaves[ index % len( leaves ) ], ( Inotify.IN_MODIFY, leaves[ index % len( leaves ) ].glob, 'f0.txt' ) ) for index in range( calls ) ]
+
+        def run ():
+            start = time.perf_counter()
+
+            for leaf, event in events:
+                inotify._transform( leaf, event )
+
+            return ( time.perf_counter() - start ) / calls
+
+        return { 'matching.transform': dict( value = measure( run, options[ 'repeat' ] ), unit = 's', better = 'lower', rules = options[ 'rules' ] ) }
+    finally:
+        inotify.close()
+
+def executor_available ( name ):
+    ( commands, persistent, action ) = ACTIONS[ name ]
+
+    return all( shutil.which( command ) for command in commands )
+
+def wait_for ( path, timeout ):
+    deadline = time.perf_counter() + timeout
+
+    while not os.path.exists( path ):
+        if time.perf_counter() > deadline:
+            return False
+
+        time.sleep( 0.0005 )
+
+    return True
+
+def bench_latency_executor ( workspace, name, persistent, options ):
+    ( commands, _, action ) = ACTIONS[ name ]
+
+    folder = tempfile.mkdtemp( prefix = f'latency-{name}-', dir = workspace )
+
+    watched = os.path.join( folder, 'watched' )
+    out = os.path.join( folder, 'out' )
+
+    os.mkdir( watched )
+    os.mkdir( out )
+
+    tags = '[create] [persistent=yes]' if persistent else '[create]'
+
+    with open( os.path.join( folder, 'Inotifile' ), 'w' ) as file:
+        file.write( f'{tags} {watched}/*.txt: {name}\n    {action.format( out = out )}\n' )
+
+    environment = dict( os.environ, PYTHONPATH = ROOT + os.pathsep + os.environ.get( 'PYTHONPATH', '' ) )
+
+    process = subprocess.Popen(
+        [ sys.executable, os.path.join( ROOT, 'bin', 'inoti-make' ), '--logger', os.path.join( folder, 'log.txt' ) ],
+        cwd = folder, env = environment, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+    )
+
+    try:
+        # Waits until the rule is ready (the watch is in place and, for persistent rules, the worker has started)
+        for attempt in range( 100 ):
+            open( os.path.join( watched, f'warmup{attempt}.txt' ), 'w' ).close()
+
+            if wait_for( os.path.join( out, f'warmup{attempt}.txt' ), 0.2 ):
+                break
+        else:
+            return None
+
+        samples = []
+
+        for index in range( options[ 'iterations' ] ):
+            start = time.perf_counter()
+
+            open( os.path.join( watched, f'{index}.txt' ), 'w' ).close()
+
+            if not wait_for( os.path.join( out, f'{index}.txt' ), 30 ):
+                return None
+
+            samples.append( time.perf_counter() - start )
+
+        return samples
+    finally:
+        process.send_signal( signal.SIGINT )
+
+        try:
+            process.wait( timeout = 10 )
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def bench_latency ( workspace, options ):
+    results = dict()
+
+    for name, ( commands, supports_persistent, action ) in ACTIONS.items():
+        if not executor_available( name ):
+            print( f'latency.{name}: skipped ({", ".join( commands )} not found)', file = sys.stderr )
+
+            continue
+
+        for persistent in ( ( False, True ) if supports_persistent else ( False, ) ):
+            key = f'latency.{name}.persistent' if persistent else f'latency.{name}'
+
+            samples = bench_latency_executor( workspace, name, persistent, options )
+
+            if samples is None:
+                print( f'{key}: failed (the action did not run)', file = sys.stderr )
+
+                continue
+
+            samples.sort()
+
+            results[ key ] = dict(
+                value = statistics.median( samples ), unit = 's', better = 'lower',
+                p95 = samples[ min( int( len( samples ) * 0.95 ), len( samples ) - 1 ) ], iterations = len( samples )
+            )
+
+    return results
+
+def run_benchmarks ( names, options ):
+    workspace = tempfile.mkdtemp( prefix = 'inoti-make-bench-', dir = options[ 'root' ] )
+
+    results = dict()
+
+    try:
+        for name in names:
+            print( f'running {name}...', file = sys.stderr )
+
+            results.update( globals()[ f'bench_{name}' ]( workspace, options ) )
+    finally:
+        shutil.rmtree( workspace, ignore_errors = True )
+
+    return dict(
+        time = time.time(),
+        python = platform.python_version(),
+        machine = platform.machine(),
+        kernel = platform.release(),
+        options = options,
+        results = results
+    )
+
+def compare ( baseline, current, threshold ):
+    """
+    Prints how each result changed, and returns the names of the ones that got worse by more than threshold percent
+    """
+    regressions = []
+
+    print( f'{"benchmark":<32} {"baseline":>14} {"current":>14} {"change":>9}' )
+
+    for name in sorted( set( baseline[ 'results' ] ) | set( current[ 'results' ] ) ):
+        before = baseline[ 'results' ].get( name )
+        after = current[ 'results' ].get( name )
+
+        if before is None or after is None:
+            print( f'{name:<32} {"-" if before is None else format( before[ "value" ], ".6g" ):>14} {"-" if after is None else format( after[ "value" ], ".6g" ):>14}' )
+
+            continue
+
+        change = ( after[ 'value' ] - before[ 'value' ] ) / before[ 'value' ] * 100 if before[ 'value' ] else 0
+
+        # For results where higher is better (like events per second) a drop is what counts as worse
+        worse = change if after.get( 'better', 'lower' ) == 'lower' else -change
+
+        flag = ' REGRESSION' if worse > threshold else ''
+
+        if flag:
+            regressions.append( name )
+
+        print( f'{name:<32} {before[ "value" ]:>14.6g} {after[ "value" ]:>14.6g} {change:>+8.1f}%{flag}' )
+
+    return regressions
+
+def main ( argv ):
+    options, args = getopt.getopt( argv, '', [
+        'only=', 'output=', 'compare=', 'threshold=', 'root=', 'repeat=',
+        'depth=', 'fanout=', 'files=', 'rules=', 'calls=', 'iterations='
+    ] )
+    options = dict( options )
+
+    settings = dict(
+        root = options.get( '--root', default_root() ),
+        repeat = int( options.get( '--repeat', 3 ) ),
+        depth = int( options.get( '--depth', 4 ) ),
+        fanout = int( options.get( '--fanout', 5 ) ),
+        files = int( options.get( '--files', 4000 ) ),
+        rules = int( options.get( '--rules', 50 ) ),
+        calls = int( options.get( '--calls', 20000 ) ),
+        iterations = int( options.get( '--iterations', 20 ) ),
+    )
+
+    names = options[ '--only' ].split( ',' ) if '--only' in options else BENCHMARKS
+
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit( f'Unknown benchmark {name} (expected one of {", ".join( BENCHMARKS )})' )
+
+    if '--compare' in options and args:
+        with open( args[ 0 ] ) as file:
+            results = json.load( file )
+    else:
+        results = run_benchmarks( names, settings )
+
+    if '--output' in options:
+        with open( options[ '--output' ], 'w' ) as file:
+            json.dump( results, file, indent = 2 )
+    elif '--compare' not in options:
+        json.dump( results, sys.stdout, indent = 2 )
+
+        print()
+
+    if '--compare' in options:
+        with open( options[ '--compare' ] ) as file:
+            baseline = json.load( file )
+
+        if compare( baseline, results, float( options.get( '--threshold', 10 ) ) ):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv[ 1: ] ) )
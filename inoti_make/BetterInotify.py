@@ -1,7 +1,12 @@
-from pathlib import PurePath
-import inotify.adapters
+from . import Inotify
+from . import Poller
+from . import Metrics
+from . import State
+import concurrent.futures
+import asyncio
+import errno
 import os.path
-import glob
+import time
 import math
 import re
 
@@ -13,10 +18,48 @@ InotifyWatcherChild = 3
 EventCreate = 0
 EventUpdate = 1
 EventRemove = 2
+# A path renamed inside the watched trees (the events carry the old path as a fifth item)
+EventMove = 3
 
 EventFile = 0
 EventFolder = 1
 
+# Native events needed to emit each type of event
+EventMasks = {
+    EventCreate: Inotify.IN_CREATE | Inotify.IN_MOVED_TO,
+    EventUpdate: Inotify.IN_MODIFY,
+    EventRemove: Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_DELETE_SELF,
+    EventMove: Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO
+}
+
+# Native events needed by the watchers themselves: InotifyWatcherParent waits for its child to be created, recursive watchers
+# for new subfolders, and every watcher needs to know when its own folder is removed
+ParentMask = Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_DELETE_SELF
+RecursiveMask = Inotify.IN_CREATE | Inotify.IN_MOVED_TO
+SelfMask = Inotify.IN_DELETE_SELF
+
+# Seconds subtracted from the time of the last read when looking for the files changed since then, since the clock used for
+# the modification times of the files can lag behind
+MTIME_SLACK = 1
+
+# Errors of add_watch meaning the folder is already gone (removed, renamed or replaced by a file before it was watched)
+GoneErrors = ( errno.ENOENT, errno.ENOTDIR )
+
+def events_mask ( events = None, close_write = False ):
+    """
+    Returns the native mask for a list of event types (all of them when None). With close_write, updates are only received
+    once the file is closed (IN_CLOSE_WRITE) instead of on every write (IN_MODIFY)
+    """
+    mask = 0
+
+    for event in ( EventMasks.keys() if events is None else events ):
+        mask |= EventMasks[ event ]
+
+    if close_write and mask & Inotify.IN_MODIFY:
+        mask = ( mask & ~Inotify.IN_MODIFY ) | Inotify.IN_CLOSE_WRITE
+
+    return mask
+
 def glob_root_folder ( pattern ):
     folders = pattern.split( os.sep )
 
@@ -30,6 +73,18 @@ def glob_root_folder ( pattern ):
 
     return os.sep.join( roots )
 
+def watch_folder ( pattern ):
+    """
+    Returns the folder watched for the pattern: the root folder of a glob, or the path itself
+    """
+    return glob_root_folder( pattern ) if is_glob( pattern ) else pattern
+
+def parent_folder ( path ):
+    """
+    Returns the folder that contains the path (relative paths without folders are inside the current folder)
+    """
+    return os.path.dirname( path ) or os.curdir
+
 def is_glob ( pattern ):
     folders = pattern.split( os.sep )
 
@@ -71,6 +126,206 @@ def glob_recursive_level ( pattern ):
     # But we don't want the first one, so we subtract 1 (but are careful to never go beneath 0
     return max( level - 1, 0 )
 
+def glob_segment_to_regex ( segment ):
+    """
+    Translates a single path segment of a glob into a regular expression. Wildcards never match the folder separator.
+    Like fnmatch, a ] right after the [ (or its negation) is part of the set, and a [ that is never closed is literal
+
+    >>> re.fullmatch( glob_segment_to_regex( 'x[]' ), 'x[]' ) is not None
+    True
+    >>> re.fullmatch( glob_segment_to_regex( '[]a]' ), ']' ) is not None
+    True
+    >>> re.fullmatch( glob_segment_to_regex( '[!]a]' ), ']' ) is not None
+    False
+    >>> re.fullmatch( glob_segment_to_regex( 'x[' ), 'x[' ) is not None
+    True
+    """
+    regex = ''
+
+    i = 0
+
+    while i < len( segment ):
+        char = segment[ i ]
+
+        i += 1
+
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            start = i + 1 if i < len( segment ) and segment[ i ] in '!^' else i
+
+            if start < len( segment ) and segment[ start ] == ']':
+                start += 1
+
+            end = segment.find( ']', start )
+
+            if end == -1:
+                regex += re.escape( char )
+            else:
+                content = segment[ i:end ].replace( '\\', '\\\\' ).replace( '[', '\\[' )
+
+                if content[ 0 ] in '!^':
+                    content = '^' + content[ 1: ]
+
+                regex += f'[{ content }]'
+
+                i = end + 1
+        else:
+            regex += re.escape( char )
+
+    return regex
+
+def glob_to_regex ( pattern ):
+    """
+    Compiles a glob into a regular expression that matches whole paths. Segments equal to ** match any number of folders 
+    (including none). Like PurePath.match, relative patterns are matched from the right
+
+    >>> glob_to_regex( '/some/path/**/*.js' ).fullmatch( '/some/path/a/b/c.js' ) is not None
+    True
+    >>> glob_to_regex( '/some/path/**/*.js' ).fullmatch( '/some/path/c.js' ) is not None
+    True
+    >>> glob_to_regex( '/some/path/*.js' ).fullmatch( '/some/path/a/c.js' ) is not None
+    False
+    >>> glob_to_regex( '*.js' ).fullmatch( '/some/path/c.js' ) is not None
+    True
+    """
+    segments = pattern.split( os.sep )
+
+    regex = '' if pattern.startswith( os.sep ) else '(?:.*/)?'
+
+    for i, segment in enumerate( segments ):
+        last = i == len( segments ) - 1
+
+        if segment == '**':
+            regex += '.*' if last else '(?:[^/]+/)*'
+        else:
+            regex += glob_segment_to_regex( segment ) + ( '' if last else '/' )
+
+    return re.compile( regex )
+
+def glob_folder_patterns ( pattern ):
+    """
+    Returns the compiled segments of the glob that must be matched by folders (the ones after the root folder and before the
+    file name). Segments equal to ** are kept as the string '**'
+    """
+    folders = pattern.split( os.sep )
+
+    root = glob_root_folder( pattern ).split( os.sep )
+
+    # A trailing ** matches files at any depth, so it also has to be matched by the folders
+    end = len( folders ) if folders[ -1 ] == '**' else len( folders ) - 1
+
+    return [ folder if folder == '**' else re.compile( glob_segment_to_regex( folder ) ) for folder in folders[ len( root ):end ] ]
+
+def exclusion_regex ( patterns ):
+    """
+    Compiles exclusion globs (like **/node_modules) into a regular expression that matches the paths they exclude: the ones
+    that match any of them, and everything inside those. Trailing slashes are ignored. Returns None when there are none
+
+    >>> exclusion_regex( [ '**/node_modules' ] ).fullmatch( '/some/path/node_modules/a/b.js' ) is not None
+    True
+    >>> exclusion_regex( [ '**/node_modules' ] ).fullmatch( '/some/path/src/b.js' ) is not None
+    False
+    """
+    if not patterns:
+        return None
+
+    return re.compile( '(?:' + '|'.join( glob_to_regex( pattern.rstrip( os.sep ) or os.sep ).pattern for pattern in patterns ) + ')(?:/.*)?' )
+
+def gitignore_patterns ( folder ):
+    """
+    Reads the .gitignore files of the folder and of its parents (up to the root of the repository) as exclusion globs.
+    Lines without a slash match names at any depth, and the others are anchored to the folder of their .gitignore (for a
+    relative folder they become relative globs, which are matched from the right). Negated lines (!) are skipped, since
+    exclusions cannot be undone, and so are the .gitignore files of the subfolders
+    """
+    relative = not os.path.isabs( folder )
+
+    current = os.path.abspath( folder or os.curdir )
+
+    patterns = []
+
+    while True:
+        try:
+            with open( os.path.join( current, '.gitignore' ) ) as file:
+                lines = file.read().splitlines()
+        except OSError:
+            lines = []
+
+        for line in lines:
+            line = line.strip()
+
+            if not line or line.startswith( '#' ) or line.startswith( '!' ):
+                continue
+
+            line = line.rstrip( '/' )
+
+            if not line:
+                continue
+
+            if '/' not in line:
+                patterns.append( os.path.join( '**', line ) )
+
+                continue
+
+            pattern = os.path.join( current, line.lstrip( '/' ) )
+
+            if relative:
+                pattern = os.path.relpath( pattern )
+
+                if pattern.startswith( os.pardir ):
+                    continue
+
+            patterns.append( pattern )
+
+        parent = os.path.dirname( current )
+
+        if os.path.exists( os.path.join( current, '.git' ) ) or parent == current:
+            return patterns
+
+        current = parent
+
+def glob_folder_test ( patterns, segments ):
+    """
+    Tests if a folder (given by its segments relative to the root folder of the glob) can contain files matching the glob.
+    Like glob.glob, wildcards do not match hidden folders unless the segment of the glob starts with a dot
+
+    >>> patterns = glob_folder_patterns( '/some/path/A*/**/*B/*.js' )
+    >>> glob_folder_test( patterns, [ 'A1', 'x', 'y' ] )
+    True
+    >>> glob_folder_test( patterns, [ 'C1' ] )
+    False
+    >>> glob_folder_test( glob_folder_patterns( '/some/path/A*/*.js' ), [ 'A1', 'x' ] )
+    False
+    """
+    states = { 0 }
+
+    for segment in segments:
+        hidden = segment.startswith( '.' )
+
+        following = set()
+
+        for state in states:
+            # A ** can match any number of folders, including none
+            while state < len( patterns ) and patterns[ state ] == '**':
+                if not hidden:
+                    following.add( state )
+
+                state += 1
+
+            if state < len( patterns ) and patterns[ state ].fullmatch( segment ):
+                if not hidden or patterns[ state ].pattern.startswith( '\\.' ):
+                    following.add( state + 1 )
+
+        states = following
+
+        if not states:
+            return False
+
+    return True
+
 from collections import Counter
 
 class InotifyWatcher:
@@ -81,59 +336,314 @@ class InotifyWatcher:
         self.parent = parent
         self.recursive = recursive
         self.children = children or []
+        # The InotifyWatcherFolder at the top of the subtree this watcher belongs to (set when created, so events never have to walk the parents)
+        self.root = self
+        # Compiled regular expression of the glob, which never matches the excluded paths (only for watchers of type InotifyWatcherGlob)
+        self.matcher = None
+        # Exclusion globs given to add_watch, and their compiled regular expression (None when there are none)
+        self.exclude = ()
+        self.excluded = None
+        # Root folder of the glob and compiled patterns its subfolders must match (only for watchers of type InotifyWatcherGlob)
+        self.folder = None
+        self.folders = None
+        # Ids returned by add_watch for this glob, and the native mask each one needs (only for watchers of type InotifyWatcherGlob)
+        self.ids = []
+        self.masks = dict()
+        # Ids that asked for EventMove. The others receive renames as a removal and a creation
+        self.moves = set()
+        # Native mask needed by this glob, or by all the globs that share this subtree (for watchers of type InotifyWatcherFolder)
+        self.mask = 0
+        # Watchers of type InotifyWatcherGlob that share this subtree (only for watchers of type InotifyWatcherFolder)
+        self.globs = []
+        # Dictionary matching each path of the subtree that matches its globs to ( type, mtime, size, inode ), kept up to date
+        # with the events, so that the changes lost when the kernel queue overflows (or while nothing was running) can be
+        # found. Until BetterInotify tracks the snapshots, it only keeps the paths announced in new folders (only for
+        # InotifyWatcherFolder)
+        self.snapshot = dict()
+        # Once a subtree runs out of native watches, all of its folders are polled instead (only for InotifyWatcherFolder)
+        self.polling = False
     
     def __repr__ ( self ):
         return "<InotifyWatcher \n\tglob: %s \n\tid: %s \n\ttype: %s \n\tparent: %s\n\trecursive: %s\n\tchildren: %s\n>" % ( self.glob, self.id, self.type, self.parent, self.recursive, self.children )
 
 class BetterInotify:
-    def __init__ ( self, logger = None ):
-        # Dictionary matching a path/glob to a watcher instance
+    """
+    The folders are watched through a backend: an object with the methods add_watch( path, mask ), 
+    remove_watch( path, superficial ), rename_watch( path, new path ), read_events( timeout ), aread_events() and close(), that returns the events as
+    tuples ( mask, cookie, path, filename ) with the masks of inotify (like Inotify.Inotify and Poller.Poller).
+    When the backend runs out of watches (or more than watch_budget are in use), the subtrees that need more are moved
+    to the fallback backend (a Poller by default)
+    """
+    def __init__ ( self, logger = None, block_duration = 1, scan_workers = 1, backend = None, fallback = None, watch_budget = None, metrics = None ):
+        # Dictionary matching a path to the watcher instances on that path
         self.watchers = dict()
         # Dictionary matching an id to a watcher instance
         self.watchers_id = dict()
+        # Dictionary matching a glob to its watcher instance (identical globs share the same one)
+        self.globs = dict()
+        # Dictionary matching a root folder to the InotifyWatcherFolder shared by all the globs with that root folder
+        self.subtrees = dict()
+        # Dictionary matching an id returned by add_watch to the watcher of its glob
+        self.handles = dict()
+        # Ids whose events are not logged
+        self.quiet = set()
+        # Dictionary matching the ids whose glob was not written as an absolute path to the tuple ( folder, written folder ),
+        # so that their events have the paths as they were written
+        self.spellings = dict()
+        # Snapshots are only taken and kept up to date once they are needed: to save or resume the state, or after the
+        # first overflow
+        self.tracking = False
+        # When the native events were last read (time.time_ns, to be compared with the modification times of the files), and
+        # the read before that one
+        self.read_at = time.time_ns()
+        self.last_read = self.read_at
+        # Dictionary matching a folder to the subtrees (their InotifyWatcherFolder) that receive the events of the files inside it
+        self.index = dict()
+        # Counts how many InotifyWatcherParent watchers are waiting on each folder
+        self.parents = Counter()
         
         self.counter = 0
 
         self.watchers_cache = Counter()
+        # Dictionary matching a folder to the mask of its native watch
+        self.watchers_masks = dict()
+
+        self.inotify = backend or Inotify.Inotify()
+        # Created only when some subtree needs it
+        self.fallback = fallback
+        # Maximum number of folders watched by the main backend (None means as many as it allows)
+        self.watch_budget = watch_budget
+        # Dictionary matching the folders watched by the fallback backend to it
+        self.backends = dict()
 
-        self.inotify = inotify.adapters.Inotify()
+        # How long (in seconds) listen waits for events before emitting a None event
+        self.block_duration = block_duration
 
         self.debug = False
 
         self.logger = logger
 
+        # How many threads list folders at the same time when scanning the trees of recursive watchers
+        self.scan_workers = scan_workers
+
+        # When the batch of native events being handled was read (time.monotonic), to measure how long they take to handle
+        self.received = None
+
+        self.metrics = metrics
+
+        if metrics is not None:
+            metrics.counter( 'events_received_total', 'Native events received for each folder', [ 'folder' ] )
+            metrics.counter( 'events_dropped_total', 'Native events of each folder that did not match any glob', [ 'folder' ] )
+            metrics.counter( 'overflows_total', 'Times the kernel queue overflowed and events were lost' )
+            metrics.histogram( 'match_seconds', 'Time spent matching paths against the globs', buckets = Metrics.MATCH_BUCKETS )
+            metrics.gauge( 'native_watches', 'Folders watched by the main backend', lambda: len( self.inotify.watches ) )
+            metrics.gauge( 'polled_folders', 'Folders watched by the fallback backend', lambda: len( self.fallback.watches ) if self.fallback is not None else 0 )
+
     def _debug ( self, *msg ):
         if self.debug:
             print( *msg )
 
-    def _create_watcher ( self, watcher ):
+    def _index_watcher ( self, watcher ):
+        if watcher.type == InotifyWatcherFolder or watcher.type == InotifyWatcherChild:
+            self.index.setdefault( watcher.glob, [] ).append( watcher.root )
+        elif watcher.type == InotifyWatcherParent:
+            self.parents[ watcher.glob ] += 1
+
+    def _unindex_watcher ( self, watcher ):
+        if watcher.type == InotifyWatcherFolder or watcher.type == InotifyWatcherChild:
+            roots = self.index.get( watcher.glob )
+
+            if roots and watcher.root in roots:
+                roots.remove( watcher.root )
+
+                if not roots:
+                    del self.index[ watcher.glob ]
+        elif watcher.type == InotifyWatcherParent:
+            self.parents[ watcher.glob ] -= 1
+
+            if self.parents[ watcher.glob ] <= 0:
+                del self.parents[ watcher.glob ]
+
+    def _list_folders ( self, folder ):
+        try:
+            with os.scandir( folder ) as entries:
+                return [ entry.path for entry in entries if entry.is_dir() ]
+        except OSError:
+            # The folder was removed (or cannot be read) in the meantime
+            return []
+
+    def _accept_folder ( self, root, path ):
+        """
+        Tests if a subfolder is worth watching for any of the globs that share the subtree
+        """
+        segments = os.path.relpath( path, root.glob ).split( os.sep )
+
+        return any( glob_folder_test( glob.folders, segments ) and ( glob.excluded is None or glob.excluded.fullmatch( path ) is None ) for glob in root.globs )
+
+    def _find_child ( self, parent, path ):
+        for watcher in self.watchers.get( path, () ):
+            if watcher.type == InotifyWatcherChild and watcher.parent == parent.id:
+                return watcher
+
+        return None
+
+    def _scan_watcher ( self, watcher ):
+        """
+        Creates the InotifyWatcherChild watchers for the subfolders of a recursive watcher. The tree is listed one level at
+        a time (each level in parallel when scan_workers is bigger than one), skipping the folders that cannot contain 
+        files that match the globs. Scanning a subtree again only creates the watchers that are missing
+        """
+        start = time.perf_counter()
+
+        visited = 0
+
+        level = [ watcher ]
+
+        pool = concurrent.futures.ThreadPoolExecutor( max_workers = self.scan_workers ) if self.scan_workers > 1 else None
+
+        try:
+            while level:
+                if pool is not None and len( level ) > 1:
+                    listings = pool.map( self._list_folders, [ parent.glob for parent in level ] )
+                else:
+                    listings = map( self._list_folders, [ parent.glob for parent in level ] )
+
+                following = []
+
+                for parent, childpaths in zip( level, listings ):
+                    visited += 1
+
+                    for childpath in childpaths:
+                        if not self._accept_folder( parent.root, childpath ):
+                            continue
+
+                        child = self._find_child( parent, childpath )
+
+                        if child is not None:
+                            child.recursive = max( child.recursive, parent.recursive - 1 )
+                        else:
+                            child = self._create_watcher( InotifyWatcher( 
+                                childpath, 
+                                type = InotifyWatcherChild, 
+                                parent = parent.id,
+                                recursive = max( parent.recursive - 1, 0 )
+                            ), scan = False )
+
+                            # Removed (or renamed) after it was listed
+                            if child is None:
+                                continue
+
+                            parent.children.append( child.id )
+
+                        if child.recursive:
+                            following.append( child )
+
+                level = following
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if self.logger and watcher.type == InotifyWatcherFolder:
+            self.logger.scan( ' '.join( glob.glob for glob in watcher.globs ), visited, time.perf_counter() - start )
+
+    def _create_glob ( self, glob, id, mask, exclude = () ):
+        watcher = InotifyWatcher( glob )
+
+        watcher.exclude = exclude
+        watcher.excluded = exclusion_regex( exclude )
+
+        # The id is added before creating the subtree, so that the native watches are created with the right mask
+        watcher.ids.append( id )
+        watcher.masks[ id ] = mask
+
+        watcher.id = self.counter
+
+        self.counter += 1
+
+        self.watchers_id[ watcher.id ] = watcher
+
+        self.globs[ ( glob, exclude ) ] = watcher
+
+        # For performance reasons, we can simply test if the path provided is indeed a glob or a regular file/folder
+        if is_glob( glob ):
+            # When it is a glob, we need to determine the root of the glob expression (the prefix of the path that has no special glob syntax)
+            # And watch that folder instead
+            watcher.matcher = glob_to_regex( glob )
+            watcher.folder = glob_root_folder( glob )
+            watcher.folders = glob_folder_patterns( glob )
+
+            recursive = glob_recursive_level( glob )
+        else:
+            # Regular paths receive all the events of the path itself and its entries, but none from its subfolders
+            watcher.matcher = re.compile( re.escape( glob ) + '(?:/[^/]+)?' )
+            watcher.folder = glob
+            watcher.folders = []
+
+            recursive = 0
+
+        # The excluded paths are left out of the matcher itself, so they never match the glob anywhere
+        if watcher.excluded is not None:
+            watcher.matcher = re.compile( f'(?!(?:{ watcher.excluded.pattern })\\Z)(?:{ watcher.matcher.pattern })' )
+
+        # Only globs with the same root folder share the same subtree of watchers. Globs with nested root folders (like
+        # src/*.py and src/lib/**/*.js) get a subtree each, but a folder watched by both still has a single native watch
+        # (see _add_watch_native), whose events are matched against every subtree indexed for the folder
+        subtree = self.subtrees.get( watcher.folder )
+
+        if subtree is None:
+            subtree = InotifyWatcher( watcher.folder, type = InotifyWatcherFolder, recursive = recursive )
+
+            subtree.globs.append( watcher )
+
+            self._update_mask( subtree )
+
+            self.subtrees[ watcher.folder ] = subtree
+
+            self._create_watcher( subtree )
+
+            if self.tracking:
+                subtree.snapshot = self._snapshot( subtree )
+        else:
+            subtree.globs.append( watcher )
+
+            if recursive:
+                subtree.recursive = max( subtree.recursive, recursive )
+
+            self._refresh_mask( subtree )
+
+            # This glob may need folders that the other ones did not
+            if recursive and self._holds_native( subtree ):
+                self._scan_watcher( subtree )
+
+            # And may match files that the other ones did not
+            if self.tracking:
+                subtree.snapshot.update( self._snapshot( subtree ) )
+
+        watcher.children.append( subtree.id )
+
+        return watcher
+
+    def _create_watcher ( self, watcher, scan = True ):
+        """
+        Registers the watcher and adds its native watch. Returns None (with nothing registered) when the watcher is an
+        InotifyWatcherChild whose folder is already gone, since new folders can be removed or renamed before their events
+        are read (mkdir -p a/b && rm -rf a)
+        """
         watcher.id = self.counter
 
         self.counter += 1
 
         self.watchers_id[ watcher.id ] = watcher
+
+        if watcher.parent != None:
+            watcher.root = self.watchers_id[ watcher.parent ].root
         
         if watcher.glob not in self.watchers:
             self.watchers[ watcher.glob ] = [ watcher ]
         else:
             self.watchers[ watcher.glob ].append( watcher )
 
-        # By default every watcher added by the user is marked as a glob
-        # For performance reasons, we can simply test if the path provided is indeed a glob or a regular file/folder
-        if watcher.type == InotifyWatcherGlob:
-            if is_glob( watcher.glob ):
-                # When it is a glob, we need to determine the root of the glob expression (the prefix of the path that has no special glob syntax)
-                # And create a regular watcher for that path
-                child = self._create_watcher( InotifyWatcher( 
-                    glob_root_folder( watcher.glob ), 
-                    type = InotifyWatcherFolder, 
-                    parent = watcher.id, 
-                    recursive = glob_recursive_level( watcher.glob ) 
-                ) )
-
-                watcher.children.append( child.id )
-            else:
-                watcher.type = InotifyWatcherFolder
+        self._index_watcher( watcher )
 
         exists = True
 
@@ -143,10 +653,9 @@ class BetterInotify:
         # This type of watcher does not emit events to the user, but rather waits for a specific child 
         # to be created, then creates a watcher for that child and kills itself
         if watcher.type == InotifyWatcherFolder or watcher.type == InotifyWatcherParent:
-            # TODO Optimization: Check if the folder is already being watched and simply link them somehow, instead of creating a new watcher
             if not os.path.exists( watcher.glob ):
                 child = self._create_watcher( InotifyWatcher( 
-                    os.path.dirname( watcher.glob ), 
+                    parent_folder( watcher.glob ), 
                     type = InotifyWatcherParent, 
                     parent = watcher.id,
                 ) )
@@ -159,243 +668,1277 @@ class BetterInotify:
             self._add_watch_native( watcher.glob )
         
         if exists and ( watcher.type == InotifyWatcherFolder or watcher.type == InotifyWatcherChild ):
-            self._add_watch_native( watcher.glob )
-                
-            if watcher.recursive:
-                # TODO Optimization: When the parent of watcher is a glob, do a partial glob test to see what childpaths are worth watching
-                for childpath in glob.glob( os.path.join( watcher.glob, "*/" ) ):
-                    # We want the folder name, but glob returns the folders with a trailing "/"
-                    # Therefore, calling os.path.basename( childpath ) returns everything after the LAST "/"
-                    # Which in our case would always be empty. Calling dirname first removes that trailing "/" and so
-                    # basename now returns the correct value
-                    childname = os.path.basename( os.path.dirname( childpath ) )
+            try:
+                self._add_watch_native( watcher.glob )
+            except OSError as error:
+                self._remove_watcher( watcher.id )
 
-                    child = self._create_watcher( InotifyWatcher( 
-                        os.path.join( watcher.glob, childname ), 
-                        type = InotifyWatcherChild, 
-                        parent = watcher.id,
-                        recursive = max( watcher.recursive - 1, 0 )
-                    ) )
+                if watcher.type != InotifyWatcherChild or error.errno not in GoneErrors:
+                    raise
 
-                    watcher.children.append( child.id )
+                self._debug( 'GONE', watcher.glob )
+
+                return None
+                
+            if watcher.recursive and scan:
+                self._scan_watcher( watcher )
 
         return watcher
 
-    def add_watch ( self, glob ):
-        if self.logger and glob not in self.watchers:
-            self.logger.watch( glob )
+    def add_watch ( self, glob, events = None, close_write = False, exclude = (), quiet = False ):
+        """
+        Starts watching the glob, and returns the id that identifies the events of this call. Adding the same glob more than
+        once reuses the same watchers (and the events are emitted once for each id), and globs with the same root folder
+        share their subtree (globs with nested root folders only share the native watches). Only the types of events given 
+        (EventCreate, EventUpdate, EventRemove and EventMove, all of them when None) are requested from the kernel for this
+        id. Renames are only paired into a single EventMove when it is given explicitly. Paths matching the exclusion globs
+        (and everything inside them) never match, and excluded folders are never watched. The events of quiet ids are not
+        logged. Globs are watched by their absolute paths, so every spelling of a folder shares its watchers, but the events
+        keep the spelling of each glob
+        """
+        id = self.counter
 
-        watcher = self._create_watcher( InotifyWatcher( glob ) )
+        self.counter += 1
 
-        return watcher.id
+        written = glob
 
-    def remove_watch ( self, id, propagate = True ):
-        if id in self.watchers_id:
-            watcher = self.watchers_id[ id ]
+        glob = os.path.abspath( glob )
 
-            del self.watchers_id[ watcher.id ]
+        # Relative exclusions are still matched from the right, only ./ prefixes would never match an absolute path
+        exclude = tuple( os.path.normpath( pattern ) for pattern in exclude )
 
-            self.watchers[ watcher.glob ].remove( watcher )
+        if glob != written:
+            self.spellings[ id ] = ( watch_folder( glob ), watch_folder( written ) )
 
-            if not self.watchers[ watcher.glob ]:
-                del self.watchers[ watcher.glob ]
+        watcher = self.globs.get( ( glob, exclude ) )
 
-            if watcher.parent != None and watcher.parent in self.watchers_id:
-                self.watchers_id[ watcher.parent ].children.remove( watcher.id )
+        if watcher is None:
+            if self.logger:
+                self.logger.watch( written )
 
-            if propagate:
-                for child in watcher.children:
-                    self.remove_watch( child )
+            try:
+                watcher = self._create_glob( glob, id, events_mask( events, close_write ), exclude )
+            except OSError:
+                self._discard_glob( ( glob, exclude ) )
 
-                if ( watcher.type == InotifyWatcherFolder or watcher.type == InotifyWatcherParent ) and watcher.parent != None:
-                    self.remove_watch( watcher.parent )
+                self.spellings.pop( id, None )
 
-    def _add_watch_native ( self, folder ):
-        self._debug( 'WATCHING', folder )
+                raise
+        else:
+            watcher.ids.append( id )
+            watcher.masks[ id ] = events_mask( events, close_write )
 
-        self.watchers_cache[ folder ] += 1
+            self._refresh_mask( self.subtrees[ watcher.folder ] )
 
-        if self.watchers_cache[ folder ] == 1:
-            self.inotify.add_watch( folder )        
-    
-    def _remove_watch_native ( self, folder, superficial = False ):
-        self._debug( 'REMOVING WATCHING', folder, superficial )
+        if events is not None and EventMove in events:
+            watcher.moves.add( id )
 
-        self.watchers_cache[ folder ] -= 1
+        self.handles[ id ] = watcher
 
-        if self.watchers_cache[ folder ] == 0:
-            del self.watchers_cache[ folder ]
+        if quiet:
+            self.quiet.add( id )
 
-            # The Pynotify library has a bug in that it does not propagate the value of superficial to other functions,
-            # There are multiple issues open reporting the situation but so far it has not been fixed.
-            # Therefore when the value is different from the default (False) we copy-pasted the code, fixed it, and run it instead of calling the function
-            if superficial:
-                wd = self.inotify._Inotify__watches.get( folder )
+        return id
 
-                if wd is None:
-                    return
+    def _discard_glob ( self, key ):
+        """
+        Removes what a glob that could not be watched left behind, including its subtree when no other glob uses it
+        """
+        watcher = self.globs.pop( key, None )
 
-                del self.inotify._Inotify__watches[ folder ]
+        if watcher is None:
+            return
 
-                del self.inotify._Inotify__watches_r[ wd ]
-            else:
-                self.inotify.remove_watch( folder, superficial = superficial )
+        self.watchers_id.pop( watcher.id, None )
 
-    def _get_event_action ( self, type_names ):
-        if 'IN_CREATE' in type_names or 'IN_MOVED_TO' in type_names:
-            return EventCreate
-        elif 'IN_DELETE' in type_names or 'IN_MOVED_FROM' in type_names or 'IN_DELETE_SELF' in type_names:
-            return EventRemove
-        elif 'IN_MODIFY' in type_names:
-            return EventUpdate
-        else:
-            return None
+        subtree = self.subtrees.get( watcher.folder )
 
-    def _get_event_type ( self, type_names ):
-        if 'IN_ISDIR' in type_names or 'IN_DELETE_SELF' in type_names:
-            return EventFolder
+        if subtree is None or watcher not in subtree.globs:
+            return
+
+        subtree.globs.remove( watcher )
+
+        if subtree.globs:
+            self._refresh_mask( subtree )
         else:
-            return EventFile
+            del self.subtrees[ watcher.folder ]
 
-    def _get_flags ( self, var, *values ):
-        return [ v == var for v in values ]
+            if subtree.id in self.watchers_id:
+                self._remove_tree( subtree )
 
-    def _transform ( self, leaf, event ):
+    def remove_watch ( self, id ):
         """
-        Transforms an event from Pynotify. Returns None if the event it received does not apply 
-        (for example, the file is inside a watched folder but does not match the glob pattern)
+        Stops emitting events for the id returned by add_watch. The watchers are only removed when no other id uses them
         """
-        if event == None:
-            return None
+        watcher = self.handles.pop( id, None )
 
-        ( type_names, path, filename ) = event
-        
-        action = self._get_event_action( type_names )
-        type = self._get_event_type( type_names )
+        if watcher is None:
+            return
 
-        if leaf.type == InotifyWatcherParent:
-            return None
-        
-        root = leaf
+        self.quiet.discard( id )
+        self.spellings.pop( id, None )
 
-        while root.type != InotifyWatcherGlob and root.parent != None:
-            root = self.watchers_id[ root.parent ]
+        watcher.ids.remove( id )
 
-        filepath = os.path.join( path, filename )
+        del watcher.masks[ id ]
 
-        # print( root.glob, root.type == InotifyWatcherGlob, filepath, PurePath( filepath ).match( root.glob ) )
-        if root.type == InotifyWatcherGlob and not PurePath( filepath ).match( root.glob ):
-            return None
+        watcher.moves.discard( id )
 
-        return ( root.id, action, type, filepath )
-    
-    def listen ( self, ignore_missing_new_folders = False, **kwargs ):
-        for event in self.inotify.event_gen(**kwargs):
-            if event is not None:
-                ( header, type_names, path, filename ) = event
-
-                # Every folder we're listening should have a watcher attached, if not it's best to just skip the event
-                if path not in self.watchers:
-                    self._debug( f"Path '{ path }' not found in watchers" )
-                    continue
+        if watcher.ids:
+            self._refresh_mask( self.subtrees[ watcher.folder ] )
 
-                # POSSIBLE CASES:
-                # (x) means emit event
-                # - InotifyWatcherParent CREATE parent path: Remove watcher and add parent native watcher
-                # - InotifyWatcherParent REMOVE self path: Create another parent watcher and add parent native watcher
-                # - InotifyWatcherChild | InotifyWatcherFolder CREATE child folder: Create another InotifyWatcherChild and add native watcher (x)
-                # - InotifyWatcherChild REMOVE self folder: Remove watcher (x)
-                # - InotifyWatcherFolder REMOVE self folder: Create parent watcher (x)
+            return
 
-                is_create, is_remove, is_update = self._get_flags( self._get_event_action( type_names ), EventCreate, EventRemove, EventUpdate )
-                is_folder, is_file = self._get_flags( self._get_event_type( type_names ), EventFolder, EventFile )
+        del self.globs[ ( watcher.glob, watcher.exclude ) ]
+        del self.watchers_id[ watcher.id ]
 
-                if not is_remove and not is_create and not is_update:
-                    self._debug( f"Ignored event type {type_names} {is_remove}" )
-                    continue
+        subtree = self.subtrees[ watcher.folder ]
 
-                self._debug( type_names, path, filename, '\n' )
+        subtree.globs.remove( watcher )
 
-                # Set a boolean flag to avoid logging the same event more than once
-                logged = False
+        # The folders that were only watched for this glob are kept until the subtree is removed
+        if not subtree.globs:
+            del self.subtrees[ watcher.folder ]
 
-                for watcher in self.watchers[ path ]:
-                    t_watcher, t_path, t_filename = watcher, path, filename
+            self._remove_tree( subtree )
+        else:
+            self._refresh_mask( subtree )
 
-                    if watcher.type == InotifyWatcherParent:
-                        parent_watcher = self.watchers_id[ watcher.parent ]
+    def _catch_up ( self, watcher ):
+        """
+        Called after a native watch is added for a folder some InotifyWatcherParent was waiting for. The folders below it may
+        have been created before the watch was added (mkdir -p, for example), so those are handled right away
+        """
+        while watcher.type == InotifyWatcherParent:
+            target = self.watchers_id[ watcher.parent ]
 
-                        if is_create and os.path.join( path, filename ) == parent_watcher.glob:
-                            self.remove_watch( watcher.id, propagate = False )
+            if not os.path.exists( target.glob ):
+                return
 
-                            self._remove_watch_native( watcher.glob )
+            self._remove_watcher( watcher.id )
 
-                            self._add_watch_native( parent_watcher.glob )
+            self._remove_watch_native( watcher.glob )
 
-                            t_watcher, t_path, t_filename = parent_watcher, os.path.join( path, filename ), ''
-                        elif is_remove and not filename:
-                            child = self._create_watcher( InotifyWatcher( 
-                                os.path.dirname( watcher.glob ), 
-                                type = InotifyWatcherParent, 
-                                parent = watcher.id,
-                            ) )
+            self._add_watch_native( target.glob )
 
-                            watcher.children.append( child.id )
+            watcher = target
 
-                            self._remove_watch_native( watcher.glob, superficial = True )
-                    elif watcher.type == InotifyWatcherChild: # or 
-                        if is_folder and is_create and watcher.recursive > 0:
-                            child = self._create_watcher( InotifyWatcher( 
-                                os.path.join( watcher.glob, filename ), 
-                                type = InotifyWatcherChild, 
-                                parent = watcher.id,
-                                recursive = max( watcher.recursive - 1, 0 )
-                            ) )
+        if watcher.type == InotifyWatcherFolder and watcher.recursive:
+            self._scan_watcher( watcher )
 
-                            watcher.children.append( child.id )
+        # Files created before the watch was added never produce events, so they must be in the snapshot already
+        if watcher.type == InotifyWatcherFolder and self.tracking:
+            watcher.snapshot = self._snapshot( watcher )
 
-                            self._add_watch_native( child.glob )
-                        elif is_remove and not filename:
-                            self.remove_watch( watcher.id, propagate = False )
+    def _holds_native ( self, watcher ):
+        """
+        Tests if the watcher is responsible for a native watch (watchers whose path does not exist wait on an InotifyWatcherParent instead)
+        """
+        if watcher.type == InotifyWatcherGlob:
+            return False
 
-                            self._remove_watch_native( watcher.glob, superficial = True )
+        return not any( self.watchers_id[ child ].type == InotifyWatcherParent for child in watcher.children if child in self.watchers_id )
 
-                            t_watcher, t_path, t_filename = self.watchers_id[ watcher.parent ], os.path.dirname( path ), os.path.basename( path )
-                    elif watcher.type == InotifyWatcherFolder:
-                        if is_folder and is_create and watcher.recursive > 0:
-                            child = self._create_watcher( InotifyWatcher( 
-                                os.path.join( watcher.glob, filename ), 
-                                type = InotifyWatcherChild, 
-                                parent = watcher.id,
-                                recursive = max( watcher.recursive - 1, 0 )
-                            ) )
+    def _remove_tree ( self, watcher ):
+        holds_native = self._holds_native( watcher )
 
-                            watcher.children.append( child.id )
+        for child in list( watcher.children ):
+            if child in self.watchers_id:
+                self._remove_tree( self.watchers_id[ child ] )
 
-                            self._add_watch_native( child.glob )
-                        elif is_remove and not filename:
-                            child = self._create_watcher( InotifyWatcher( 
-                                os.path.dirname( watcher.glob ), 
-                                type = InotifyWatcherParent, 
-                                parent = watcher.id,
-                            ) )
+        self._remove_watcher( watcher.id )
 
-                            watcher.children.append( child.id )
+        if holds_native:
+            self._remove_watch_native( watcher.glob )
+
+    def _remove_watcher ( self, id ):
+        if id in self.watchers_id:
+            watcher = self.watchers_id[ id ]
 
-                            self._remove_watch_native( watcher.glob, superficial = True )
+            del self.watchers_id[ watcher.id ]
 
-                    event = self._transform( t_watcher, ( type_names, t_path, t_filename ) )
+            self._unindex_watcher( watcher )
 
-                    if event != None:
-                        if not logged and self.logger:
-                            self.logger.event( event_name( event[ 1 ] ), type_name( event[ 2 ] ), event[ 3 ] )
+            self.watchers[ watcher.glob ].remove( watcher )
 
-                            logged = True
+            if not self.watchers[ watcher.glob ]:
+                del self.watchers[ watcher.glob ]
 
-                        yield event
-            else:
-                # When the event is None, always emit it
-                yield event
+            # Watchers rolled back by _create_watcher were never added to the children of their parent
+            if watcher.parent != None and watcher.parent in self.watchers_id and watcher.id in self.watchers_id[ watcher.parent ].children:
+                self.watchers_id[ watcher.parent ].children.remove( watcher.id )
+
+    def _update_mask ( self, subtree ):
+        """
+        Calculates the native mask needed by the subtree. Returns True if it changed
+        """
+        mask = SelfMask | ( RecursiveMask if subtree.recursive else 0 )
+
+        for glob in subtree.globs:
+            glob.mask = 0
+
+            for id_mask in glob.masks.values():
+                glob.mask |= id_mask
+
+            mask |= glob.mask
+
+        changed = mask != subtree.mask
+
+        subtree.mask = mask
+
+        return changed
+
+    def _refresh_mask ( self, subtree ):
+        """
+        Updates the masks of the native watches of the subtree after the globs (or their ids) using it changed
+        """
+        if not self._update_mask( subtree ):
+            return
+
+        pending = [ subtree ]
+
+        while pending:
+            watcher = pending.pop()
+
+            if self._holds_native( watcher ):
+                self._update_watch_native( watcher.glob )
+
+            pending.extend( self.watchers_id[ child ] for child in watcher.children if child in self.watchers_id )
+
+    def _folder_mask ( self, folder ):
+        """
+        The mask of a native watch is the union of what every watcher of the folder needs
+        """
+        mask = 0
+
+        for watcher in self.watchers.get( folder, () ):
+            if watcher.type == InotifyWatcherParent:
+                mask |= ParentMask
+            else:
+                mask |= watcher.root.mask
+
+        return mask
+
+    def _update_watch_native ( self, folder ):
+        if folder not in self.watchers_cache:
+            return
+
+        mask = self._folder_mask( folder )
+
+        if mask != self.watchers_masks.get( folder ):
+            self.watchers_masks[ folder ] = mask
+
+            # Adding a watch for a path that is already watched replaces its mask
+            self._backend( folder ).add_watch( folder, mask )
+
+    def _backend ( self, folder ):
+        return self.backends.get( folder, self.inotify )
+
+    def _fall_back ( self, folder ):
+        """
+        Moves the subtrees of the folder to the fallback backend, and returns it
+        """
+        if self.fallback is None:
+            self.fallback = Poller.Poller()
+
+        for watcher in self.watchers.get( folder, () ):
+            if not watcher.root.polling:
+                watcher.root.polling = True
+
+                if self.logger:
+                    self.logger.fallback( watcher.root.glob, len( self.inotify.watches ) )
+
+        return self.fallback
+
+    def _choose_backend ( self, folder ):
+        if any( watcher.root.polling for watcher in self.watchers.get( folder, () ) ):
+            return self.fallback
+
+        if self.watch_budget is not None and len( self.inotify.watches ) >= self.watch_budget:
+            return self._fall_back( folder )
+
+        return self.inotify
+
+    def _add_watch_native ( self, folder ):
+        self._debug( 'WATCHING', folder )
+
+        self.watchers_cache[ folder ] += 1
+
+        if self.watchers_cache[ folder ] == 1:
+            mask = self._folder_mask( folder )
+
+            backend = self._choose_backend( folder )
+
+            try:
+                try:
+                    backend.add_watch( folder, mask )
+                except OSError as error:
+                    # ENOSPC means the kernel limit of watches (fs.inotify.max_user_watches) was reached
+                    if error.errno != errno.ENOSPC or backend is not self.inotify:
+                        raise
+
+                    backend = self._fall_back( folder )
+
+                    backend.add_watch( folder, mask )
+            except OSError:
+                del self.watchers_cache[ folder ]
+
+                raise
+
+            if backend is not self.inotify:
+                self.backends[ folder ] = backend
+
+            self.watchers_masks[ folder ] = mask
+        else:
+            self._update_watch_native( folder )
+    
+    def _remove_watch_native ( self, folder, superficial = False ):
+        self._debug( 'REMOVING WATCHING', folder, superficial )
+
+        self.watchers_cache[ folder ] -= 1
+
+        if self.watchers_cache[ folder ] == 0:
+            del self.watchers_cache[ folder ]
+            del self.watchers_masks[ folder ]
+
+            self.backends.pop( folder, self.inotify ).remove_watch( folder, superficial = superficial )
+        elif not superficial:
+            self._update_watch_native( folder )
+
+    def _get_event_action ( self, mask ):
+        if mask & ( Inotify.IN_CREATE | Inotify.IN_MOVED_TO ):
+            return EventCreate
+        elif mask & ( Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_DELETE_SELF ):
+            return EventRemove
+        elif mask & ( Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE ):
+            return EventUpdate
+        else:
+            return None
+
+    def _get_event_type ( self, mask ):
+        if mask & ( Inotify.IN_ISDIR | Inotify.IN_DELETE_SELF ):
+            return EventFolder
+        else:
+            return EventFile
+
+    def _get_flags ( self, var, *values ):
+        return [ v == var for v in values ]
+
+    def _transform ( self, leaf, event ):
+        """
+        Transforms a native event. Returns an empty list if the event it received does not apply 
+        (for example, the file is inside a watched folder but does not match the glob pattern)
+        """
+        if event == None:
+            return []
+
+        ( mask, path, filename ) = event
+        
+        action = self._get_event_action( mask )
+        type = self._get_event_type( mask )
+
+        if leaf.type == InotifyWatcherParent:
+            return []
+
+        filepath = os.path.join( path, filename ) if filename else path
+
+        return self._match( leaf.root, mask, action, type, filepath )
+
+    def _match ( self, root, mask, action, type, filepath, remember = True ):
+        """
+        Matches the path once against each glob that shares the subtree, and returns one event for each id of the globs that
+        match and asked for this type of native event. Paths that match are also updated in the snapshot of the subtree
+        """
+        events = []
+
+        matched = False
+
+        if self.metrics is not None:
+            start = time.perf_counter()
+
+        for glob in root.globs:
+            if glob.mask & mask and glob.matcher.fullmatch( filepath ) is not None:
+                events.extend( ( id, action, type, self._spell( id, filepath ) ) for id in glob.ids if glob.masks[ id ] & mask )
+
+                matched = True
+
+        if self.metrics is not None:
+            self.metrics.observe( 'match_seconds', (), time.perf_counter() - start )
+
+        if matched and remember and not self._remember( root, action, type, filepath ):
+            return []
+
+        return events
+
+    def _match_move ( self, root, type, source, target, old_watched, new_watched ):
+        """
+        Returns the events of a path renamed from source to target (old_watched and new_watched tell if the subtree receives
+        the events of each folder). Ids that asked for EventMove receive one when both paths match their glob, and the
+        others (or when only one of the paths matches) receive a removal and a creation, like separate native events would
+        """
+        events = []
+
+        for glob in root.globs:
+            old_match = old_watched and glob.matcher.fullmatch( source ) is not None
+            new_match = new_watched and glob.matcher.fullmatch( target ) is not None
+
+            if not old_match and not new_match:
+                continue
+
+            for id in glob.ids:
+                if old_match and new_match and id in glob.moves:
+                    events.append( ( id, EventMove, type, self._spell( id, target ), self._spell( id, source ) ) )
+                else:
+                    if old_match and glob.masks[ id ] & Inotify.IN_MOVED_FROM:
+                        events.append( ( id, EventRemove, type, self._spell( id, source ) ) )
+
+                    if new_match and glob.masks[ id ] & Inotify.IN_MOVED_TO:
+                        events.append( ( id, EventCreate, type, self._spell( id, target ) ) )
+
+        return events
+
+    def _spell ( self, id, filepath ):
+        """
+        Returns the path as it would be spelled by the glob of the id (globs are watched by their absolute paths)
+        """
+        spelling = self.spellings.get( id )
+
+        if spelling is None:
+            return filepath
+
+        ( folder, written ) = spelling
+
+        relative = filepath[ len( folder ): ].lstrip( os.sep )
+
+        if not relative:
+            return written or os.curdir
+
+        return os.path.join( written, relative ) if written else relative
+
+    def _loud ( self, events ):
+        """
+        Tests if any of the events is for an id whose events are logged
+        """
+        return any( event[ 0 ] not in self.quiet for event in events )
+
+    def _log ( self, events ):
+        """
+        Logs each path of the events once (they have one event for each id that receives them)
+        """
+        if self.logger:
+            for ( action, type, filepath, *source ) in dict.fromkeys( event[ 1: ] for event in events if event[ 0 ] not in self.quiet ):
+                self.logger.event( event_name( action ), type_name( type ), filepath, *source )
+
+    def _remember ( self, root, action, type, filepath ):
+        """
+        Updates the path in the snapshot of the subtree. Returns False for creations that were already reported (by
+        _announce, for example). Until the snapshots are tracked, only the paths already in it are checked, so most events
+        never need a stat
+        """
+        if not self.tracking and ( action == EventRemove or filepath not in root.snapshot ):
+            root.snapshot.pop( filepath, None )
+
+            return True
+
+        if action != EventRemove:
+            try:
+                stat = os.stat( filepath )
+
+                entry = ( type, stat.st_mtime_ns, stat.st_size, stat.st_ino )
+
+                announced = action == EventCreate and root.snapshot.get( filepath ) == entry
+
+                if self.tracking:
+                    root.snapshot[ filepath ] = entry
+                else:
+                    del root.snapshot[ filepath ]
+
+                return not announced
+            except OSError:
+                # Already removed again, the event for that is still on the way
+                pass
+
+        root.snapshot.pop( filepath, None )
+
+        return True
+
+    def _snapshot ( self, subtree, watcher = None ):
+        """
+        Lists every path watched by the subtree (or only the ones below one of its watchers) that matches its globs, with
+        their modification time, size and inode. The folders are listed in parallel when scan_workers is bigger than one
+        """
+        globs = [ glob.matcher for glob in subtree.globs ]
+
+        def visit ( path, is_dir, stat ):
+            if any( matcher.fullmatch( path ) is not None for matcher in globs ):
+                try:
+                    stat = stat()
+
+                    return [ ( path, ( EventFolder if is_dir else EventFile, stat.st_mtime_ns, stat.st_size, stat.st_ino ) ) ]
+                except OSError:
+                    pass
+
+            return []
+
+        def list_folder ( folder ):
+            entries = []
+
+            try:
+                with os.scandir( folder ) as iterator:
+                    for entry in iterator:
+                        entries.extend( visit( entry.path, entry.is_dir(), entry.stat ) )
+            except OSError:
+                pass
+
+            return entries
+
+        snapshot = dict()
+
+        # Plain path globs can watch (and match) the path itself, which may even be a file
+        if watcher is None and os.path.exists( subtree.glob ):
+            snapshot.update( visit( subtree.glob, os.path.isdir( subtree.glob ), lambda: os.stat( subtree.glob ) ) )
+
+        # The watchers of the subfolders are already known, so every folder can be listed at once
+        folders = []
+
+        pending = [ watcher or subtree ]
+
+        while pending:
+            watcher = pending.pop()
+
+            pending.extend( self.watchers_id[ child ] for child in watcher.children if child in self.watchers_id and self.watchers_id[ child ].type == InotifyWatcherChild )
+
+            folders.append( watcher.glob )
+
+        if self.scan_workers > 1 and len( folders ) > 1:
+            with concurrent.futures.ThreadPoolExecutor( max_workers = self.scan_workers ) as pool:
+                listings = list( pool.map( list_folder, folders ) )
+        else:
+            listings = map( list_folder, folders )
+
+        for entries in listings:
+            snapshot.update( entries )
+
+        return snapshot
+
+    def _announce ( self, watcher ):
+        """
+        Yields create events for the entries that were already inside a new folder when it started being watched (created
+        with mkdir -p, moved into the tree, or found by polling), since the backends never report those
+        """
+        root = watcher.root
+
+        for filepath, entry in self._snapshot( root, watcher ).items():
+            if root.snapshot.get( filepath ) == entry:
+                continue
+
+            root.snapshot[ filepath ] = entry
+
+            events = self._match( root, EventMasks[ EventCreate ], EventCreate, entry[ 0 ], filepath, remember = False )
+
+            self._log( events )
+
+            yield from events
+
+    def _remove_children ( self, watcher ):
+        """
+        Called when the folder of the watcher is removed. The subfolders are usually reported removed first, but not when
+        they are watched by a different backend, so any left are removed too, and remove events are yielded for the paths
+        below the folder that were never reported as removed
+        """
+        children = [ self.watchers_id[ child ] for child in watcher.children if child in self.watchers_id and self.watchers_id[ child ].type == InotifyWatcherChild ]
+
+        if not children:
+            return
+
+        for child in children:
+            self._remove_tree( child )
+
+        yield from self._removed_below( watcher.root, watcher.glob )
+
+    def _removed_below ( self, root, folder ):
+        """
+        Yields remove events for the paths of the snapshot below the folder (deepest first), which are removed from it
+        """
+        prefix = os.path.join( folder, '' )
+
+        for filepath in sorted( ( filepath for filepath in root.snapshot if filepath.startswith( prefix ) ), reverse = True ):
+            type = root.snapshot[ filepath ][ 0 ]
+
+            events = self._match( root, EventMasks[ EventRemove ], EventRemove, type, filepath )
+
+            self._log( events )
+
+            yield from events
+
+    def _reconcile ( self, subtree, since = None ):
+        """
+        Rebuilds the watchers of the subtree after events were lost (their folders may have been created, removed or replaced
+        in the meantime), and yields the events that describe the differences between its snapshot and the disk. When the
+        subtree had no snapshot, since is when the events were last read (time.time_ns): the files modified after it are
+        reported as updated, but the paths removed in the meantime are lost
+        """
+        holds_native = self._holds_native( subtree )
+
+        # Parents waiting for the subtree are created again from scratch, in case the folders they waited for changed
+        for child in list( subtree.children ):
+            if child in self.watchers_id and self.watchers_id[ child ].type == InotifyWatcherParent:
+                self._remove_tree( self.watchers_id[ child ] )
+
+        exists = os.path.exists( subtree.glob )
+
+        if exists and not holds_native:
+            try:
+                self._add_watch_native( subtree.glob )
+
+                holds_native = True
+            except OSError:
+                exists = False
+
+        if exists:
+            pending = [ subtree ]
+
+            while pending:
+                watcher = pending.pop()
+
+                try:
+                    # Adding the watch again creates a new one if the folder was replaced, and is harmless otherwise
+                    self._backend( watcher.glob ).add_watch( watcher.glob, self.watchers_masks[ watcher.glob ] )
+                except OSError:
+                    if watcher is subtree:
+                        exists = False
+
+                        break
+
+                    self._remove_tree( watcher )
+
+                    continue
+
+                for child in list( watcher.children ):
+                    if child in self.watchers_id:
+                        if os.path.isdir( self.watchers_id[ child ].glob ):
+                            pending.append( self.watchers_id[ child ] )
+                        else:
+                            self._remove_tree( self.watchers_id[ child ] )
+
+            if exists and subtree.recursive:
+                self._scan_watcher( subtree )
+
+        if not exists:
+            for child in list( subtree.children ):
+                if child in self.watchers_id:
+                    self._remove_tree( self.watchers_id[ child ] )
+
+            if holds_native:
+                self._remove_watch_native( subtree.glob, superficial = True )
+
+            child = self._create_watcher( InotifyWatcher( 
+                parent_folder( subtree.glob ), 
+                type = InotifyWatcherParent, 
+                parent = subtree.id,
+            ) )
+
+            subtree.children.append( child.id )
+
+        previous, subtree.snapshot = subtree.snapshot, self._snapshot( subtree )
+
+        if since is not None:
+            previous = dict( 
+                ( filepath, entry if entry[ 1 ] < since else ( entry[ 0 ], None, *entry[ 2: ] ) ) 
+                for filepath, entry in subtree.snapshot.items() 
+            )
+
+        yield from self._differences( subtree, previous )
+
+    def _differences ( self, subtree, previous ):
+        """
+        Yields the events that turn an older snapshot of the subtree into its current one. Files that were replaced (a new
+        inode) count as updated even when their modification time and size are the same
+        """
+        changes = []
+
+        for filepath, ( type, mtime, size, inode ) in subtree.snapshot.items():
+            old = previous.get( filepath )
+
+            if old is None:
+                changes.append( ( EventCreate, type, filepath ) )
+            elif old[ 0 ] != type:
+                changes.append( ( EventRemove, old[ 0 ], filepath ) )
+                changes.append( ( EventCreate, type, filepath ) )
+            elif type == EventFile and old[ 1: ] != ( mtime, size, inode ):
+                changes.append( ( EventUpdate, type, filepath ) )
+
+        # Removed paths are reported from the deepest to the shallowest, like the backends do
+        for filepath in sorted( ( filepath for filepath in previous if filepath not in subtree.snapshot ), reverse = True ):
+            changes.append( ( EventRemove, previous[ filepath ][ 0 ], filepath ) )
+
+        for ( action, type, filepath ) in changes:
+            # Synthetic updates must reach both the globs listening to IN_MODIFY and the ones listening to IN_CLOSE_WRITE
+            mask = EventMasks[ action ] | ( Inotify.IN_CLOSE_WRITE if action == EventUpdate else 0 )
+
+            events = self._match( subtree, mask, action, type, filepath, remember = False )
+
+            self._log( events )
+
+            yield from events
+
+    def track ( self ):
+        """
+        Takes the snapshots of every subtree, and keeps them up to date with the events from then on. Until it is called,
+        events never stat their files and watching a glob never lists its files
+        """
+        if self.tracking:
+            return
+
+        self.tracking = True
+
+        for subtree in self.subtrees.values():
+            subtree.snapshot = self._snapshot( subtree )
+
+    def snapshots ( self ):
+        """
+        Returns a dictionary matching the root folder of each subtree to its snapshot, which can be given to resume later
+        """
+        self.track()
+
+        return dict( ( folder, subtree.snapshot ) for folder, subtree in self.subtrees.items() )
+
+    def resume ( self, snapshots ):
+        """
+        Yields the events for the changes made since the snapshots (returned by snapshots, usually by a previous run) were
+        taken. Subtrees without an older snapshot are skipped, since nothing is known about what they looked like
+        """
+        self.track()
+
+        for folder, previous in snapshots.items():
+            subtree = self.subtrees.get( folder )
+
+            if subtree is None:
+                continue
+
+            events = list( self._differences( subtree, previous ) )
+
+            if self.logger:
+                self.logger.resume( folder, len( events ) )
+
+            yield from events
+
+    def load_state ( self, directory ):
+        """
+        Returns the events missed since the snapshots were saved to the directory (see State)
+        """
+        return list( self.resume( State.load( directory, self.subtrees.keys() ) ) )
+
+    def save_state ( self, directory ):
+        State.save( directory, self.snapshots() )
+
+    def _overflow ( self ):
+        """
+        The kernel discards events when its queue is full, and only reports that it did. Since any folder could have lost 
+        events, every subtree is reconciled with the disk. The first overflow starts tracking the snapshots, so that the next
+        ones can tell exactly what changed
+        """
+        subtrees = list( self.subtrees.values() )
+
+        if self.logger:
+            self.logger.overflow( len( subtrees ) )
+
+        since = None if self.tracking else self.last_read - MTIME_SLACK * 1_000_000_000
+
+        self.tracking = True
+
+        for subtree in subtrees:
+            yield from self._reconcile( subtree, since )
+    
+    def _descendants ( self, watcher ):
+        """
+        Returns the watcher and every InotifyWatcherChild below it
+        """
+        watchers = [ watcher ]
+
+        for descendant in watchers:
+            watchers.extend( self.watchers_id[ child ] for child in descendant.children if child in self.watchers_id and self.watchers_id[ child ].type == InotifyWatcherChild )
+
+        return watchers
+
+    def _movable ( self, source, folder, target ):
+        """
+        Tests if the watchers of the folder renamed from source to target (inside folder) can simply be renamed: every
+        watcher of source must be an InotifyWatcherChild whose subtree also watches the new folder with the same depth, and
+        the folders below it cannot be watched by anything else. Returns the list of ( watcher, new parent, descendants ),
+        or None when the watchers have to be removed and created again
+        """
+        watchers = self.watchers.get( source, () )
+
+        if not watchers or any( watcher.type != InotifyWatcherChild for watcher in watchers ):
+            return None
+
+        moves = []
+
+        for watcher in watchers:
+            parent = next( ( other for other in self.watchers[ folder ] if other.root is watcher.root and other.type in ( InotifyWatcherFolder, InotifyWatcherChild ) ), None )
+
+            if parent is None or max( parent.recursive - 1, 0 ) != watcher.recursive:
+                return None
+
+            moves.append( ( watcher, parent, self._descendants( watcher ) ) )
+
+        # Subtrees that would start watching the folder now (they were not watching it before) need new watchers
+        roots = set( watcher.root for watcher in watchers )
+
+        for other in self.watchers[ folder ]:
+            if other.type in ( InotifyWatcherFolder, InotifyWatcherChild ) and other.root not in roots and other.recursive > 0 and self._accept_folder( other.root, target ):
+                return None
+
+        moving = set( descendant for ( watcher, parent, descendants ) in moves for descendant in descendants )
+
+        for ( watcher, parent, descendants ) in moves:
+            for descendant in descendants:
+                path = target + descendant.glob[ len( source ): ]
+
+                if path in self.watchers or not self._accept_folder( watcher.root, path ):
+                    return None
+
+                if any( other not in moving for other in self.watchers[ descendant.glob ] ):
+                    return None
+
+        return moves
+
+    def _rename_watch_native ( self, folder, path ):
+        if folder not in self.watchers_cache:
+            return
+
+        self.watchers_cache[ path ] = self.watchers_cache.pop( folder )
+        self.watchers_masks[ path ] = self.watchers_masks.pop( folder )
+
+        backend = self.backends.pop( folder, self.inotify )
+
+        if backend is not self.inotify:
+            self.backends[ path ] = backend
+
+        backend.rename_watch( folder, path )
+
+    def _rename_watcher ( self, watcher, parent, descendants, source, target ):
+        """
+        Moves the watcher under its new parent, and renames it (and its descendants) from source to target
+        """
+        self.watchers_id[ watcher.parent ].children.remove( watcher.id )
+
+        parent.children.append( watcher.id )
+
+        watcher.parent = parent.id
+
+        for descendant in descendants:
+            self._unindex_watcher( descendant )
+
+            self.watchers[ descendant.glob ].remove( descendant )
+
+            if not self.watchers[ descendant.glob ]:
+                del self.watchers[ descendant.glob ]
+
+            descendant.glob = target + descendant.glob[ len( source ): ]
+
+            self.watchers.setdefault( descendant.glob, [] ).append( descendant )
+
+            self._index_watcher( descendant )
+
+    def _moved_paths ( self, root, watcher, source, target ):
+        """
+        Updates the snapshot of the subtree for a folder renamed from source to target (already watched by watcher), and
+        yields the events of the folder and of every path below it
+        """
+        prefix = os.path.join( source, '' )
+
+        before = dict( ( filepath, entry ) for filepath, entry in root.snapshot.items() if filepath == source or filepath.startswith( prefix ) )
+
+        for filepath in before:
+            del root.snapshot[ filepath ]
+
+        # The old entries would be enough to rename the paths, but some paths may only match the globs with their new name
+        after = self._snapshot( root, watcher )
+
+        if any( glob.matcher.fullmatch( target ) is not None for glob in root.globs ):
+            try:
+                stat = os.stat( target )
+
+                after[ target ] = ( EventFolder, stat.st_mtime_ns, stat.st_size, stat.st_ino )
+            except OSError:
+                pass
+
+        if self.tracking:
+            root.snapshot.update( after )
+        else:
+            # Without a snapshot, the old paths are the new ones with the old name that match the globs
+            for filepath, entry in after.items():
+                old = source + filepath[ len( target ): ]
+
+                if any( glob.matcher.fullmatch( old ) is not None for glob in root.globs ):
+                    before.setdefault( old, entry )
+
+        names = set( filepath[ len( source ): ] for filepath in before ) | set( filepath[ len( target ): ] for filepath in after )
+
+        for name in sorted( names ):
+            ( old, new ) = ( source + name, target + name )
+
+            type = ( after.get( new ) or before[ old ] )[ 0 ]
+
+            events = self._match_move( root, type, old, new, old in before, new in after )
+
+            self._log( events )
+
+            yield from events
+
+    def _move ( self, mask, path, filename, to_mask, to_path, to_filename, renames ):
+        """
+        Handles an IN_MOVED_FROM together with the IN_MOVED_TO of the same rename (they share the cookie). Renamed folders
+        keep their watchers and native watches, which are only renamed (and the rename is added to renames, for the events
+        of the same batch that still use the old paths). When that is not possible, both events are handled on their own
+        """
+        if path not in self.watchers or to_path not in self.watchers or to_path in self.parents:
+            yield from self._process( mask, path, filename )
+            yield from self._process( to_mask, to_path, to_filename )
+
+            return
+
+        source = os.path.join( path, filename )
+        target = os.path.join( to_path, to_filename )
+
+        is_folder = bool( mask & Inotify.IN_ISDIR )
+
+        moves = self._movable( source, to_path, target ) if is_folder else []
+
+        if moves is None:
+            yield from self._process( mask, path, filename )
+            yield from self._process( to_mask, to_path, to_filename )
+
+            return
+
+        for folder in dict.fromkeys( descendant.glob for ( watcher, parent, descendants ) in moves for descendant in descendants ):
+            self._rename_watch_native( folder, target + folder[ len( source ): ] )
+
+        for ( watcher, parent, descendants ) in moves:
+            self._rename_watcher( watcher, parent, descendants, source, target )
+
+        if moves:
+            renames.append( ( source, target ) )
+
+        renamed = dict( ( watcher.root, watcher ) for ( watcher, parent, descendants ) in moves )
+
+        old_roots = self.index.get( path, [] )
+        new_roots = self.index.get( to_path, [] )
+
+        for root in dict.fromkeys( old_roots + new_roots ):
+            if root in renamed:
+                yield from self._moved_paths( root, renamed[ root ], source, target )
+
+                continue
+
+            type = EventFolder if is_folder else EventFile
+
+            root.snapshot.pop( source, None )
+
+            if root in new_roots and any( glob.matcher.fullmatch( target ) is not None for glob in root.globs ):
+                self._remember( root, EventCreate, type, target )
+
+            events = self._match_move( root, type, source, target, root in old_roots, root in new_roots )
+
+            self._log( events )
+
+            yield from events
+
+    def _rename ( self, path, renames ):
+        for ( source, target ) in renames:
+            if path is not None and ( path == source or path.startswith( os.path.join( source, '' ) ) ):
+                path = target + path[ len( source ): ]
+
+        return path
+
+    def _process ( self, mask, path, filename ):
+        """
+        Updates the watchers affected by a single native event, and yields the transformed events it produces
+        """
+        if mask & Inotify.IN_Q_OVERFLOW:
+            yield from self._overflow()
+
+            return
+
+        # Every folder we're listening should have a watcher attached, if not it's best to just skip the event
+        if path not in self.watchers:
+            self._debug( f"Path '{ path }' not found in watchers" )
+            return
+
+        # POSSIBLE CASES:
+        # (x) means emit event
+        # - InotifyWatcherParent CREATE parent path: Remove watcher and add parent native watcher
+        # - InotifyWatcherParent REMOVE self path: Create another parent watcher and add parent native watcher
+        # - InotifyWatcherChild | InotifyWatcherFolder CREATE child folder: Create another InotifyWatcherChild and add native watcher (x)
+        # - InotifyWatcherChild REMOVE self folder: Remove watcher (x)
+        # - InotifyWatcherFolder REMOVE self folder: Create parent watcher (x)
+
+        is_create, is_remove, is_update = self._get_flags( self._get_event_action( mask ), EventCreate, EventRemove, EventUpdate )
+        is_folder, is_file = self._get_flags( self._get_event_type( mask ), EventFolder, EventFile )
+
+        if not is_remove and not is_create and not is_update:
+            if self.debug: self._debug( f"Ignored event type { Inotify.mask_names( mask ) } {is_remove}" )
+            return
+
+        if self.debug: self._debug( Inotify.mask_names( mask ), path, filename, '\n' )
+
+        # A watched folder moved out of the trees is never reported as removed (its watch follows it), so its watchers are
+        # removed now along with everything that was inside it
+        if is_folder and filename and mask & Inotify.IN_MOVED_FROM:
+            for watcher in list( self.watchers.get( os.path.join( path, filename ), () ) ):
+                if watcher.type == InotifyWatcherChild and watcher.id in self.watchers_id:
+                    self._remove_tree( watcher )
+
+                    yield from self._removed_below( watcher.root, watcher.glob )
+
+        # Set a boolean flag to avoid logging the same event more than once
+        logged = False
+
+        # Events for entries inside the folder that cannot change the watchers (anything other than the creation of
+        # folders, the creation of paths some InotifyWatcherParent waits for, and the removal of watched folders)
+        # only need to be matched against the root watchers indexed for this folder
+        if filename and ( not is_create or ( is_file and path not in self.parents ) ):
+            action = EventCreate if is_create else ( EventRemove if is_remove else EventUpdate )
+            type = EventFolder if is_folder else EventFile
+
+            filepath = os.path.join( path, filename )
+
+            for root in self.index.get( path, () ):
+                for event in self._match( root, mask, action, type, filepath ):
+                    if not logged and self.logger and event[ 0 ] not in self.quiet:
+                        self.logger.event( event_name( action ), type_name( type ), filepath )
+
+                        logged = True
+
+                    yield event
+
+            return
+
+        # The watchers of this path can change while handling the event
+        for watcher in list( self.watchers[ path ] ):
+            t_watcher, t_path, t_filename = watcher, path, filename
+
+            created = None
+
+            if watcher.type == InotifyWatcherParent:
+                parent_watcher = self.watchers_id[ watcher.parent ]
+
+                if is_create and os.path.normpath( os.path.join( path, filename ) ) == parent_watcher.glob:
+                    self._remove_watcher( watcher.id )
+
+                    self._remove_watch_native( watcher.glob )
+
+                    self._add_watch_native( parent_watcher.glob )
+
+                    self._catch_up( parent_watcher )
+
+                    t_watcher, t_path, t_filename = parent_watcher, parent_watcher.glob, ''
+                elif is_remove and not filename:
+                    child = self._create_watcher( InotifyWatcher( 
+                        parent_folder( watcher.glob ), 
+                        type = InotifyWatcherParent, 
+                        parent = watcher.id,
+                    ) )
+
+                    watcher.children.append( child.id )
+
+                    self._remove_watch_native( watcher.glob, superficial = True )
+            elif watcher.type == InotifyWatcherChild: # or 
+                if is_folder and is_create and watcher.recursive > 0 and self._accept_folder( watcher.root, os.path.join( path, filename ) ):
+                    child = self._create_watcher( InotifyWatcher( 
+                        os.path.join( watcher.glob, filename ), 
+                        type = InotifyWatcherChild, 
+                        parent = watcher.id,
+                        recursive = max( watcher.recursive - 1, 0 )
+                    ) )
+
+                    # The folder may be gone already, and its removal is still on the way
+                    if child is not None:
+                        watcher.children.append( child.id )
+
+                        created = child
+                elif is_remove and not filename:
+                    yield from self._remove_children( watcher )
+
+                    self._remove_watcher( watcher.id )
+
+                    self._remove_watch_native( watcher.glob, superficial = True )
+
+                    t_watcher, t_path, t_filename = self.watchers_id[ watcher.parent ], os.path.dirname( path ), os.path.basename( path )
+            elif watcher.type == InotifyWatcherFolder:
+                if is_folder and is_create and watcher.recursive > 0 and self._accept_folder( watcher.root, os.path.join( path, filename ) ):
+                    child = self._create_watcher( InotifyWatcher( 
+                        os.path.join( watcher.glob, filename ), 
+                        type = InotifyWatcherChild, 
+                        parent = watcher.id,
+                        recursive = max( watcher.recursive - 1, 0 )
+                    ) )
+
+                    # The folder may be gone already, and its removal is still on the way
+                    if child is not None:
+                        watcher.children.append( child.id )
+
+                        created = child
+                elif is_remove and not filename:
+                    yield from self._remove_children( watcher )
+
+                    child = self._create_watcher( InotifyWatcher( 
+                        parent_folder( watcher.glob ), 
+                        type = InotifyWatcherParent, 
+                        parent = watcher.id,
+                    ) )
+
+                    watcher.children.append( child.id )
+
+                    self._remove_watch_native( watcher.glob, superficial = True )
+
+            for event in self._transform( t_watcher, ( mask, t_path, t_filename ) ):
+                if not logged and self.logger and event[ 0 ] not in self.quiet:
+                    self.logger.event( event_name( event[ 1 ] ), type_name( event[ 2 ] ), event[ 3 ] )
+
+                    logged = True
+
+                yield event
+
+            if created is not None:
+                yield from self._announce( created )
+
+    def _timeout ( self, timeout ):
+        if callable( timeout ):
+            return timeout()
+
+        return self.block_duration if timeout is None else timeout
+
+    def _fallback_timeout ( self, timeout ):
+        """
+        The main backend cannot wait past the moment some folder of the fallback backend must be polled
+        """
+        if self.fallback is None or not self.fallback.watches:
+            return timeout
+
+        due = self.fallback.timeout()
+
+        if due is None:
+            return timeout
+
+        return due if timeout is None else min( timeout, due )
+
+    def _pairs ( self, events ):
+        """
+        Returns a dictionary matching the index of each IN_MOVED_FROM of the batch to the index of the IN_MOVED_TO with the
+        same cookie (renames inside the watched folders). Renames split between two batches are handled as separate events
+        """
+        pairs = dict()
+
+        pending = dict()
+
+        for index, ( mask, cookie, path, filename ) in enumerate( events ):
+            if not cookie:
+                continue
+
+            if mask & Inotify.IN_MOVED_FROM:
+                pending[ cookie ] = index
+            elif mask & Inotify.IN_MOVED_TO and cookie in pending:
+                pairs[ pending.pop( cookie ) ] = index
+
+        return pairs
+
+    def _receive ( self, events ):
+        """
+        Yields the transformed events of a batch of native events
+        """
+        self.received = time.monotonic()
+
+        self.last_read, self.read_at = self.read_at, time.time_ns()
+
+        pairs = self._pairs( events )
+
+        paired = set( pairs.values() )
+
+        # Folders renamed in place while handling the batch. The later events of the batch were read before, so their paths
+        # still have the old names
+        renames = []
+
+        for index, ( mask, cookie, path, filename ) in enumerate( events ):
+            if index in paired:
+                continue
+
+            path = self._rename( path, renames )
+
+            if index in pairs:
+                ( to_mask, cookie, to_path, to_filename ) = events[ pairs[ index ] ]
+
+                transformed = self._move( mask, path, filename, to_mask, self._rename( to_path, renames ), to_filename, renames )
+            else:
+                transformed = self._process( mask, path, filename )
+
+            if self.metrics is None:
+                yield from transformed
+
+                continue
+
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self.metrics.inc( 'overflows_total' )
+
+                yield from transformed
+
+                continue
+
+            emitted = 0
+
+            for event in transformed:
+                emitted += 1
+
+                yield event
+
+            self.metrics.inc( 'events_received_total', ( path, ) )
+
+            if index in pairs:
+                self.metrics.inc( 'events_received_total', ( to_path, ) )
+
+            if not emitted:
+                self.metrics.inc( 'events_dropped_total', ( path, ) )
+
+    def listen ( self, ignore_missing_new_folders = False, timeout = None ):
+        """
+        Yields the transformed events. A None is yielded after each batch of native events (meaning there is nothing else
+        pending right now) and whenever timeout seconds pass without events. When timeout is None, the block_duration given
+        to the constructor is used. It can also be a function, called before each wait, that returns the seconds to wait
+        (or None to wait for as long as needed)
+        """
+        while True:
+            yield from self._receive( self.inotify.read_events( timeout = self._fallback_timeout( self._timeout( timeout ) ) ) )
+
+            if self.fallback is not None:
+                yield from self._receive( self.fallback.read_events( timeout = 0 ) )
+
+            yield None
+
+    async def alisten ( self, timeout = None ):
+        """
+        Same as listen, but as an asynchronous generator that waits for the events without blocking the asyncio loop
+        """
+        while True:
+            try:
+                events = await asyncio.wait_for( self.inotify.aread_events(), self._fallback_timeout( self._timeout( timeout ) ) )
+            except asyncio.TimeoutError:
+                events = []
+
+            if self.fallback is not None:
+                events = events + self.fallback.read_events( timeout = 0 )
+
+            for event in self._receive( events ):
+                yield event
+
+            yield None
+
+    def close ( self ):
+        self.inotify.close()
+
+        if self.fallback is not None:
+            self.fallback.close()
 
 def event_name ( event ):
     if event ==  EventCreate:
@@ -404,6 +1947,8 @@ def event_name ( event ):
         return "update"
     elif event == EventRemove:
         return "remove"
+    elif event == EventMove:
+        return "move"
     else: return None
 
 def type_name ( type ):
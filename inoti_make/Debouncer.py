@@ -0,0 +1,200 @@
+from .BetterInotify import EventCreate, EventUpdate, EventRemove
+import itertools
+import heapq
+import time
+
+def coalesce ( previous, current ):
+    """
+    Merges two consecutive actions that happened to the same path into the single action that describes both.
+    Returns None when they cancel each other (a file that was created and removed before anyone noticed it)
+
+    >>> coalesce( EventCreate, EventUpdate ) == EventCreate
+    True
+    >>> coalesce( EventCreate, EventRemove ) is None
+    True
+    >>> coalesce( EventRemove, EventCreate ) == EventUpdate
+    True
+    """
+    if previous == EventCreate:
+        return None if current == EventRemove else EventCreate
+    elif current == EventRemove:
+        return EventRemove
+    else:
+        # A file that was removed and created again (or updated twice) is, for whoever runs after, just an update
+        return EventUpdate
+
+class Debouncer:
+    """
+    Holds the events of each key (usually the rule and the file path) until that key has been quiet for the whole window.
+    Events received in the meantime are coalesced into one, so a burst of writes results in a single action
+    """
+    def __init__ ( self ):
+        # Dictionary matching a key to a list [ deadline, event, payload ]
+        self.pending = dict()
+        # Heap of ( deadline, sequence, key ). Entries whose deadline no longer matches the pending one are stale and ignored
+        self.deadlines = []
+
+        self.sequence = itertools.count()
+
+    def __len__ ( self ):
+        return len( self.pending )
+
+    def push ( self, key, event, window, payload = None, now = None ):
+        now = time.monotonic() if now is None else now
+
+        deadline = now + window
+
+        if key in self.pending:
+            entry = self.pending[ key ]
+
+            ( id, action, type, filepath ) = entry[ 1 ]
+
+            action = coalesce( action, event[ 1 ] )
+
+            if action is None:
+                del self.pending[ key ]
+
+                return
+
+            entry[ 0 ] = deadline
+            entry[ 1 ] = ( id, action, event[ 2 ], filepath )
+        else:
+            self.pending[ key ] = [ deadline, event, payload ]
+
+        heapq.heappush( self.deadlines, ( deadline, next( self.sequence ), key ) )
+
+    def timeout ( self, now = None ):
+        """
+        Returns how many seconds until the next key is ready, or None if there is nothing pending
+        """
+        now = time.monotonic() if now is None else now
+
+        while self.deadlines:
+            ( deadline, _, key ) = self.deadlines[ 0 ]
+
+            if key in self.pending and self.pending[ key ][ 0 ] == deadline:
+                return max( deadline - now, 0 )
+
+            heapq.heappop( self.deadlines )
+
+        return None
+
+    def ready ( self, now = None ):
+        """
+        Yields the tuples ( event, payload ) for every key that has been quiet for their whole window
+        """
+        now = time.monotonic() if now is None else now
+
+        while self.deadlines and self.deadlines[ 0 ][ 0 ] <= now:
+            ( deadline, _, key ) = heapq.heappop( self.deadlines )
+
+            entry = self.pending.get( key )
+
+            if entry is not None and entry[ 0 ] == deadline:
+                del self.pending[ key ]
+
+                yield ( entry[ 1 ], entry[ 2 ] )
+
+    def flush ( self ):
+        """
+        Yields every pending event right away, regardless of their deadlines
+        """
+        for ( deadline, event, payload ) in sorted( self.pending.values(), key = lambda entry: entry[ 0 ] ):
+            yield ( event, payload )
+
+        self.pending.clear()
+        self.deadlines.clear()
+
+class Batcher:
+    """
+    Collects the events of each key (usually the rule) from the first one until its window ends, or until it has size
+    different paths. Events for a path that is already in the batch are coalesced with the previous one
+    """
+    def __init__ ( self ):
+        # Dictionary matching a key to a list [ deadline, dictionary matching each path to its event, payload ]
+        self.pending = dict()
+        # Heap of ( deadline, sequence, key ). Entries of batches that were already sent are stale and ignored
+        self.deadlines = []
+
+        self.sequence = itertools.count()
+
+    def __len__ ( self ):
+        return len( self.pending )
+
+    def push ( self, key, event, window, size = None, payload = None, now = None ):
+        """
+        Adds the event to the batch of the key. Returns the list of events of the batch when it is full, None otherwise
+        """
+        now = time.monotonic() if now is None else now
+
+        ( id, action, type, filepath ) = event
+
+        if key not in self.pending:
+            deadline = now + window
+
+            self.pending[ key ] = [ deadline, dict(), payload ]
+
+            heapq.heappush( self.deadlines, ( deadline, next( self.sequence ), key ) )
+
+        events = self.pending[ key ][ 1 ]
+
+        if filepath in events:
+            action = coalesce( events[ filepath ][ 1 ], action )
+
+            if action is None:
+                del events[ filepath ]
+            else:
+                events[ filepath ] = ( id, action, type, filepath )
+        else:
+            events[ filepath ] = event
+
+        if size and len( events ) >= size:
+            del self.pending[ key ]
+
+            return list( events.values() )
+
+        return None
+
+    def timeout ( self, now = None ):
+        """
+        Returns how many seconds until the next batch is ready, or None if there is nothing pending
+        """
+        now = time.monotonic() if now is None else now
+
+        while self.deadlines:
+            ( deadline, _, key ) = self.deadlines[ 0 ]
+
+            if key in self.pending and self.pending[ key ][ 0 ] == deadline:
+                return max( deadline - now, 0 )
+
+            heapq.heappop( self.deadlines )
+
+        return None
+
+    def ready ( self, now = None ):
+        """
+        Yields the tuples ( events, payload ) for every batch whose window ended (batches left empty by coalescing are dropped)
+        """
+        now = time.monotonic() if now is None else now
+
+        while self.deadlines and self.deadlines[ 0 ][ 0 ] <= now:
+            ( deadline, _, key ) = heapq.heappop( self.deadlines )
+
+            entry = self.pending.get( key )
+
+            if entry is not None and entry[ 0 ] == deadline:
+                del self.pending[ key ]
+
+                if entry[ 1 ]:
+                    yield ( list( entry[ 1 ].values() ), entry[ 2 ] )
+
+    def flush ( self ):
+        """
+        Yields the tuples ( events, payload ) of every pending batch right away, regardless of their windows
+        """
+        for ( deadline, events, payload ) in sorted( self.pending.values(), key = lambda entry: entry[ 0 ] ):
+            if events:
+                yield ( list( events.values() ), payload )
+
+        self.pending.clear()
+        self.deadlines.clear()
@@ -0,0 +1,345 @@
+from collections import Counter, deque
+import concurrent.futures
+import bisect
+import threading
+import traceback
+
+# What happens when an action does not fit in a full queue: the events stop being read until there is room (block), the
+# oldest waiting action of the rule is dropped (drop-oldest), or it is merged with the one waiting for the same path
+# (coalesce, which drops the oldest when there is none)
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_COALESCE = 'coalesce'
+
+POLICIES = ( POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_COALESCE )
+
+def check_policy ( policy ):
+    if policy not in POLICIES:
+        raise Exception( f'Invalid overload policy "{ policy }".' )
+
+    return policy
+
+class Task:
+    def __init__ ( self, rule, path, function, args ):
+        self.rule = rule
+        self.path = path
+        self.function = function
+        self.args = args
+        # Priority of the queue the task waits in, or None once it left the queue (it started or was dropped)
+        self.level = None
+
+    @property
+    def key ( self ):
+        return ( self.rule, self.path )
+
+    def __repr__ ( self ):
+        return "<Task \n\trule: %s \n\tpath: %s>" % ( id( self.rule ), self.path )
+
+class Dispatcher:
+    """
+    Runs the actions on a pool of threads, so that a slow action does not stop the events from being read.
+    The total number of actions running at the same time is limited by jobs, and each rule can have its own (lower) limit.
+    Actions of the same rule for the same path always run one at a time, in the order they were submitted.
+    The actions that cannot start right away wait in a queue, where rules with higher priorities go first. When the queue
+    holds more than capacity actions, the policy of the rule decides what to drop, but actions of rules with a lower
+    priority (that do not block) are always dropped first. coalesce is a function that merges the arguments of two
+    actions for the same path (returning None when they cancel each other), by default the newest ones are kept.
+    forget is a function called with the key and the arguments of each action removed from the queue without running
+    (dropped, discarded, left when shutting down, or the older one of two merged actions). It is called while holding the
+    lock, so it cannot use the dispatcher
+    """
+    def __init__ ( self, jobs = 1, capacity = None, coalesce = None, forget = None ):
+        self.jobs = max( jobs, 1 )
+        self.capacity = capacity
+        self.coalesce = coalesce
+        self.forget = forget
+
+        self.pool = concurrent.futures.ThreadPoolExecutor( max_workers = self.jobs )
+
+        # Dictionary matching a rule to the maximum number of actions it can have running
+        self.limits = dict()
+        # Dictionaries matching a rule to its priority (0 by default) and to its policy when the queue is full
+        self.priorities = dict()
+        self.policies = dict()
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition( self.lock )
+        # Notified when actions leave the queue, for the submits waiting for room
+        self.room = threading.Condition( self.lock )
+
+        # Dictionary matching each priority to the queue of its waiting actions, and the priorities from the highest to the
+        # lowest (stored negated, so that they stay sorted), so that scheduling never sorts the waiting actions
+        self.queues = dict()
+        self.levels = []
+        self.size = 0
+
+        self.running = 0
+        self.running_rules = Counter()
+        self.running_keys = set()
+
+        # Actions of each rule dropped (or merged into others) because the queue was full, and submits that had to wait,
+        # since the last call to take_drops
+        self.dropped = Counter()
+        self.coalesced = Counter()
+        self.blocked = Counter()
+
+    def limit ( self, rule, jobs ):
+        if jobs:
+            self.limits[ rule ] = int( jobs )
+
+    def prioritize ( self, rule, priority = 0, policy = POLICY_BLOCK ):
+        self.priorities[ rule ] = int( priority )
+        self.policies[ rule ] = check_policy( policy )
+
+    def __len__ ( self ):
+        """
+        Number of actions waiting for their turn
+        """
+        return self.size
+
+    def _waiting ( self ):
+        """
+        Yields the waiting tasks, from the highest priority to the lowest (and in the order they were submitted)
+        """
+        for level in self.levels:
+            yield from self.queues[ -level ]
+
+    def _enqueue ( self, task ):
+        task.level = self.priorities.get( task.rule, 0 )
+
+        if task.level not in self.queues:
+            self.queues[ task.level ] = deque()
+
+            bisect.insort( self.levels, -task.level )
+
+        self.queues[ task.level ].append( task )
+
+        self.size += 1
+
+    def _dequeue ( self, task ):
+        self.queues[ task.level ].remove( task )
+
+        task.level = None
+
+        self.size -= 1
+
+    def _forget ( self, tasks ):
+        if self.forget is not None:
+            for task in tasks:
+                self.forget( task.key, task.args )
+
+    def _can_run ( self, task ):
+        if task.key in self.running_keys:
+            return False
+
+        if task.rule in self.limits and self.running_rules[ task.rule ] >= self.limits[ task.rule ]:
+            return False
+
+        return True
+
+    def _schedule ( self ):
+        """
+        Starts every waiting task that is allowed to run, from the highest priority to the lowest. Only the tasks up to the
+        last one started are looked at, so nothing is scanned while every job is busy. Should only be called while holding
+        the lock
+        """
+        # Keys that have a task waiting before the current one. Later tasks with the same key cannot skip ahead of it
+        blocked = set()
+
+        for level in self.levels:
+            if self.running >= self.jobs:
+                return
+
+            queue = self.queues[ -level ]
+
+            skipped = []
+
+            while queue and self.running < self.jobs:
+                task = queue.popleft()
+
+                if task.key in blocked or not self._can_run( task ):
+                    blocked.add( task.key )
+
+                    skipped.append( task )
+
+                    continue
+
+                task.level = None
+
+                self.size -= 1
+
+                self.running += 1
+                self.running_rules[ task.rule ] += 1
+                self.running_keys.add( task.key )
+
+                self.pool.submit( self._run, task )
+
+            queue.extendleft( reversed( skipped ) )
+
+    def _run ( self, task ):
+        try:
+            task.function( *task.args )
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.running_rules[ task.rule ] -= 1
+                self.running_keys.discard( task.key )
+
+                self._schedule()
+
+                if not self.running and not self.size:
+                    self.idle.notify_all()
+
+                self.room.notify_all()
+
+    def _victim ( self, task ):
+        """
+        Returns the waiting task to drop to make room for the task: the oldest one of the lowest priority below it (rules
+        that block are never dropped) or, if the task itself can be dropped, the oldest one of its rule
+        """
+        priority = self.priorities.get( task.rule, 0 )
+
+        for level in reversed( self.levels ):
+            if -level >= priority:
+                break
+
+            for waiting in self.queues[ -level ]:
+                if self.policies.get( waiting.rule, POLICY_BLOCK ) != POLICY_BLOCK:
+                    return waiting
+
+        if self.policies.get( task.rule, POLICY_BLOCK ) != POLICY_BLOCK:
+            return next( ( waiting for waiting in self.queues.get( priority, () ) if waiting.rule == task.rule ), None )
+
+        return None
+
+    def _merge ( self, task ):
+        """
+        Merges the task into the last one waiting for the same path. Returns False if there is none
+        """
+        # A task that already started had no other task for its path before it
+        if task.level is None:
+            return False
+
+        previous = None
+
+        # Tasks of the same rule always share their queue
+        for waiting in self.queues[ task.level ]:
+            if waiting is task:
+                break
+
+            if waiting.key == task.key:
+                previous = waiting
+
+        if previous is None:
+            return False
+
+        args = task.args if self.coalesce is None else self.coalesce( previous.args, task.args )
+
+        self._dequeue( task )
+
+        if args is None:
+            self._dequeue( previous )
+
+            self._forget( [ previous, task ] )
+        else:
+            # The merged action takes the place of the newest one, so only the older arguments are gone
+            self._forget( [ previous ] )
+
+            previous.args = args
+
+        self.coalesced[ task.rule ] += 1
+
+        return True
+
+    def _overload ( self, task ):
+        """
+        Called when the task made the queue grow past its capacity. Should only be called while holding the lock
+        """
+        if self.policies.get( task.rule, POLICY_BLOCK ) == POLICY_COALESCE and self._merge( task ):
+            return
+
+        victim = self._victim( task )
+
+        if victim is not None:
+            self._dequeue( victim )
+
+            self._forget( [ victim ] )
+
+            self.dropped[ victim.rule ] += 1
+
+            return
+
+        self.blocked[ task.rule ] += 1
+
+        # The task stays in the queue (and may start) while waiting, so it is the events that wait
+        while self.size > self.capacity and task.level is not None:
+            self.room.wait()
+
+    def submit ( self, rule, path, function, *args ):
+        task = Task( rule, path, function, args )
+
+        with self.lock:
+            self._enqueue( task )
+
+            self._schedule()
+
+            if self.capacity is not None and self.size > self.capacity:
+                self._overload( task )
+
+    def busy ( self, key ):
+        """
+        Tests if an action with the key ( rule, path ) is running or waiting
+        """
+        with self.lock:
+            return key in self.running_keys or any( task.key == key for task in self._waiting() )
+
+    def discard ( self, key ):
+        """
+        Removes the waiting actions with the key ( rule, path ), since a newer one supersedes them
+        """
+        with self.lock:
+            for task in [ task for task in self._waiting() if task.key == key ]:
+                self._dequeue( task )
+
+                self._forget( [ task ] )
+
+            self.room.notify_all()
+
+    def take_drops ( self ):
+        """
+        Returns the counters ( dropped, coalesced, blocked ) of each rule since the last call, and resets them
+        """
+        with self.lock:
+            counters = ( self.dropped, self.coalesced, self.blocked )
+
+            self.dropped = Counter()
+            self.coalesced = Counter()
+            self.blocked = Counter()
+
+        return counters
+
+    def join ( self ):
+        """
+        Blocks until every submitted action has finished
+        """
+        with self.lock:
+            while self.running or self.size:
+                self.idle.wait()
+
+    def shutdown ( self, wait = True ):
+        """
+        Discards the actions that did not start yet and stops the pool (waiting for the running ones to finish if wait is True)
+        """
+        with self.lock:
+            self._forget( list( self._waiting() ) )
+
+            self.queues.clear()
+            self.levels.clear()
+
+            self.size = 0
+
+            self.room.notify_all()
+
+        self.pool.shutdown( wait = wait )
@@ -1,97 +1,641 @@
 from . import BetterInotify
 from . import Logger
+from . import Debouncer
+from . import Dispatcher
+from . import Parser
+from . import Poller
+from . import Metrics
+from . import HashCache
+from . import State
+from . import Sharding
+from . import Recording
 import subprocess
+import contextlib
+import threading
+import functools
+import traceback
+import asyncio
+import signal
+import tempfile
 import base64
+import shlex
+import time
 import sys
 import os
 
+# Names of the variables given to every action (see Inotifile.create_variables)
+VARIABLES = ( 'FILE', 'EXTNAME', 'FILENAME', 'DIRNAME', 'ACTION', 'TYPE', 'OLDFILE' )
+
+# Lists given to the actions of batched rules ([batch=...]), with one item for each event of the batch
+BATCH_VARIABLES = ( 'FILES', 'ACTIONS', 'TYPES' )
+
+EVENT_TYPES = { 'create': BetterInotify.EventCreate, 'update': BetterInotify.EventUpdate, 'remove': BetterInotify.EventRemove, 'move': BetterInotify.EventMove }
+
+# Characters PowerShell reads as single quotes (besides ' itself, the typographic ones)
+POWERSHELL_QUOTES = "'\u2018\u2019\u201a\u201b"
+
+# Seconds to wait after the Inotifile changes before parsing it again (editors often write a file in more than one step)
+RELOAD_DELAY = 0.2
+
+# Minimum seconds between the log lines about the actions dropped because the queue was full
+QUEUE_REPORT_INTERVAL = 5
+
+# What happens to an event when the action of its rule for the same path is still running: it runs afterwards (queue),
+# the running action is killed and the new one starts right away (restart), or the event is ignored (ignore)
+BUSY_QUEUE = 'queue'
+BUSY_RESTART = 'restart'
+BUSY_IGNORE = 'ignore'
+
+BUSY_POLICIES = ( BUSY_QUEUE, BUSY_RESTART, BUSY_IGNORE )
+
+NODE_WORKER = """
+const fs = require( 'fs' ), vm = require( 'vm' ), readline = require( 'readline' );
+
+const ack = parseInt( process.env.INOTI_MAKE_FD );
+
+readline.createInterface( { input: process.stdin } ).on( 'line', line => {
+    let status = 0;
+
+    try {
+        const script = Buffer.from( line, 'base64' ).toString( 'utf8' );
+
+        vm.runInThisContext( '(function (require) {\\n' + script + '\\n})' )( require );
+    } catch ( error ) {
+        console.error( error );
+
+        status = 1;
+    }
+
+    fs.writeSync( ack, status + '\\n' );
+} );
+"""
+
+POWERSHELL_WORKER = """
+$ack = [System.IO.StreamWriter]::new( "/proc/self/fd/$env:INOTI_MAKE_FD" )
+
+while ( $null -ne ( $line = [Console]::In.ReadLine() ) ) {
+    $status = 0
+
+    try {
+        $script = [System.Text.Encoding]::Unicode.GetString( [System.Convert]::FromBase64String( $line ) )
+
+        & ( [ScriptBlock]::Create( $script ) ) | Out-Host
+
+        if ( -not $? ) { $status = 1 }
+    } catch {
+        Write-Host $_
+
+        $status = 1
+    }
+
+    $ack.WriteLine( $status )
+    $ack.Flush()
+}
+"""
+
+def encode_powershell ( script ):
+    return base64.b64encode( script.encode( 'UTF-16LE' ) ).decode( 'ascii' )
+
+class Execution:
+    """
+    Handle of an action that can be stopped from other threads, because a newer event superseded it (cancel) or because
+    it took longer than the timeout of its rule (expire). Executors that start processes attach them while they run, and
+    stopping kills their whole process group. Actions without a process (like Python actions, which run in this process)
+    cannot be killed, so they run to the end
+    """
+    def __init__ ( self ):
+        # Why stopping the action was asked for ('cancelled' or 'timeout'), or None. Actions stopped before they start never run
+        self.stopped = None
+        # Set to the same once a process of the action was actually killed, so that it is reported with that status
+        self.reason = None
+        self.process = None
+        self.lock = threading.Lock()
+
+    def attach ( self, process ):
+        with self.lock:
+            self.process = process
+
+        # Stopped before the process started
+        if self.stopped is not None:
+            self.kill()
+
+    def detach ( self ):
+        with self.lock:
+            self.process = None
+
+    def kill ( self ):
+        with self.lock:
+            if self.process is not None:
+                try:
+                    os.killpg( self.process.pid, signal.SIGKILL )
+                except ProcessLookupError:
+                    # Already finished
+                    return
+
+                self.reason = self.stopped
+
+    def stop ( self, reason ):
+        if self.stopped is None:
+            self.stopped = reason
+
+        self.kill()
+
+    def cancel ( self ):
+        self.stop( 'cancelled' )
+
+    def expire ( self ):
+        self.stop( 'timeout' )
+
+class Coprocess:
+    """
+    A long-lived interpreter that receives the scripts to run through its stdin (one request at a time) and answers with
+    the exit status of each one through a separate pipe, whose file descriptor is given in the INOTI_MAKE_FD variable.
+    If the interpreter dies it is started again on the next request. Since it runs in its own process group, stopping a
+    request kills the interpreter too
+    """
+    def __init__ ( self, command, bootstrap = None ):
+        self.command = command
+        self.bootstrap = bootstrap
+        self.process = None
+        self.acks = None
+        self.lock = threading.Lock()
+
+    def alive ( self ):
+        return self.process is not None and self.process.poll() is None
+
+    def start ( self ):
+        ( read, write ) = os.pipe()
+
+        try:
+            self.process = subprocess.Popen( 
+                self.command, 
+                stdin = subprocess.PIPE, 
+                stdout = sys.stdout, 
+                pass_fds = ( write, ), 
+                env = dict( os.environ, INOTI_MAKE_FD = str( write ) ),
+                encoding = 'utf-8',
+                start_new_session = True
+            )
+        finally:
+            os.close( write )
+
+        self.acks = os.fdopen( read, 'r', encoding = 'ascii' )
+
+        if self.bootstrap:
+            self.process.stdin.write( self.bootstrap )
+            self.process.stdin.flush()
+
+    def stop ( self ):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+            try:
+                self.process.wait( timeout = 1 )
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+            self.process = None
+
+        if self.acks is not None:
+            self.acks.close()
+
+            self.acks = None
+
+    def run ( self, request, execution = None ):
+        with self.lock:
+            # The request is only sent once, and an interpreter that died before receiving it can safely receive it again
+            for attempt in range( 2 ):
+                if not self.alive():
+                    self.stop()
+                    self.start()
+
+                try:
+                    self.process.stdin.write( request )
+                    self.process.stdin.flush()
+
+                    break
+                except BrokenPipeError:
+                    self.stop()
+            else:
+                return -1
+
+            if execution is not None:
+                execution.attach( self.process )
+
+            try:
+                status = self.acks.readline()
+            finally:
+                if execution is not None:
+                    execution.detach()
+
+            # When the pipe is closed without an answer, the interpreter crashed (or exited) while running the script
+            if not status:
+                self.stop()
+
+                return -1
+
+            return int( status )
+
+class Program:
+    """
+    The actions of a watcher, along with whatever the executor prepared for them when the Inotifile was loaded
+    """
+    def __init__ ( self, actions ):
+        self.actions = actions
+        self.coprocess = None
+        # Compiled form of the actions, for the executors that can compile them ahead of time
+        self.code = None
+
 class Executor:
+    # Encoding of the scripts given to the interpreters through their stdin
+    encoding = 'ascii'
+
     def escape ( self, string, quote = "'" ):
         string = string.replace( "\\", "\\\\" ).replace( quote, f"\\{quote}" )
 
         return f"{quote}{string}{quote}"
 
+    def literal ( self, value ):
+        """
+        Returns the value (a string, or a list of strings for the variables of batched rules) written in the language of the executor
+        """
+        if isinstance( value, list ):
+            return self.array( [ self.escape( item ) for item in value ] )
+
+        return self.escape( value )
+
+    def array ( self, items ):
+        return '[ ' + ', '.join( items ) + ' ]'
+
+    def coprocess ( self ):
+        """
+        Executors that support persistent workers return a new Coprocess for their interpreter
+        """
+        return None
+
+    def prepare ( self, watcher ):
+        """
+        Called once for every watcher when the Inotifile is loaded. The returned program is then given to run on every event
+        """
+        program = Program( watcher.actions )
+
+        if Parser.parse_flag( watcher.option( 'persistent' ) ):
+            program.coprocess = self.coprocess()
+
+            if program.coprocess:
+                program.coprocess.start()
+
+        return program
+
+    def release ( self, program ):
+        if program.coprocess:
+            program.coprocess.stop()
+
+    def command ( self, program, variables ):
+        """
+        Returns the tuple ( arguments, input ) for the process that runs the actions
+        """
+        raise NotImplementedError()
+
+    def request ( self, program, variables ):
+        """
+        Returns the request sent to the persistent worker of the program to run the actions
+        """
+        raise NotImplementedError()
+
+    def run ( self, program, variables, execution = None ):
+        """
+        Runs the actions and returns their exit status. When an Execution is given, the process runs in its own process
+        group and is attached to it, so that it can be stopped from another thread
+        """
+        if program.coprocess:
+            return program.coprocess.run( self.request( program, variables ), execution )
+
+        ( arguments, input ) = self.command( program, variables )
+
+        if execution is None:
+            return subprocess.run( arguments, input = input, stdout = sys.stdout, encoding = self.encoding ).returncode
+
+        process = subprocess.Popen( 
+            arguments, 
+            stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL, 
+            stdout = sys.stdout, 
+            encoding = self.encoding, 
+            start_new_session = True 
+        )
+
+        execution.attach( process )
+
+        try:
+            process.communicate( input )
+        finally:
+            execution.detach()
+
+        return process.returncode
+
+    async def arun ( self, program, variables ):
+        """
+        Same as run, but waits for the process inside the running asyncio loop. If cancelled, the process is killed
+        (along with anything it started, since each process runs in its own process group)
+        """
+        if program.coprocess:
+            return await asyncio.to_thread( program.coprocess.run, self.request( program, variables ) )
+
+        ( arguments, input ) = self.command( program, variables )
+
+        process = await asyncio.create_subprocess_exec( 
+            *arguments, 
+            stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL, 
+            stdout = sys.stdout,
+            start_new_session = True
+        )
+
+        try:
+            await process.communicate( input.encode( self.encoding ) if input is not None else None )
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                try:
+                    os.killpg( process.pid, signal.SIGKILL )
+                except ProcessLookupError:
+                    pass
+
+                await process.wait()
+
+            raise
+
+        return process.returncode
+
 class ShellExecutor(Executor):
     def inject ( self, variables ):
-        return [ f'{key}={variables[key]}' for key in variables.keys() ]
+        lines = []
 
-    def run ( self, actions, variables ):
-        command = '\n'.join( self.inject( variables ) + actions )
-        
-        subprocess.run( [ '/bin/sh' ], input = command, stdout = sys.stdout, encoding = 'ascii' )
+        for key, value in variables.items():
+            if isinstance( value, list ):
+                # POSIX sh has no arrays: the lists are given one item per line, and the files are also set as the 
+                # positional parameters, so that for FILE in "$@" works with any file name
+                lines.append( f'{key}={shlex.quote( chr( 10 ).join( value ) )}' )
+
+                if key == 'FILES':
+                    lines.append( 'set -- ' + ' '.join( shlex.quote( item ) for item in value ) )
+            else:
+                lines.append( f'{key}={shlex.quote( value )}' )
+
+        return lines
+
+    def coprocess ( self ):
+        # dash only accepts single digit file descriptors in redirections, so the pipe is reopened as fd 3
+        return Coprocess( [ '/bin/sh' ], bootstrap = 'exec 3>"/proc/self/fd/$INOTI_MAKE_FD"\n' )
+
+    def script ( self, program, variables ):
+        return '\n'.join( self.inject( variables ) + program.actions )
+
+    def command ( self, program, variables ):
+        return ( [ '/bin/sh' ], self.script( program, variables ) )
+
+    def request ( self, program, variables ):
+        # Each script runs in a subshell so that variables set by one event do not leak into the next one
+        return f'( eval {shlex.quote( self.script( program, variables ) )} ) < /dev/null\necho $? >&3\n'
 
 class PythonExecutor(Executor):
-    def run ( self, actions, variables ):
-        exec( '\n'.join( actions ), variables )
+    def prepare ( self, watcher ):
+        program = super().prepare( watcher )
+
+        # Compiling when the Inotifile loads means syntax errors show up right away, and each event only runs the code object
+        program.code = compile( '\n'.join( program.actions ), f'<{ " ".join( watcher.patterns ) }>', 'exec' )
+
+        return program
+
+    def run ( self, program, variables, execution = None ):
+        # The actions run in this process, so they cannot be stopped
+        exec( program.code, variables )
+
+        return 0
+
+    async def arun ( self, program, variables ):
+        # The actions run in the interpreter itself, so they are moved out of the asyncio loop to not block it
+        return await asyncio.to_thread( self.run, program, variables )
 
 class PowershellExecutor(Executor):
+    def escape ( self, string, quote = "'" ):
+        """
+        Single-quoted strings of PowerShell take backslashes literally, and only escape their quotes by doubling them
+        """
+        string = ''.join( char * 2 if char in POWERSHELL_QUOTES else char for char in string )
+
+        return f"'{string}'"
+
     def inject ( self, variables ):
-        return [ f'${key}={self.escape(variables[key])}' for key in variables.keys() ]
+        return [ f'${key}={self.literal(variables[key])}' for key in variables.keys() ]
+
+    def array ( self, items ):
+        return '[string[]]@( ' + ', '.join( items ) + ' )'
+
+    def coprocess ( self ):
+        return Coprocess( [ 'pwsh-preview', '-NoLogo', '-NoProfile', '-NonInteractive', '-ec', encode_powershell( POWERSHELL_WORKER ) ] )
+
+    def script ( self, program, variables ):
+        return '\n'.join( self.inject( variables ) + program.actions )
+
+    def command ( self, program, variables ):
+        return ( [ 'pwsh-preview', '-ec', encode_powershell( self.script( program, variables ) ) ], None )
 
-    def run_script ( self, script ):
-        command = base64.b64encode( 
-            script.encode('UTF-16LE') 
-        ).decode( 'ascii' )
+    def request ( self, program, variables ):
+        return encode_powershell( self.script( program, variables ) ) + '\n'
 
-        os.system( f'pwsh-preview -ec {command}' )
+    def run_script ( self, script, coprocess = None ):
+        command = encode_powershell( script )
 
+        if coprocess:
+            return coprocess.run( command + '\n' )
 
-    def run ( self, actions, variables ):
-        self.run_script( '\n'.join( self.inject( variables ) + actions ) )
+        return subprocess.run( [ 'pwsh-preview', '-ec', command ] ).returncode
 
 class CSharpExecutor(PowershellExecutor):
-    def inject ( self, variables ):
-        quote = '"'
+    def __init__ ( self ):
+        # Folder where the assemblies compiled for each watcher are kept
+        self.folder = None
+        self.counter = 0
+
+    def compile ( self, actions, batch = False ):
+        """
+        Compiles the actions into an assembly with a static Run method that receives the variables as parameters (and the 
+        lists of batched rules as arrays). Returns the tuple ( class name, assembly path ), and throws an exception if the 
+        code does not compile
+        """
+        if self.folder is None:
+            self.folder = tempfile.mkdtemp( prefix = 'inoti-make-' )
 
-        return [ f'String {key} = {self.escape(variables[key], quote)};' for key in variables.keys() ]
+        name = f'Rule{ self.counter }'
 
-    def run ( self, actions, variables ):
-        variables = self.inject( variables )
+        self.counter += 1
+
+        assembly = os.path.join( self.folder, f'{ name }.dll' )
+
+        parameters = ', '.join( [ f'String {key}' for key in VARIABLES ] + ( [ f'String[] {key}' for key in BATCH_VARIABLES ] if batch else [] ) )
 
         source = """
+        $ErrorActionPreference = "Stop"
+
         $assemblies=(
             "System", "System.Console"
         )
 
-        $source=@"
+        $source=@'
         using System;
         
         #pragma warning disable CS0219
         namespace INotify {
-            public static class App {
-                public static void Main(){
-                    """ + '\n'.join( variables ) + """
+            public static class """ + name + """ {
+                public static void Run(""" + parameters + """){
                     """ + '\n'.join( actions ) + """
                 }
             }
         }
-"@
+'@
 
-        Add-Type -ReferencedAssemblies $assemblies -TypeDefinition $source -Language CSharp -IgnoreWarnings
-
-        [INotify.App]::Main()
+        Add-Type -ReferencedAssemblies $assemblies -TypeDefinition $source -Language CSharp -IgnoreWarnings -OutputAssembly """ + self.escape( assembly ) + """ -OutputType Library
         """
 
-        self.run_script( source )
+        if self.run_script( source ) != 0:
+            raise Exception( f'Could not compile the C# actions of { name }.' )
+
+        return ( name, assembly )
+
+    def prepare ( self, watcher ):
+        program = super().prepare( watcher )
+
+        program.code = self.compile( program.actions, batch = bool( watcher.option( 'batch' ) ) )
+
+        return program
+
+    def release ( self, program ):
+        super().release( program )
+
+        ( name, assembly ) = program.code
+
+        if os.path.exists( assembly ):
+            os.remove( assembly )
+
+    def script ( self, program, variables ):
+        ( name, assembly ) = program.code
+
+        keys = VARIABLES + BATCH_VARIABLES if 'FILES' in variables else VARIABLES
+
+        arguments = ', '.join( self.literal( variables[ key ] ) if key in variables else '$null' for key in keys )
+
+        # Loading an assembly that is already loaded (in a persistent worker) is a no-op, so the code is never compiled again
+        return f'Add-Type -Path { self.escape( assembly ) }\n[INotify.{ name }]::Run( { arguments } )'
         
 
 class NodeExecutor(Executor):
     def inject ( self, variables ):
-        return [ f'var {key}={self.escape(variables[key])}' for key in variables.keys() ]
+        return [ f'var {key}={self.literal(variables[key])}' for key in variables.keys() ]
 
-    def run ( self, actions, variables ):
-        command = '\n'.join( self.inject( variables ) + actions )
-        
-        subprocess.run( [ '/usr/bin/env', 'node' ], input = command, stdout = sys.stdout, encoding = 'ascii' )
+    def coprocess ( self ):
+        return Coprocess( [ '/usr/bin/env', 'node', '-e', NODE_WORKER ] )
+
+    def script ( self, program, variables ):
+        return '\n'.join( self.inject( variables ) + program.actions )
 
+    def command ( self, program, variables ):
+        return ( [ '/usr/bin/env', 'node' ], self.script( program, variables ) )
+
+    def request ( self, program, variables ):
+        return base64.b64encode( self.script( program, variables ).encode( 'utf-8' ) ).decode( 'ascii' ) + '\n'
+
+
+class StubExecutor(Executor):
+    """
+    Runs nothing, so that recordings can be replayed without running the actions. Each action takes duration seconds
+    """
+    def __init__ ( self, duration = 0 ):
+        self.duration = duration
+
+    def prepare ( self, watcher ):
+        return Program( watcher.actions )
+
+    def run ( self, program, variables, execution = None ):
+        if self.duration:
+            time.sleep( self.duration )
+
+        return 0
+
+    async def arun ( self, program, variables ):
+        if self.duration:
+            await asyncio.sleep( self.duration )
+
+        return 0
         
 class Inotifile:
-    def __init__ ( self, executors, watchers ):
+    def __init__ ( self, executors, watchers, debounce = 0, jobs = 1, scan_workers = 1, watch_budget = None, poll_interval = None, stats = None, stats_interval = Metrics.STATS_INTERVAL, hash_cache = None, state = None, source = None, shards = 1, queue_size = None, overload = Dispatcher.POLICY_BLOCK, record = None, replay = None, replay_speed = 1 ):
         self.executors = executors
         self.watchers = watchers
+        # Default quiet window (in seconds) for watchers that do not set their own [debounce=...] option
+        self.debounce = debounce
+        self.debouncer = Debouncer.Debouncer()
+        self.batcher = Debouncer.Batcher()
+        # Maximum number of actions running at the same time (each watcher can lower it with [jobs=...])
+        self.jobs = jobs
+        self.dispatcher = None
+        # Maximum number of actions waiting for their turn (None for no limit), and what to do with the new ones when it is
+        # reached, for watchers that do not set their own [overload=...] option (see Dispatcher.POLICIES)
+        self.queue_size = queue_size
+        self.overload = overload
+        self.queue_reported = None
+        # Dictionary matching ( watcher, path ) to the Execution of its last action, and the set of the ones running, so that
+        # the rules with [on_busy=restart] can stop the stale ones
+        self.executions = dict()
+        self.active = set()
+        self.lock = threading.Lock()
+        # Number of threads used to scan the trees of recursive patterns when they are added
+        self.scan_workers = scan_workers
+        # Maximum number of inotify watches to use, and how often (in seconds) the folders past that are polled
+        self.watch_budget = watch_budget
+        self.poll_interval = poll_interval
+        # Number of processes the watched trees are split between (see Sharding)
+        self.shards = shards
+        # Dictionary matching each watcher to the program its executor prepared
+        self.programs = dict()
+        # Dictionary matching each watcher to its debounce window
+        self.windows = dict()
+        # Dictionary matching each batched watcher to the tuple ( window, maximum size )
+        self.batches = dict()
+        # Dictionary matching the ids returned by BetterInotify.add_watch to their watcher
+        self.watchers_ids = dict()
+        # File where the metrics are written every stats_interval seconds (they are only collected when there is one)
+        self.stats = stats
+        self.stats_interval = stats_interval
+        self.metrics = Metrics.Metrics() if stats else None
+        # Dictionary matching each watcher to the labels that identify it in the metrics
+        self.rules = dict()
+        # Digests of the files seen by the rules with [hash=yes], saved to the hash_cache file (if any) when stopping
+        self.hashes = HashCache.HashCache()
+        self.hash_cache = hash_cache
+        self.hashed = set()
+        # Dictionary matching each watcher to the key of its digests in the cache
+        self.hash_keys = dict()
+        # Folder where the snapshots of the watched trees are kept between runs (None disables the catch-up on startup)
+        self.state = state
+        self.state_saved = None
+        # Path of the Inotifile the watchers came from. When set, it is watched too, and the rules are reloaded when it changes
+        self.source = source
+        self.source_id = None
+        self.reload_at = None
+        # File where the events handled are recorded, or recording whose events are handled instead of the file system's
+        # (at replay_speed times the speed they were recorded, or as fast as possible when 0)
+        self.record = record
+        self.recorder = None
+        self.replay = replay
+        self.replay_speed = replay_speed
+        # Set by start
+        self.logger = None
     
     def create_variables ( self, event ):
-        ( id, action, type, filepath ) = event
+        ( id, action, type, filepath ) = event[ :4 ]
 
         return {
             'FILE': filepath,
@@ -99,39 +643,885 @@ class Inotifile:
             'FILENAME': os.path.basename( filepath ),
             'DIRNAME': os.path.dirname( filepath ),
             'ACTION': BetterInotify.event_name( action ),
-            'TYPE': BetterInotify.type_name( type )
+            'TYPE': BetterInotify.type_name( type ),
+            # Only moves have the path the file had before
+            'OLDFILE': event[ 4 ] if len( event ) > 4 else ''
         }
 
-    def start ( self, logger = Logger.Logger() ):
-        inotify = BetterInotify.BetterInotify( logger = logger )
+    def create_batch_variables ( self, events ):
+        """
+        The variables of a batch are the lists FILES, ACTIONS and TYPES (in the order the events happened), along with the
+        variables of its last event
+        """
+        variables = self.create_variables( events[ -1 ] )
 
-        watchers_ids = dict()
+        variables[ 'FILES' ] = [ filepath for ( id, action, type, filepath ) in events ]
+        variables[ 'ACTIONS' ] = [ BetterInotify.event_name( action ) for ( id, action, type, filepath ) in events ]
+        variables[ 'TYPES' ] = [ BetterInotify.type_name( type ) for ( id, action, type, filepath ) in events ]
+
+        return variables
+
+    def debounce_window ( self, watcher ):
+        return Parser.parse_duration( watcher.option( 'debounce', self.debounce ) ) or 0
+
+    def batch_settings ( self, watcher ):
+        """
+        Returns the tuple ( window, maximum size ) of a batched watcher ([batch=2s] [batch_size=100]), or None
+        """
+        window = Parser.parse_duration( watcher.option( 'batch' ) )
+
+        if not window:
+            return None
+
+        return ( window, int( watcher.option( 'batch_size', 0 ) ) or None )
+
+    def timeout ( self ):
+        """
+        Returns how many seconds until some debounced event or batch is ready (None when nothing is pending)
+        """
+        timeouts = [ timeout for timeout in ( self.debouncer.timeout(), self.batcher.timeout() ) if timeout is not None ]
+
+        if self.reload_at is not None:
+            timeouts.append( max( self.reload_at - time.monotonic(), 0 ) )
+
+        return min( timeouts ) if timeouts else None
+
+    def executor ( self, watcher ):
+        return self.executors[ watcher.executor or 'shell' ]
+
+    def action_started ( self, watcher, received ):
+        """
+        Records how long the event took to start its action (received is when its native event was read). Returns the
+        time the action started
+        """
+        start = time.monotonic()
+
+        if self.metrics is not None and received is not None:
+            self.metrics.observe( 'action_latency_seconds', self.rules[ watcher ], start - received )
+
+        return start
+
+    def action_finished ( self, watcher, event, received, start, status ):
+        duration = time.monotonic() - start
+
+        if self.metrics is not None:
+            self.metrics.observe( 'action_duration_seconds', self.rules[ watcher ], duration )
+            self.metrics.inc( 'action_exit_codes_total', self.rules[ watcher ] + ( status, ) )
+
+        if self.logger is not None:
+            # Batches are logged with their last event
+            ( id, action, type, filepath ) = ( event[ -1 ] if isinstance( event, list ) else event )[ :4 ]
+
+            self.logger.action( 
+                *self.rules[ watcher ], 
+                BetterInotify.event_name( action ), BetterInotify.type_name( type ), filepath, 
+                status, None if received is None else start - received, duration,
+                files = len( event ) if isinstance( event, list ) else 1
+            )
+
+    def event_variables ( self, event ):
+        # Batched rules receive a list of events
+        return self.create_batch_variables( event ) if isinstance( event, list ) else self.create_variables( event )
+
+    def busy_policy ( self, watcher ):
+        return watcher.option( 'on_busy', BUSY_QUEUE )
+
+    def action_timeout ( self, watcher ):
+        return Parser.parse_duration( watcher.option( 'timeout' ) )
+
+    def action_key ( self, watcher, event ):
+        # Batches have no path (see dispatch)
+        return ( watcher, None if isinstance( event, list ) else event[ 3 ] )
+
+    def content_changed ( self, watcher, event ):
+        ( id, action, type, filepath ) = event[ :4 ]
+
+        key = ( self.hash_keys[ watcher ], filepath )
+
+        if action == BetterInotify.EventRemove:
+            self.hashes.forget( key )
+
+            return True
+
+        # The content did not change, but the path did
+        if action == BetterInotify.EventMove:
+            self.hashes.forget( ( self.hash_keys[ watcher ], event[ 4 ] ) )
+
+            return True
+
+        if type == BetterInotify.EventFolder or self.hashes.changed( key, filepath ):
+            return True
+
+        if self.metrics is not None:
+            self.metrics.inc( 'actions_suppressed_total', self.rules[ watcher ] )
+
+        return False
+
+    def changed_events ( self, watcher, event ):
+        """
+        For rules with [hash=yes], removes the events of files whose content did not change since the rule last saw them.
+        Returns None when nothing is left
+        """
+        if watcher not in self.hashed:
+            return event
+
+        if isinstance( event, list ):
+            return [ item for item in event if self.content_changed( watcher, item ) ] or None
+
+        return event if self.content_changed( watcher, event ) else None
+
+    def forget_execution ( self, key, execution ):
+        with self.lock:
+            if self.executions.get( key ) is execution:
+                del self.executions[ key ]
+
+    def forget_action ( self, key, args ):
+        """
+        Called by the dispatcher for the actions it removes from the queue without running them
+        """
+        ( watcher, event, received, execution ) = args
+
+        self.forget_execution( key, execution )
+
+    def execute ( self, watcher, event, received = None, execution = None ):
+        program = self.programs.get( watcher )
+
+        key = self.action_key( watcher, event )
+
+        execution = execution or Execution()
+
+        # The rule was removed from the Inotifile after the event was queued, or a newer event superseded this one before
+        # it started
+        if program is None or execution.stopped is not None:
+            return self.forget_execution( key, execution )
+
+        event = self.changed_events( watcher, event )
+
+        if event is None:
+            return self.forget_execution( key, execution )
+
+        variables = self.event_variables( event )
+
+        timeout = self.action_timeout( watcher )
+
+        timer = threading.Timer( timeout, execution.expire ) if timeout else None
+
+        with self.lock:
+            self.active.add( execution )
+
+        start = self.action_started( watcher, received )
+
+        # Actions that raise an exception are counted with the status "error"
+        status = 'error'
+
+        try:
+            if timer is not None:
+                timer.start()
+
+            code = self.executor( watcher ).run( program, variables, execution )
+
+            status = str( code )
+
+            return code
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+            with self.lock:
+                self.active.discard( execution )
+
+            self.forget_execution( key, execution )
+
+            self.action_finished( watcher, event, received, start, execution.reason or status )
+
+    def coalesce_actions ( self, previous, current ):
+        """
+        Merges the arguments of two actions of the same rule waiting for the same path (see Dispatcher). Batches are joined,
+        and events are coalesced like the debouncer does
+        """
+        ( watcher, event, received, _ ) = previous
+        # The newest Execution is the one the next events of the path will stop
+        ( _, newer, _, execution ) = current
+
+        if isinstance( event, list ):
+            return ( watcher, event + newer, received, execution )
+
+        # Moves have two paths, so only the newest event is kept
+        if len( event ) > 4 or len( newer ) > 4:
+            return ( watcher, newer, received, execution )
+
+        action = Debouncer.coalesce( event[ 1 ], newer[ 1 ] )
+
+        if action is None or not watcher.test( newer[ 3 ], [ BetterInotify.event_name( action ), BetterInotify.type_name( newer[ 2 ] ) ] ):
+            return None
+
+        return ( watcher, ( newer[ 0 ], action, *newer[ 2: ] ), received, execution )
+
+    def report_queue ( self ):
+        """
+        Logs (at most every QUEUE_REPORT_INTERVAL seconds) the actions of each rule that were dropped, coalesced or had to
+        wait because the queue was full
+        """
+        if self.dispatcher is None or self.queue_size is None:
+            return
+
+        if self.queue_reported is not None and time.monotonic() - self.queue_reported < QUEUE_REPORT_INTERVAL:
+            return
+
+        ( dropped, coalesced, blocked ) = self.dispatcher.take_drops()
+
+        for watcher in set( dropped ) | set( coalesced ) | set( blocked ):
+            if self.metrics is not None:
+                self.metrics.inc( 'actions_dropped_total', self.rules[ watcher ] + ( 'dropped', ), dropped[ watcher ] )
+                self.metrics.inc( 'actions_dropped_total', self.rules[ watcher ] + ( 'coalesced', ), coalesced[ watcher ] )
+                self.metrics.inc( 'queue_waits_total', self.rules[ watcher ], blocked[ watcher ] )
+
+            if self.logger is not None:
+                self.logger.queue( *self.rules[ watcher ], len( self.dispatcher ), self.queue_size, dropped[ watcher ], coalesced[ watcher ], blocked[ watcher ] )
+
+        self.queue_reported = time.monotonic()
+
+    def skip_busy ( self, watcher ):
+        if self.metrics is not None:
+            self.metrics.inc( 'actions_skipped_total', self.rules[ watcher ] )
+
+    def submit ( self, watcher, path, event, received ):
+        key = ( watcher, path )
+
+        policy = self.busy_policy( watcher )
+
+        if policy == BUSY_IGNORE and self.dispatcher.busy( key ):
+            return self.skip_busy( watcher )
+
+        execution = Execution()
+
+        with self.lock:
+            previous = self.executions.get( key )
+
+            self.executions[ key ] = execution
+
+        # The waiting actions are dropped and the running one is killed, so the new one starts as soon as it is gone
+        if policy == BUSY_RESTART:
+            self.dispatcher.discard( key )
+
+            if previous is not None:
+                previous.cancel()
+
+        self.dispatcher.submit( watcher, path, self.execute, watcher, event, received, execution )
+
+    def stop_actions ( self ):
+        """
+        Kills the actions that are running (their processes no longer receive the Ctrl+C of the terminal, since they run
+        in their own process groups)
+        """
+        with self.lock:
+            active = list( self.active )
+
+        for execution in active:
+            execution.cancel()
+
+    def dispatch ( self, watcher, event, received = None ):
+        ( id, action, type, filepath ) = event[ :4 ]
+
+        if watcher.test( filepath, [ BetterInotify.event_name( action ), BetterInotify.type_name( type ) ] ):
+            if watcher in self.batches:
+                ( window, size ) = self.batches[ watcher ]
+
+                batch = self.batcher.push( watcher, event, window, size, ( watcher, received ) )
+
+                # Batches of the same rule have no path, so they run one at a time, in order
+                if batch is not None:
+                    self.submit( watcher, None, batch, received )
+            else:
+                self.submit( watcher, filepath, event, received )
+
+    def label_rules ( self ):
+        # Rules are identified by their position in the Inotifile (patterns can repeat), and labeled with their patterns.
+        # Labels of removed rules are kept, since their last actions may still be running
+        self.rules.update( ( watcher, ( str( index ), ' '.join( watcher.patterns ) ) ) for index, watcher in enumerate( self.watchers ) )
+
+        # The digests are saved between runs, so they are kept by what the rule says (and which of the rules written the
+        # same way it is) instead of its position, which changes when other rules are added, removed or reordered
+        seen = dict()
 
-        # Add the patterns from the Inotify file to the watcher
         for watcher in self.watchers:
+            fingerprint = watcher.fingerprint()
+
+            seen[ fingerprint ] = seen.get( fingerprint, -1 ) + 1
+
+            self.hash_keys[ watcher ] = f'{ fingerprint }.{ seen[ fingerprint ] }'
+
+    def check_options ( self, watcher ):
+        """
+        Raises an exception if an option of the watcher has an invalid value
+        """
+        Dispatcher.check_policy( watcher.option( 'overload', self.overload ) )
+
+        int( watcher.option( 'priority', 0 ) )
+
+        if self.busy_policy( watcher ) not in BUSY_POLICIES:
+            raise Exception( f'Invalid on_busy policy "{ self.busy_policy( watcher ) }".' )
+
+        self.action_timeout( watcher )
+
+    def prepare_rules ( self, watchers ):
+        """
+        Reads the options of the watchers and prepares their programs. If any program fails, the ones already prepared are
+        released before raising the error
+        """
+        programs = dict()
+
+        try:
+            for watcher in watchers:
+                # Checked before preparing the program, so a bad option does not leave it prepared
+                self.check_options( watcher )
+
+                programs[ watcher ] = self.executor( watcher ).prepare( watcher )
+        except BaseException:
+            for watcher, program in programs.items():
+                self.executor( watcher ).release( program )
+
+            raise
+
+        for watcher in watchers:
+            self.windows[ watcher ] = self.debounce_window( watcher )
+
+            if self.batch_settings( watcher ):
+                self.batches[ watcher ] = self.batch_settings( watcher )
+
+            if Parser.parse_flag( watcher.option( 'hash' ) ):
+                self.hashed.add( watcher )
+
+        self.programs.update( programs )
+
+    def release_rules ( self, watchers ):
+        for watcher in watchers:
+            program = self.programs.pop( watcher, None )
+
+            if program is not None:
+                self.executor( watcher ).release( program )
+
+            self.windows.pop( watcher, None )
+            self.batches.pop( watcher, None )
+            self.hashed.discard( watcher )
+
+    def prepare ( self ):
+        if self.hash_cache:
+            self.hashes.load( self.hash_cache )
+
+        self.label_rules()
+
+        if self.metrics is not None:
+            self.metrics.histogram( 'action_latency_seconds', 'Time from reading the native event to starting the action', [ 'rule', 'patterns' ] )
+            self.metrics.histogram( 'action_duration_seconds', 'Time each action took to run', [ 'rule', 'patterns' ] )
+            self.metrics.counter( 'action_exit_codes_total', 'Actions that finished with each exit code', [ 'rule', 'patterns', 'code' ] )
+            self.metrics.gauge( 'debounce_pending', 'Paths waiting for their debounce window to end', lambda: len( self.debouncer ) )
+            self.metrics.gauge( 'batches_pending', 'Batches waiting for their window to end', lambda: len( self.batcher ) )
+            self.metrics.counter( 'actions_suppressed_total', 'Events skipped because the content of the file did not change', [ 'rule', 'patterns' ] )
+            self.metrics.counter( 'actions_dropped_total', 'Actions dropped (or merged into another one) because the queue was full', [ 'rule', 'patterns', 'reason' ] )
+            self.metrics.counter( 'actions_skipped_total', 'Events ignored because the action of the rule for the path was still running', [ 'rule', 'patterns' ] )
+            self.metrics.counter( 'queue_waits_total', 'Times the events stopped being read until the queue had room for an action', [ 'rule', 'patterns' ] )
+
+        # Programs are prepared before watching anything, so that errors in the actions show up right away
+        self.prepare_rules( self.watchers )
+
+    def release ( self ):
+        self.release_rules( list( self.programs.keys() ) )
+
+        if self.hash_cache:
+            self.hashes.save( self.hash_cache )
+
+    def watch_events ( self, watcher ):
+        """
+        Returns the types of events the kernel should report for this watcher. Debounced (and batched) watchers need every
+        event of the path, otherwise a burst like create + update + remove could not be coalesced correctly
+        """
+        if self.windows.get( watcher ) or watcher in self.batches:
+            return None
+
+        return [ EVENT_TYPES[ name ] for name in watcher.events() ]
+
+    def add_watches ( self, inotify, watchers = None ):
+        # Add the patterns from the Inotify file to the watcher
+        for watcher in ( self.watchers if watchers is None else watchers ):
+            events = self.watch_events( watcher )
+
+            close_write = Parser.parse_flag( watcher.option( 'close_write' ) )
+
+            gitignore = Parser.parse_flag( watcher.option( 'gitignore' ) )
+
             for folder in watcher.patterns:
-                id = inotify.add_watch( folder )
+                exclude = list( watcher.exclude )
+
+                if gitignore:
+                    exclude.extend( BetterInotify.gitignore_patterns( Parser.glob_root_folder( folder ) ) )
+
+                id = inotify.add_watch( folder, events = events, close_write = close_write, exclude = exclude )
 
-                watchers_ids[ id ] = watcher
+                self.watchers_ids[ id ] = watcher
+
+                if self.recorder is not None:
+                    self.recorder.watch( id, folder )
 
         if inotify.logger: inotify.logger.flush()
 
-        for event in inotify.listen():
-            if event != None: 
-                ( id, action, type, filepath ) = event
+    def remove_watches ( self, inotify, watchers ):
+        for id, watcher in list( self.watchers_ids.items() ):
+            if watcher in watchers:
+                inotify.remove_watch( id )
+
+                del self.watchers_ids[ id ]
+
+    def limit ( self, watcher ):
+        self.dispatcher.limit( watcher, watcher.option( 'jobs' ) )
+
+        self.dispatcher.prioritize( watcher, watcher.option( 'priority', 0 ), watcher.option( 'overload', self.overload ) )
+
+    def watch_source ( self, inotify ):
+        """
+        Watches the Inotifile through a glob on its folder (and not the file itself, since editors usually save by replacing
+        the file). The glob also matches the temporary files some editors write next to it, which are ignored by handle.
+        The glob is absolute, so its folder is the same for the rules that spell it differently. Its events are not logged
+        """
+        if self.source is not None:
+            glob = os.path.abspath( self.source ) + '*'
+
+            self.source_id = inotify.add_watch( glob, quiet = True )
+
+            if self.recorder is not None:
+                self.recorder.watch( self.source_id, glob )
+
+    def reload ( self, inotify ):
+        """
+        Parses the Inotifile again and compares the new watchers with the current ones. Only the patterns of the rules that
+        were added or removed are watched or unwatched: the rules that did not change keep their watchers (along with their
+        programs and pending events). When the new Inotifile has errors (or its new patterns cannot be watched), the current
+        rules are kept
+        """
+        logger = inotify.logger
+
+        try:
+            watchers = Parser.file( self.source )
+
+            # Rules that were written the same way are matched to the current ones (in order, since rules can repeat)
+            current = dict()
+
+            for watcher in self.watchers:
+                current.setdefault( watcher.signature(), [] ).append( watcher )
+
+            merged = []
+            added = []
+
+            for watcher in watchers:
+                same = current.get( watcher.signature() )
+
+                if same:
+                    merged.append( same.pop( 0 ) )
+                else:
+                    merged.append( watcher )
+                    added.append( watcher )
+
+            removed = [ watcher for same in current.values() for watcher in same ]
+
+            self.prepare_rules( added )
+        except Exception as error:
+            if logger: logger.reload_failed( self.source, error )
+
+            return
+
+        previous = self.watchers
+
+        self.watchers = merged
+
+        self.label_rules()
+
+        for watcher in added:
+            self.limit( watcher )
+
+        # New watches are added before the old ones are removed, so globs used by both keep their trees and native watches
+        try:
+            self.add_watches( inotify, added )
+        except OSError as error:
+            # A new pattern whose folder cannot be watched: the watches of the new rules are removed again
+            self.remove_watches( inotify, added )
+
+            self.release_rules( added )
+
+            self.watchers = previous
+
+            self.label_rules()
+
+            if logger: logger.reload_failed( self.source, error )
+
+            return
+
+        self.remove_watches( inotify, removed )
+
+        self.release_rules( removed )
+
+        if logger: logger.reload( self.source, len( added ), len( removed ), len( merged ) - len( added ) )
+
+    def create_inotify ( self, logger ):
+        if self.replay is not None:
+            return Recording.Replay( self.replay, logger = logger, speed = self.replay_speed )
+
+        if self.shards > 1:
+            return Sharding.Shards( self.shards, logger = logger, scan_workers = self.scan_workers, watch_budget = self.watch_budget, poll_interval = self.poll_interval, metrics = self.metrics )
+
+        fallback = Poller.Poller( interval = self.poll_interval ) if self.poll_interval else None
+
+        return BetterInotify.BetterInotify( logger = logger, scan_workers = self.scan_workers, fallback = fallback, watch_budget = self.watch_budget, metrics = self.metrics )
+
+    def create_dispatcher ( self ):
+        return Dispatcher.Dispatcher( jobs = self.jobs, capacity = self.queue_size, coalesce = self.coalesce_actions, forget = self.forget_action )
+
+    def create_recorder ( self ):
+        return Recording.Recorder( self.record ) if self.record else None
 
-                if id in watchers_ids:
-                    watcher = watchers_ids[ id ]
+    def start_reporter ( self ):
+        return Metrics.Reporter( self.metrics, self.stats, self.stats_interval ).start() if self.metrics is not None else None
 
-                    if watcher.test( filepath, [ BetterInotify.event_name( action ), BetterInotify.type_name( type ) ] ):
-                        # self.logger.log( BetterInotify.event_name( action ), BetterInotify.type_name( type ), filepath )
+    def handle ( self, inotify, event ):
+        """
+        Handles one event from BetterInotify.listen (or alisten), sending the events that are ready to dispatch
+        """
+        if self.recorder is not None:
+            self.recorder.record( event )
+
+        if event != None: 
+            ( id, action, type, filepath ) = event[ :4 ]
+
+            if id == self.source_id:
+                if action != BetterInotify.EventRemove and os.path.abspath( filepath ) == os.path.abspath( self.source ):
+                    self.reload_at = time.monotonic() + RELOAD_DELAY
+            elif id in self.watchers_ids:
+                watcher = self.watchers_ids[ id ]
+
+                window = self.windows[ watcher ]
+
+                # The conditions are only tested after coalescing, since a created file that was removed
+                # right away should not run the rule at all
+                if window > 0:
+                    self.debouncer.push( ( watcher, filepath ), event, window, ( watcher, inotify.received ) )
+                else:
+                    self.dispatch( watcher, event, inotify.received )
+        else:
+            # A None means there are no more events pending right now
+            if self.reload_at is not None and self.reload_at <= time.monotonic():
+                self.reload_at = None
+
+                self.reload( inotify )
 
-                        variables = self.create_variables( event )
+            for ( event, ( watcher, received ) ) in self.debouncer.ready():
+                self.dispatch( watcher, event, received )
 
-                        executor = self.executors[ watcher.executor or 'shell' ]
+            for ( events, ( watcher, received ) ) in self.batcher.ready():
+                self.submit( watcher, None, events, received )
 
-                        executor.run( watcher.actions, variables )
+            self.save_state( inotify )
+
+            self.report_queue()
             
             if inotify.logger: inotify.logger.flush()
 
-        
+    def flush ( self ):
+        """
+        Dispatches every debounced event and every batch still pending, without waiting for their windows to end
+        """
+        for ( event, ( watcher, received ) ) in self.debouncer.flush():
+            self.dispatch( watcher, event, received )
+
+        # Dispatching the debounced events may add them to batches, so these are only flushed afterwards
+        for ( events, ( watcher, received ) ) in self.batcher.flush():
+            self.submit( watcher, None, events, received )
+
+    def missed_events ( self, inotify ):
+        """
+        Returns the events for the changes made to the watched trees since the state was last saved
+        """
+        self.state_saved = time.monotonic()
+
+        if self.state is None:
+            return []
+
+        return inotify.load_state( self.state )
+
+    def save_state ( self, inotify, force = False ):
+        if self.state is None:
+            return
+
+        if not force and ( self.state_saved is None or time.monotonic() - self.state_saved < State.STATE_INTERVAL ):
+            return
+
+        inotify.save_state( self.state )
+
+        self.state_saved = time.monotonic()
+
+    def start ( self, logger = Logger.Logger() ):
+        self.logger = logger
+
+        # The shards are forked before the programs are prepared, so that they never hold the pipes of the persistent
+        # interpreters (which would then never see the end of their input)
+        inotify = self.create_inotify( logger )
+
+        try:
+            self.prepare()
+        except Exception:
+            inotify.close()
+
+            raise
+
+        self.dispatcher = self.create_dispatcher()
+
+        for watcher in self.watchers:
+            self.limit( watcher )
+
+        if self.metrics is not None:
+            self.metrics.gauge( 'queue_depth', 'Actions waiting for their turn to run', lambda: len( self.dispatcher ) )
+            self.metrics.gauge( 'actions_running', 'Actions running right now', lambda: self.dispatcher.running )
+
+        self.recorder = self.create_recorder()
+
+        self.add_watches( inotify )
+
+        self.watch_source( inotify )
+
+        reporter = self.start_reporter()
+
+        try:
+            inotify.received = time.monotonic()
+
+            for event in self.missed_events( inotify ):
+                self.handle( inotify, event )
+
+            # listen only has to wake up when some debounced event is ready (the timeout is None when nothing is pending)
+            for event in inotify.listen( timeout = self.timeout ):
+                self.handle( inotify, event )
+
+        finally:
+            # Whether listen ended on its own (replays) or was interrupted (Ctrl+C or SIGTERM), the pending events still run
+            # and the actions are allowed to finish. Only a second interrupt kills them
+            try:
+                self.flush()
+
+                self.dispatcher.join()
+            finally:
+                self.stop_actions()
+
+                self.dispatcher.shutdown()
+
+                self.save_state( inotify, force = True )
+
+                self.release()
+
+                inotify.close()
+
+                if self.recorder is not None:
+                    self.recorder.close()
+
+                if reporter is not None:
+                    reporter.stop()
+
+class AsyncInotifile(Inotifile):
+    """
+    Runs the Inotifile inside an asyncio loop. Events are read without blocking the loop, and each action runs as a task
+    (processes are started with asyncio.create_subprocess_exec), so many actions can be in flight without a thread for each
+    """
+    def __init__ ( self, executors, watchers, **kwargs ):
+        super().__init__( executors, watchers, **kwargs )
+
+        # Actions run as tasks, without the dispatcher and its queue
+        if self.queue_size is not None or self.overload != Dispatcher.POLICY_BLOCK:
+            raise Exception( 'The queue size and overload policy are not supported when running in asyncio.' )
+
+        self.tasks = set()
+        # Dictionary matching ( watcher, path ) to the last task started for it, so actions for the same path run in order
+        self.tails = dict()
+        self.semaphore = None
+        self.semaphores = dict()
+        self.listener = None
+        self.stopped = None
+        self.stopping = False
+        self.drain = True
+
+    async def execute ( self, watcher, event, received = None, previous = None ):
+        if previous is not None:
+            await asyncio.wait( [ previous ] )
+
+        if watcher in self.hashed:
+            # Hashing reads the files, so it is kept out of the loop
+            event = await asyncio.to_thread( self.changed_events, watcher, event )
+
+            if event is None:
+                return None
+
+        async with self.semaphores.get( watcher ) or contextlib.nullcontext():
+            async with self.semaphore:
+                program = self.programs.get( watcher )
+
+                # The rule was removed from the Inotifile while the action was waiting
+                if program is None:
+                    return None
+
+                variables = self.event_variables( event )
+
+                start = self.action_started( watcher, received )
+
+                status = 'error'
+
+                try:
+                    code = await asyncio.wait_for( self.executor( watcher ).arun( program, variables ), self.action_timeout( watcher ) )
+
+                    status = str( code )
+
+                    return code
+                except asyncio.TimeoutError:
+                    # wait_for already cancelled the action (and killed its processes)
+                    status = 'timeout'
+
+                    return None
+                except asyncio.CancelledError:
+                    status = 'cancelled'
+
+                    raise
+                finally:
+                    self.action_finished( watcher, event, received, start, status )
+
+    def check_options ( self, watcher ):
+        super().check_options( watcher )
+
+        for name in ( 'priority', 'overload' ):
+            if watcher.option( name ) is not None:
+                raise Exception( f'The option "{ name }" is not supported when running in asyncio.' )
+
+    def limit ( self, watcher ):
+        if watcher.option( 'jobs' ):
+            self.semaphores[ watcher ] = asyncio.Semaphore( int( watcher.option( 'jobs' ) ) )
+
+    def _done ( self, key, task ):
+        self.tasks.discard( task )
+
+        if self.tails.get( key ) is task:
+            del self.tails[ key ]
+
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+
+            traceback.print_exception( type( error ), error, error.__traceback__ )
+
+    def submit ( self, watcher, path, event, received ):
+        key = ( watcher, path )
+
+        previous = self.tails.get( key )
+
+        if previous is not None:
+            if self.busy_policy( watcher ) == BUSY_IGNORE:
+                return self.skip_busy( watcher )
+
+            # The new action still waits for the cancelled one, so it only starts once its processes are gone
+            if self.busy_policy( watcher ) == BUSY_RESTART:
+                previous.cancel()
+
+        task = asyncio.ensure_future( self.execute( watcher, event, received, previous ) )
+
+        self.tails[ key ] = task
+        self.tasks.add( task )
+
+        task.add_done_callback( functools.partial( self._done, key ) )
+
+    async def listen ( self, inotify ):
+        async for event in inotify.alisten( timeout = self.timeout ):
+            self.handle( inotify, event )
+
+    async def start ( self, logger = Logger.Logger() ):
+        self.logger = logger
+
+        loop = asyncio.get_running_loop()
+
+        self.stopped = loop.create_future()
+
+        # The shards are forked before the programs are prepared, so that they never hold the pipes of the persistent
+        # interpreters (which would then never see the end of their input)
+        inotify = self.create_inotify( logger )
+
+        try:
+            self.prepare()
+        except Exception:
+            inotify.close()
+
+            raise
+
+        self.semaphore = asyncio.Semaphore( max( self.jobs, 1 ) )
+
+        for watcher in self.watchers:
+            self.limit( watcher )
+
+        if self.metrics is not None:
+            self.metrics.gauge( 'actions_running', 'Actions started and not finished yet (including the ones waiting for their turn)', lambda: len( self.tasks ) )
+
+        self.recorder = self.create_recorder()
+
+        reporter = None
+
+        try:
+            # Scanning big trees takes a while, so it is done outside of the loop (nothing else uses inotify yet)
+            await loop.run_in_executor( None, self.add_watches, inotify )
+
+            self.watch_source( inotify )
+
+            reporter = self.start_reporter()
+
+            missed = await loop.run_in_executor( None, self.missed_events, inotify )
+
+            inotify.received = time.monotonic()
+
+            for event in missed:
+                self.handle( inotify, event )
+
+            self.listener = asyncio.ensure_future( self.listen( inotify ) )
+
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                # stop() cancels the listener, but if this task itself was cancelled the cancellation must go on
+                if not self.stopping:
+                    raise
+        finally:
+            # Draining also runs the events still waiting for their windows to end, instead of silently dropping them
+            if self.drain:
+                self.flush()
+            else:
+                for task in self.tasks:
+                    task.cancel()
+
+            if self.tasks:
+                await asyncio.gather( *self.tasks, return_exceptions = True )
+
+            self.save_state( inotify, force = True )
+
+            self.release()
+
+            inotify.close()
+
+            if self.recorder is not None:
+                self.recorder.close()
+
+            if reporter is not None:
+                reporter.stop()
+
+            if not self.stopped.done():
+                self.stopped.set_result( None )
+
+    def stop ( self, drain = True ):
+        """
+        Stops listening for events. When drain is True the actions already started are allowed to finish, otherwise they
+        are cancelled (and their processes killed). Returns a future that is done once everything has stopped
+        """
+        self.drain = drain
+
+        self.stopping = True
+
+        if self.listener is not None:
+            self.listener.cancel()
+
+        return self.stopped
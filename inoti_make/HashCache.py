@@ -0,0 +1,122 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import json
+import os
+
+# Memory (in bytes, roughly) the cache can use before evicting the least recently used entries
+MAX_BYTES = 16 * 1024 * 1024
+# Rough size of an entry besides its key: the tuple, the digest and the dictionary slot
+ENTRY_BYTES = 200
+# Files are hashed in chunks, so big files never have to be read into memory at once
+CHUNK_SIZE = 1024 * 1024
+
+def hash_file ( path ):
+    digest = hashlib.blake2b( digest_size = 16 )
+
+    with open( path, 'rb' ) as file:
+        while True:
+            chunk = file.read( CHUNK_SIZE )
+
+            if not chunk:
+                break
+
+            digest.update( chunk )
+
+    return digest.hexdigest()
+
+class HashCache:
+    """
+    Remembers the digest of the content of each file (for each key, usually the rule and the path), so that events that
+    did not change the content (touches, or saving the same content again) can be told apart from real changes.
+    Files whose size and modification time did not change are not hashed again. The least recently used entries are
+    evicted once the cache takes more than max_bytes
+    """
+    def __init__ ( self, max_bytes = MAX_BYTES ):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+        # Dictionary matching a key to ( mtime, size, digest ), from the least to the most recently used
+        self.entries = OrderedDict()
+
+        self.lock = threading.Lock()
+
+    def __len__ ( self ):
+        return len( self.entries )
+
+    def _cost ( self, key ):
+        return ENTRY_BYTES + sum( len( part ) for part in key )
+
+    def _store ( self, key, entry ):
+        with self.lock:
+            if key not in self.entries:
+                self.bytes += self._cost( key )
+
+            self.entries[ key ] = entry
+            self.entries.move_to_end( key )
+
+            while self.bytes > self.max_bytes and self.entries:
+                ( evicted, _ ) = self.entries.popitem( last = False )
+
+                self.bytes -= self._cost( evicted )
+
+    def forget ( self, key ):
+        with self.lock:
+            if self.entries.pop( key, None ) is not None:
+                self.bytes -= self._cost( key )
+
+    def changed ( self, key, path ):
+        """
+        Tests if the content of the file changed since the last time it was seen with this key. Files seen for the first
+        time (or that cannot be read) count as changed
+        """
+        try:
+            stat = os.stat( path )
+        except OSError:
+            self.forget( key )
+
+            return True
+
+        with self.lock:
+            entry = self.entries.get( key )
+
+            if entry is not None:
+                self.entries.move_to_end( key )
+
+        if entry is not None and entry[ 0 ] == stat.st_mtime_ns and entry[ 1 ] == stat.st_size:
+            return False
+
+        try:
+            digest = hash_file( path )
+        except OSError:
+            self.forget( key )
+
+            return True
+
+        self._store( key, ( stat.st_mtime_ns, stat.st_size, digest ) )
+
+        return entry is None or entry[ 2 ] != digest
+
+    def load ( self, path ):
+        """
+        Loads the entries saved by save. A missing (or unreadable) file just leaves the cache empty
+        """
+        try:
+            with open( path ) as file:
+                entries = json.load( file )[ 'entries' ]
+        except ( OSError, ValueError, KeyError ):
+            return
+
+        for ( *key, mtime, size, digest ) in entries:
+            self._store( tuple( key ), ( mtime, size, digest ) )
+
+    def save ( self, path ):
+        with self.lock:
+            entries = [ [ *key, *entry ] for key, entry in self.entries.items() ]
+
+        temporary = f'{path}.{os.getpid()}.tmp'
+
+        with open( temporary, 'w' ) as file:
+            json.dump( dict( version = 1, entries = entries ), file )
+
+        os.replace( temporary, path )
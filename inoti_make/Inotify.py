@@ -0,0 +1,289 @@
+import ctypes.util
+import asyncio
+import ctypes
+import select
+import struct
+import errno
+import os
+import io
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+IN_ONESHOT = 0x80000000
+
+IN_ALL_EVENTS = 0x00000fff
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+MASK_NAMES = dict( ( value, name ) for name, value in globals().items() if name.startswith( 'IN_' ) and name not in ( 'IN_ALL_EVENTS', 'IN_NONBLOCK', 'IN_CLOEXEC' ) )
+
+# Every event starts with the header struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; }
+# followed by len bytes with the file name (padded with null bytes)
+HEADER = struct.Struct( 'iIII' )
+
+# Enough for a few thousand events per read (each one takes at most 16 bytes plus NAME_MAX + 1)
+BUFFER_SIZE = 1024 * 1024
+
+_libc = None
+
+def libc ():
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno = True )
+
+        _libc.inotify_init1.argtypes = [ ctypes.c_int ]
+        _libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+        _libc.inotify_rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+
+    return _libc
+
+def mask_names ( mask ):
+    return [ name for value, name in MASK_NAMES.items() if mask & value ]
+
+def check ( result, path = None ):
+    if result < 0:
+        code = ctypes.get_errno()
+
+        raise OSError( code, os.strerror( code ), path )
+
+    return result
+
+class Inotify:
+    """
+    Thin wrapper around an inotify file descriptor. Events are read in batches (as many as fit in the buffer with a single
+    read) and parsed straight from the buffer, and each one is returned as the tuple ( mask, cookie, path, filename )
+    """
+    def __init__ ( self, buffer_size = BUFFER_SIZE ):
+        self.fd = check( libc().inotify_init1( IN_NONBLOCK | IN_CLOEXEC ) )
+
+        self.file = io.FileIO( self.fd, 'rb', closefd = False )
+
+        self.buffer = bytearray( buffer_size )
+        self.view = memoryview( self.buffer )
+
+        self.poll = select.poll()
+        self.poll.register( self.fd, select.POLLIN )
+
+        # Dictionary matching a path to its watch descriptor
+        self.watches = dict()
+        # Dictionary matching a watch descriptor to the set of its paths. The kernel returns the same descriptor for every
+        # path of the same folder (symbolic links, bind mounts, relative and absolute paths), and its events go to all of them
+        self.paths = dict()
+        # Dictionary matching a path to the mask it asked for, and a watch descriptor to the mask the kernel has (the union
+        # of the masks of its paths)
+        self.masks = dict()
+        self.wd_masks = dict()
+
+    def fileno ( self ):
+        return self.fd
+
+    def close ( self ):
+        if self.fd is not None:
+            self.poll.unregister( self.fd )
+
+            os.close( self.fd )
+
+            self.fd = None
+
+    def _forget_path ( self, path, wd ):
+        """
+        Removes the path from the paths of the descriptor. Returns True if no other path uses it
+        """
+        paths = self.paths.get( wd )
+
+        if paths is None:
+            return True
+
+        paths.discard( path )
+
+        if paths:
+            return False
+
+        del self.paths[ wd ]
+
+        self.wd_masks.pop( wd, None )
+
+        return True
+
+    def _union ( self, wd ):
+        mask = 0
+
+        for path in self.paths.get( wd, () ):
+            mask |= self.masks[ path ]
+
+        return mask
+
+    def add_watch ( self, path, mask = IN_ALL_EVENTS ):
+        # The mask is added to the one the descriptor may already have for other paths, so none of them misses events
+        wd = check( libc().inotify_add_watch( self.fd, os.fsencode( path ), mask | IN_MASK_ADD ), path )
+
+        # Watching a path again after it was replaced (without reading the events that said so) returns a new descriptor
+        previous = self.watches.get( path )
+
+        if previous is not None and previous != wd:
+            self._forget_path( path, previous )
+
+        self.watches[ path ] = wd
+        self.masks[ path ] = mask
+
+        self.paths.setdefault( wd, set() ).add( path )
+
+        # Bits that no path asks for anymore (the mask of this path was narrowed) are removed from the descriptor
+        union = self._union( wd )
+
+        if self.wd_masks.get( wd, union ) | mask != union:
+            check( libc().inotify_add_watch( self.fd, os.fsencode( path ), union ), path )
+
+        self.wd_masks[ wd ] = union
+
+        return wd
+
+    def remove_watch ( self, path, superficial = False ):
+        """
+        Stops watching the path. When superficial is True, the watch is only forgotten (used when the kernel already
+        removed it, for example because the folder was deleted)
+        """
+        wd = self.watches.pop( path, None )
+
+        self.masks.pop( path, None )
+
+        if wd is None:
+            return
+
+        if not self._forget_path( path, wd ):
+            # Other paths still use the descriptor, which keeps only the events they asked for
+            union = self._union( wd )
+
+            if not superficial and union != self.wd_masks.get( wd ):
+                other = next( iter( self.paths[ wd ] ) )
+
+                try:
+                    check( libc().inotify_add_watch( self.fd, os.fsencode( other ), union ), other )
+
+                    self.wd_masks[ wd ] = union
+                except OSError:
+                    # The folder is gone, and the kernel will remove the watch on its own
+                    pass
+
+            return
+
+        if not superficial:
+            try:
+                check( libc().inotify_rm_watch( self.fd, wd ), path )
+            except OSError as error:
+                # The kernel may have removed the watch already
+                if error.errno != errno.EINVAL:
+                    raise
+
+    def rename_watch ( self, path, target ):
+        """
+        Changes the path of a watch (after its folder was renamed, since the watch follows it)
+        """
+        wd = self.watches.pop( path, None )
+
+        if wd is None:
+            return
+
+        self.watches[ target ] = wd
+        self.masks[ target ] = self.masks.pop( path )
+
+        if wd in self.paths:
+            self.paths[ wd ].discard( path )
+            self.paths[ wd ].add( target )
+
+    def parse ( self, length ):
+        events = []
+
+        view = self.view
+
+        offset = 0
+
+        while offset < length:
+            ( wd, mask, cookie, size ) = HEADER.unpack_from( view, offset )
+
+            offset += HEADER.size
+
+            if size:
+                name = bytes( view[ offset:offset + size ] ).rstrip( b'\0' )
+
+                offset += size
+            else:
+                name = b''
+
+            if mask & IN_IGNORED:
+                # The kernel dropped this watch (the folder was removed, or the watch was removed by us)
+                for path in self.paths.pop( wd, () ):
+                    if self.watches.get( path ) == wd:
+                        del self.watches[ path ]
+                        del self.masks[ path ]
+
+                self.wd_masks.pop( wd, None )
+
+                continue
+
+            name = os.fsdecode( name )
+
+            paths = self.paths.get( wd )
+
+            if not paths:
+                events.append( ( mask, cookie, None, name ) )
+            else:
+                events.extend( ( mask, cookie, path, name ) for path in paths )
+
+        return events
+
+    def read_events ( self, timeout = None ):
+        """
+        Waits up to timeout seconds (forever if None) for events, and returns all the ones available (or an empty list)
+        """
+        if not self.poll.poll( None if timeout is None else max( int( timeout * 1000 ), 0 ) ):
+            return []
+
+        length = self.file.readinto( self.buffer )
+
+        # The file descriptor is non-blocking, so this happens if someone else read the events first
+        if not length:
+            return []
+
+        return self.parse( length )
+
+    async def aread_events ( self ):
+        """
+        Same as read_events, but waits for the events inside the running asyncio loop without blocking it
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            events = self.read_events( timeout = 0 )
+
+            if events:
+                return events
+
+            future = loop.create_future()
+
+            loop.add_reader( self.fd, lambda: future.done() or future.set_result( None ) )
+
+            try:
+                await future
+            finally:
+                loop.remove_reader( self.fd )
@@ -1,4 +1,10 @@
+import threading
+import traceback
+import queue
+import json
+import time
 import sys
+import os
 import re
 
 def styled ( txt, style ): return f"\033[{style}m{txt}\033[0m"
@@ -13,43 +19,266 @@ def fgGray ( txt ): return styled( txt, 90 )
 def eraseLastLine (): print( "\033[A\33[2K\r", end = '' )
 def stripAnsi ( txt ): return re.sub( r'\033+\[[0-9]+m', '', txt )
 
+# Lines the background writer can hold before the threads that log have to wait for it
+BUFFER_LINES = 10000
+
+# Size (in bytes) the log file can reach before it is rotated, and how many rotated files are kept
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+
+# Log files are written in UTF-8, and paths that are not valid UTF-8 keep their original bytes
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+
+class RotatingFile:
+    """
+    Log file that is renamed to path.1 (and the older ones to path.2, path.3, ...) once it grows past max_bytes. Rotation
+    is disabled when max_bytes is None
+    """
+    def __init__ ( self, path, max_bytes = MAX_BYTES, backups = BACKUPS ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open( path, 'a', encoding = ENCODING, errors = ERRORS )
+        self.size = self.file.tell()
+
+    def isatty ( self ):
+        return False
+
+    def rotate ( self ):
+        self.file.close()
+
+        # The file is opened again even if the renames fail, so the next writes still have somewhere to go
+        try:
+            if self.backups > 0:
+                for index in range( self.backups - 1, 0, -1 ):
+                    if os.path.exists( f'{self.path}.{index}' ):
+                        os.replace( f'{self.path}.{index}', f'{self.path}.{index + 1}' )
+
+                os.replace( self.path, f'{self.path}.1' )
+            else:
+                os.remove( self.path )
+        finally:
+            self.file = open( self.path, 'a', encoding = ENCODING, errors = ERRORS )
+            self.size = self.file.tell()
+
+    def write ( self, string ):
+        # The limit is in bytes, and paths can have characters that take more than one
+        size = len( string.encode( ENCODING, ERRORS ) )
+
+        if self.max_bytes is not None and self.size > 0 and self.size + size > self.max_bytes:
+            self.rotate()
+
+        self.file.write( string )
+
+        self.size += size
+
+    def flush ( self ):
+        self.file.flush()
+
+    def close ( self ):
+        self.file.close()
+
+class BackgroundFile:
+    """
+    Wraps a file so that the writes only queue the text, and a background thread writes (and flushes) everything queued
+    at once. The queue is bounded, so a slow disk makes the writers wait instead of using more and more memory
+    """
+    def __init__ ( self, file, buffer_lines = BUFFER_LINES ):
+        self.file = file
+        self.queue = queue.Queue( maxsize = buffer_lines )
+        self.thread = threading.Thread( target = self._run, daemon = True )
+        self.thread.start()
+
+    def isatty ( self ):
+        return False
+
+    def _run ( self ):
+        # Whether the last write failed, so that an error that keeps happening (a full disk) is only reported once
+        failing = False
+
+        while True:
+            strings = [ self.queue.get() ]
+
+            # Takes everything that is already waiting, to write it with a single call
+            while not self.queue.empty():
+                strings.append( self.queue.get_nowait() )
+
+            closing = strings[ -1 ] is None
+
+            # The thread keeps draining the queue when the file fails (those lines are lost), or the loggers would block
+            try:
+                self.file.write( ''.join( string for string in strings if string is not None ) )
+                self.file.flush()
+
+                failing = False
+            except Exception:
+                if not failing:
+                    traceback.print_exc()
+
+                failing = True
+
+            if closing:
+                return
+
+    def write ( self, string ):
+        self.queue.put( string )
+
+    def flush ( self ):
+        # The background thread flushes after each write
+        pass
+
+    def close ( self ):
+        """
+        Waits until everything queued is written, and closes the file
+        """
+        if self.thread.is_alive():
+            self.queue.put( None )
+
+            self.thread.join()
+
+        self.file.close()
+
+
 class Logger:
+    """
+    Writes what happens as lines of text. The colors are only used when writing to a terminal, and the codes for them are
+    not even built otherwise
+    """
     def __init__ ( self, file = sys.stderr ):
         self.file = file
+        self.color = self.isatty()
+
+    def paint ( self, style, txt ):
+        return style( txt ) if self.color else txt
 
     def color_action ( self, action ):
         if action == 'REMOVE':
-            return fgRed( action )
+            return self.paint( fgRed, action )
         elif action == 'CREATE':
-            return fgBlue( action )
+            return self.paint( fgBlue, action )
         elif action == 'UPDATE':
-            return fgGreen( action )
+            return self.paint( fgGreen, action )
+        elif action == 'MOVE':
+            return self.paint( fgMagenta, action )
         else: return action
 
     def color_type ( self, type ):
         if type == 'FOLDER':
-            return fgCyan( type )
+            return self.paint( fgCyan, type )
         elif type == 'FILE':
-            return fgGray( type )
+            return self.paint( fgGray, type )
         else: return type
 
     def isatty ( self ):
         return ( self.file == sys.stderr or self.file == sys.stdout ) and self.file.isatty()
 
     def write ( self, string ):
-        if not self.isatty():
-            string = stripAnsi( string )
-
         self.file.write( string )
 
     def flush ( self ):
         self.file.flush()
 
+    def close ( self ):
+        if self.file != sys.stderr and self.file != sys.stdout:
+            self.file.close()
+
     def watch ( self, pattern ):
-        self.write( f'{fgYellow( "WATCH" )} {pattern}\n' )
+        self.write( f'{self.paint( fgYellow, "WATCH" )} {pattern}\n' )
+
+    def scan ( self, pattern, folders, seconds ):
+        self.write( f'{self.paint( fgYellow, "SCAN" )} {pattern} {self.paint( fgGray, f"({folders} folders in {seconds:.3f}s)" )}\n' )
+
+    def fallback ( self, folder, watches ):
+        self.write( f'{self.paint( fgYellow, "POLLING" )} {folder} {self.paint( fgGray, f"(out of native watches, {watches} in use)" )}\n' )
 
-    def event ( self, action, type, filepath ):
+    def overflow ( self, subtrees ):
+        self.write( f'{self.paint( fgRed, "OVERFLOW" )} {self.paint( fgGray, f"(events were lost, rescanning {subtrees} folders)" )}\n' )
+
+    def resume ( self, folder, events ):
+        self.write( f'{self.paint( fgYellow, "RESUME" )} {folder} {self.paint( fgGray, f"({events} events missed while stopped)" )}\n' )
+
+    def reload ( self, path, added, removed, kept ):
+        self.write( f'{self.paint( fgYellow, "RELOAD" )} {path} {self.paint( fgGray, f"({added} rules added, {removed} removed, {kept} unchanged)" )}\n' )
+
+    def reload_failed ( self, path, error ):
+        self.write( f'{self.paint( fgRed, "RELOAD" )} {path} {self.paint( fgGray, f"(kept the previous rules: {error})" )}\n' )
+
+    def queue ( self, rule, patterns, depth, capacity, dropped, coalesced, blocked ):
+        """
+        Called when the actions of a rule did not fit in the queue (depth is how many actions are waiting right now)
+        """
+        self.write( f'{self.paint( fgRed, "QUEUE" )} {patterns} {self.paint( fgGray, f"({depth}/{capacity} waiting, {dropped} actions dropped, {coalesced} coalesced, {blocked} waited for room)" )}\n' )
+
+    def event ( self, action, type, filepath, source = None ):
         action = self.color_action( action.upper() )
         type = self.color_type( type.upper() )
+
+        if source is not None:
+            filepath = f'{source} -> {filepath}'
         
         self.write( f'{action} {type} {filepath}\n' )
+
+    def action ( self, rule, patterns, action, type, filepath, status, latency, duration, files = 1 ):
+        """
+        Called when the action of a rule finishes (latency is how long it took to start, or None if unknown). Only the
+        actions that failed are shown as text
+        """
+        if status == '0' or status == 'None':
+            return
+
+        target = filepath if files == 1 else f'{files} files'
+
+        self.write( f'{self.paint( fgRed, "FAILED" )} {patterns} {target} {self.paint( fgGray, f"(status {status} after {duration:.3f}s)" )}\n' )
+
+class JsonLogger(Logger):
+    """
+    Writes each record as a line with a JSON object, with at least the keys time (seconds since the epoch) and kind
+    """
+    def __init__ ( self, file = sys.stderr ):
+        self.file = file
+        self.color = False
+
+    def record ( self, kind, **fields ):
+        self.write( json.dumps( dict( time = time.time(), kind = kind, **fields ) ) + '\n' )
+
+    def watch ( self, pattern ):
+        self.record( 'watch', pattern = pattern )
+
+    def scan ( self, pattern, folders, seconds ):
+        self.record( 'scan', pattern = pattern, folders = folders, duration = seconds )
+
+    def fallback ( self, folder, watches ):
+        self.record( 'fallback', folder = folder, watches = watches )
+
+    def overflow ( self, subtrees ):
+        self.record( 'overflow', subtrees = subtrees )
+
+    def resume ( self, folder, events ):
+        self.record( 'resume', folder = folder, events = events )
+
+    def reload ( self, path, added, removed, kept ):
+        self.record( 'reload', path = path, added = added, removed = removed, kept = kept )
+
+    def reload_failed ( self, path, error ):
+        self.record( 'reload_failed', path = path, error = str( error ) )
+
+    def queue ( self, rule, patterns, depth, capacity, dropped, coalesced, blocked ):
+        self.record( 'queue', rule = rule, patterns = patterns, depth = depth, capacity = capacity, dropped = dropped, coalesced = coalesced, blocked = blocked )
+
+    def event ( self, action, type, filepath, source = None ):
+        if source is None:
+            self.record( 'event', action = action, type = type, path = filepath )
+        else:
+            self.record( 'event', action = action, type = type, path = filepath, old_path = source )
+
+    def action ( self, rule, patterns, action, type, filepath, status, latency, duration, files = 1 ):
+        self.record( 
+            'action', 
+            rule = rule, patterns = patterns, 
+            action = action, type = type, path = filepath, files = files, 
+            status = status, latency = latency, duration = duration 
+        )
+
+# Loggers for each value of the --log-format option
+FORMATS = { 'text': Logger, 'json': JsonLogger }
@@ -0,0 +1,270 @@
+import threading
+import functools
+import bisect
+import json
+import math
+import time
+import os
+
+# Upper bounds (in seconds) of the buckets used by default for histograms
+DURATION_BUCKETS = ( 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 )
+# Matching a path takes microseconds, so it needs much smaller buckets
+MATCH_BUCKETS = ( 0.000001, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01 )
+
+# How often (in seconds) the stats file is written by default
+STATS_INTERVAL = 10
+
+PREFIX = 'inoti_make_'
+
+class Histogram:
+    def __init__ ( self, buckets ):
+        self.buckets = buckets
+        # Observations in each bucket (the last one is for values bigger than every bucket)
+        self.counts = [ 0 ] * ( len( buckets ) + 1 )
+        self.sum = 0
+        self.count = 0
+
+    def observe ( self, value ):
+        self.counts[ bisect.bisect_left( self.buckets, value ) ] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge ( self, other ):
+        self.counts = [ mine + theirs for mine, theirs in zip( self.counts, other.counts ) ]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative ( self ):
+        """
+        Yields the pairs ( upper bound, observations up to it ), as Prometheus expects
+        """
+        total = 0
+
+        for bound, count in zip( self.buckets + ( math.inf, ), self.counts ):
+            total += count
+
+            yield ( bound, total )
+
+def escape_label ( value ):
+    return str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+def format_labels ( names, values, extra = () ):
+    pairs = list( zip( names, values ) ) + list( extra )
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join( f'{name}="{escape_label( value )}"' for name, value in pairs ) + '}'
+
+def format_value ( value ):
+    if value == math.inf:
+        return '+Inf'
+
+    return repr( float( value ) ) if isinstance( value, float ) else str( value )
+
+class Metrics:
+    """
+    Counters, histograms and gauges, each identified by a name and a list of label values (for example the folder or
+    the rule). Values can be recorded from any thread, and the whole set can be written as a Prometheus text file or as JSON
+    """
+    def __init__ ( self ):
+        self.lock = threading.Lock()
+
+        # Dictionaries matching a name to ( help, label names, dictionary of label values to value )
+        self.counters = dict()
+        self.histograms = dict()
+        # Dictionary matching a name to ( help, label names, function ). The function returns the current value, or a
+        # dictionary matching label values to values
+        self.gauges = dict()
+
+        self.buckets = dict()
+
+        # Dictionary matching the name of a gauge added by merge to the last values of each source
+        self.sources = dict()
+
+    def counter ( self, name, help, labels = () ):
+        self.counters.setdefault( name, ( help, tuple( labels ), dict() ) )
+
+    def histogram ( self, name, help, labels = (), buckets = DURATION_BUCKETS ):
+        self.histograms.setdefault( name, ( help, tuple( labels ), dict() ) )
+
+        self.buckets[ name ] = tuple( buckets )
+
+    def gauge ( self, name, help, function, labels = () ):
+        self.gauges[ name ] = ( help, tuple( labels ), function )
+
+    def inc ( self, name, labels = (), value = 1 ):
+        values = self.counters[ name ][ 2 ]
+
+        with self.lock:
+            values[ labels ] = values.get( labels, 0 ) + value
+
+    def observe ( self, name, labels, value ):
+        values = self.histograms[ name ][ 2 ]
+
+        with self.lock:
+            histogram = values.get( labels )
+
+            if histogram is None:
+                histogram = values[ labels ] = Histogram( self.buckets[ name ] )
+
+            histogram.observe( value )
+
+    def _gauge_values ( self, function ):
+        value = function()
+
+        return value if isinstance( value, dict ) else { (): value }
+
+    def _sum_sources ( self, name ):
+        total = dict()
+
+        for values in list( self.sources[ name ].values() ):
+            for key, value in values.items():
+                total[ key ] = total.get( key, 0 ) + value
+
+        return total
+
+    def take ( self ):
+        """
+        Returns the counters and histograms recorded since the last call (which start again from zero) and the current
+        values of the gauges, in a form that can be pickled and given to merge
+        """
+        with self.lock:
+            counters = dict( ( name, ( help, labels, dict( values ) ) ) for name, ( help, labels, values ) in self.counters.items() )
+            histograms = dict( ( name, ( help, labels, self.buckets[ name ], dict( values ) ) ) for name, ( help, labels, values ) in self.histograms.items() )
+
+            for ( help, labels, values ) in [ *self.counters.values(), *self.histograms.values() ]:
+                values.clear()
+
+        gauges = dict( ( name, ( help, labels, self._gauge_values( function ) ) ) for name, ( help, labels, function ) in self.gauges.items() )
+
+        return ( counters, histograms, gauges )
+
+    def merge ( self, taken, source = None ):
+        """
+        Adds the metrics taken from another Metrics (usually of another process). Gauges report the sum of the last values
+        of every source
+        """
+        ( counters, histograms, gauges ) = taken
+
+        for name, ( help, labels, values ) in counters.items():
+            self.counter( name, help, labels )
+
+            for key, value in values.items():
+                self.inc( name, key, value )
+
+        for name, ( help, labels, buckets, values ) in histograms.items():
+            self.histogram( name, help, labels, buckets )
+
+            with self.lock:
+                mine = self.histograms[ name ][ 2 ]
+
+                for key, histogram in values.items():
+                    if key not in mine:
+                        mine[ key ] = Histogram( buckets )
+
+                    mine[ key ].merge( histogram )
+
+        for name, ( help, labels, values ) in gauges.items():
+            if name not in self.sources:
+                self.sources[ name ] = dict()
+
+                self.gauge( name, help, functools.partial( self._sum_sources, name ), labels )
+
+            self.sources[ name ][ source ] = values
+
+    def prometheus ( self ):
+        lines = []
+
+        with self.lock:
+            for name, ( help, labels, values ) in self.counters.items():
+                lines.append( f'# HELP {PREFIX}{name} {help}' )
+                lines.append( f'# TYPE {PREFIX}{name} counter' )
+
+                for key, value in values.items():
+                    lines.append( f'{PREFIX}{name}{format_labels( labels, key )} {format_value( value )}' )
+
+            for name, ( help, labels, values ) in self.histograms.items():
+                lines.append( f'# HELP {PREFIX}{name} {help}' )
+                lines.append( f'# TYPE {PREFIX}{name} histogram' )
+
+                for key, histogram in values.items():
+                    for bound, count in histogram.cumulative():
+                        lines.append( f'{PREFIX}{name}_bucket{format_labels( labels, key, [ ( "le", format_value( bound ) ) ] )} {count}' )
+
+                    lines.append( f'{PREFIX}{name}_sum{format_labels( labels, key )} {format_value( histogram.sum )}' )
+                    lines.append( f'{PREFIX}{name}_count{format_labels( labels, key )} {histogram.count}' )
+
+        for name, ( help, labels, function ) in self.gauges.items():
+            lines.append( f'# HELP {PREFIX}{name} {help}' )
+            lines.append( f'# TYPE {PREFIX}{name} gauge' )
+
+            for key, value in self._gauge_values( function ).items():
+                lines.append( f'{PREFIX}{name}{format_labels( labels, key )} {format_value( value )}' )
+
+        return '\n'.join( lines ) + '\n'
+
+    def json ( self ):
+        metrics = dict()
+
+        def samples ( labels, values, convert ):
+            return [ dict( labels = dict( zip( labels, key ) ), **convert( value ) ) for key, value in values.items() ]
+
+        with self.lock:
+            for name, ( help, labels, values ) in self.counters.items():
+                metrics[ name ] = dict( type = 'counter', help = help, samples = samples( labels, values, lambda value: dict( value = value ) ) )
+
+            for name, ( help, labels, values ) in self.histograms.items():
+                metrics[ name ] = dict( type = 'histogram', help = help, samples = samples( labels, values, lambda histogram: dict(
+                    count = histogram.count,
+                    sum = histogram.sum,
+                    buckets = dict( ( format_value( bound ), count ) for bound, count in histogram.cumulative() )
+                ) ) )
+
+        for name, ( help, labels, function ) in self.gauges.items():
+            metrics[ name ] = dict( type = 'gauge', help = help, samples = samples( labels, self._gauge_values( function ), lambda value: dict( value = value ) ) )
+
+        return json.dumps( dict( time = time.time(), metrics = metrics ), indent = 2 ) + '\n'
+
+    def write ( self, path ):
+        """
+        Writes the metrics to the file (as JSON if its extension is .json, in the Prometheus text format otherwise). The
+        file is replaced at once, so readers never see it half written
+        """
+        content = self.json() if path.endswith( '.json' ) else self.prometheus()
+
+        temporary = f'{path}.{os.getpid()}.tmp'
+
+        with open( temporary, 'w' ) as file:
+            file.write( content )
+
+        os.replace( temporary, path )
+
+class Reporter:
+    """
+    Writes the metrics to a file every interval seconds (and one last time when stopped), on a background thread
+    """
+    def __init__ ( self, metrics, path, interval = STATS_INTERVAL ):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _run ( self ):
+        while not self.stopping.wait( self.interval ):
+            self.metrics.write( self.path )
+
+    def start ( self ):
+        self.thread = threading.Thread( target = self._run, daemon = True )
+        self.thread.start()
+
+        return self
+
+    def stop ( self ):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        self.metrics.write( self.path )
@@ -1,9 +1,13 @@
+import hashlib
 import re
 import os
 
 MODE_CONDITION = 0
 MODE_ACTION = 1
 
+# Condition tags that select the type of event (as opposed to the type of path, like file or folder)
+EVENT_TAGS = ( 'create', 'update', 'remove', 'move' )
+
 def is_indented ( line ):
     return line.startswith( '\t' ) or line.startswith( '    ' )
 
@@ -20,10 +24,20 @@ def parse_inotifile_watcher ( line ):
         if match:
             line = line[ len( match[ 0 ] ): ]
 
-            conditions = re.split( r'\s+', match[ 1 ].strip() )
+            tags = re.split( r'\s+', match[ 1 ].strip() )
+
+            # Tags in the form key=value are options for this watcher (like [debounce=200ms]), not conditions
+            conditions = [ tag for tag in tags if tag and '=' not in tag ]
+
+            for tag in tags:
+                if '=' in tag:
+                    key, value = tag.split( '=', 1 )
+
+                    watcher.options[ key ] = value
 
             # Adds multiple conditions
-            watcher.conditions.append( conditions )
+            if conditions:
+                watcher.conditions.append( conditions )
         else:
             break
 
@@ -37,9 +51,11 @@ def parse_inotifile_watcher ( line ):
 
         line = line[ :-len( match[ 0 ] ) ]
 
-    patterns = re.split( r'\s+', line.strip() )
+    patterns = [ pattern for pattern in re.split( r'\s+', line.strip() ) if pattern ]
 
-    watcher.patterns.extend( patterns )
+    # Patterns starting with an exclamation mark (like !**/node_modules) exclude the paths they match
+    watcher.patterns.extend( pattern for pattern in patterns if not pattern.startswith( '!' ) )
+    watcher.exclude.extend( pattern[ 1: ] for pattern in patterns if pattern.startswith( '!' ) and pattern[ 1: ] )
     
     return watcher
 
@@ -48,12 +64,18 @@ def parse_inotifile ( content ):
     Our parsing strategy is to consider two types of lines: unindented lines represent condition (the patter of files, the executor, etc...)
     Indented lines are added as actions to the last condition registered (if none is found, an exception is thrown)
     Lines starting with the hastag character (#) are treated as comments
+    Condition lines with only options and no patterns (like [debounce=200ms]) set the default options for every watcher,
+    and the exclusion patterns of lines without other patterns (like !**/.git) are added to every watcher
     """
 
     mode = MODE_CONDITION
 
     watchers = []
 
+    defaults = dict()
+
+    exclude = []
+
     watcher = None
 
     for line in content.split( '\n' ):
@@ -74,12 +96,84 @@ def parse_inotifile ( content ):
         if mode == MODE_CONDITION:
             watcher = parse_inotifile_watcher( line )
 
-            watchers.append( watcher )
+            if not watcher.patterns and not watcher.executor and ( watcher.options or watcher.exclude ):
+                defaults.update( watcher.options )
+
+                exclude.extend( watcher.exclude )
+
+                # Global options cannot have actions, so any indented line after them will throw an exception
+                watcher = None
+            else:
+                watchers.append( watcher )
 
             mode = MODE_ACTION
+
+    for watcher in watchers:
+        for key, value in defaults.items():
+            watcher.options.setdefault( key, value )
+
+        watcher.exclude.extend( pattern for pattern in exclude if pattern not in watcher.exclude )
             
     return watchers
 
+def parse_flag ( value ):
+    """
+    Converts an option like [persistent=yes] to a boolean. Missing options are false
+    """
+    if value is None:
+        return False
+
+    if isinstance( value, bool ):
+        return value
+
+    return value.strip().lower() in ( '1', 'true', 'yes', 'on' )
+
+def parse_duration ( value ):
+    """
+    Converts a duration written in the Inotifile (like 200ms, 1.5s or 2m) to seconds. Values without unit are seconds
+
+    >>> parse_duration( '200ms' )
+    0.2
+    >>> parse_duration( '2m' )
+    120.0
+    """
+    if value is None:
+        return None
+
+    if isinstance( value, ( int, float ) ):
+        return float( value )
+
+    match = re.match( r'^\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|h)?\s*$', value )
+
+    if not match:
+        raise Exception( f'Invalid duration "{ value }".' )
+
+    multipliers = { 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600 }
+
+    return float( match[ 1 ] ) * multipliers[ match[ 2 ] or 's' ]
+
+def parse_size ( value ):
+    """
+    Converts a size (like 512K, 10M or 1G) to bytes. Values without unit are bytes
+
+    >>> parse_size( '10M' )
+    10485760
+    """
+    if value is None:
+        return None
+
+    if isinstance( value, int ):
+        return value
+
+    match = re.match( r'^\s*([0-9]+)\s*([kmg])?b?\s*$', value, re.IGNORECASE )
+
+    if not match:
+        raise Exception( f'Invalid size "{ value }".' )
+
+    multipliers = { 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+
+    return int( match[ 1 ] ) * multipliers.get( ( match[ 2 ] or '' ).lower(), 1 )
+
 def glob_root_folder ( pattern ):
     folders = pattern.split( os.sep )
 
@@ -97,13 +191,55 @@ class Watcher:
     def __init__ ( self ):
         self.conditions = []
         self.patterns = []
+        # Globs whose paths (and everything inside them) are never matched by the patterns
+        self.exclude = []
         self.executor = None
         self.actions = []
+        self.options = dict()
 
     def folders ( self ):
         for pattern in self.patterns:
             yield glob_root_folder( pattern )
 
+    def option ( self, name, default = None ):
+        return self.options.get( name, default )
+
+    def events ( self ):
+        """
+        Returns the names of the events that can pass the conditions of this watcher (every one of them when the
+        conditions do not mention any)
+        """
+        events = set( EVENT_TAGS )
+
+        for condition in self.conditions:
+            tags = [ tag for tag in condition if tag in EVENT_TAGS ]
+
+            # A condition without event tags is about the type of path, so any event can pass it
+            if len( tags ) == len( condition ):
+                events &= set( tags )
+
+        return [ tag for tag in EVENT_TAGS if tag in events ]
+
+    def signature ( self ):
+        """
+        Returns a tuple that is equal for two watchers only if they were written the same way, so that the watchers that
+        did not change when the Inotifile is parsed again can be found
+        """
+        return ( 
+            tuple( tuple( condition ) for condition in self.conditions ), 
+            tuple( self.patterns ), 
+            tuple( self.exclude ), 
+            self.executor, 
+            tuple( self.actions ), 
+            tuple( sorted( self.options.items() ) ) 
+        )
+
+    def fingerprint ( self ):
+        """
+        Returns a short digest of the signature, which is the same in every run
+        """
+        return hashlib.blake2b( repr( self.signature() ).encode( 'utf-8' ), digest_size = 8 ).hexdigest()
+
     def test ( self, filename, tags ):
         # Each condition must have at least one matching tag
         for condition in self.conditions:
@@ -114,7 +250,7 @@ class Watcher:
         return True
 
     def __repr__ ( self ):
-        return "<Watcher \n\tconditions: %s \n\tpatterns: %s \n\texecutor: %s \n\tactions: %s>" % ( self.conditions, self.patterns, self.executor, self.actions )
+        return "<Watcher \n\tconditions: %s \n\tpatterns: %s \n\texclude: %s \n\texecutor: %s \n\toptions: %s \n\tactions: %s>" % ( self.conditions, self.patterns, self.exclude, self.executor, self.options, self.actions )
 
 def file ( name ):
     with open( name ) as f:
@@ -0,0 +1,272 @@
+from . import Inotify
+import itertools
+import asyncio
+import array
+import heapq
+import errno
+import time
+import os
+
+# Seconds between polls of a folder that just started being watched
+POLL_INTERVAL = 1
+# Folders that change often are polled sooner (up to MIN_INTERVAL), and folders that do not change are polled less and
+# less often (down to MAX_INTERVAL)
+MIN_INTERVAL = 0.25
+MAX_INTERVAL = 10
+
+class Folder:
+    """
+    Snapshot of the entries of a polled folder. Entries are kept sorted by name, with their kind, modification time and
+    size in arrays, so that big folders take little memory and two snapshots can be compared with a single merge
+    """
+    __slots__ = ( 'path', 'mask', 'wd', 'names', 'kinds', 'mtimes', 'sizes', 'interval', 'deadline' )
+
+    def __init__ ( self, path, mask, wd, interval ):
+        self.path = path
+        self.mask = mask
+        self.wd = wd
+        self.names = []
+        self.kinds = array.array( 'b' )
+        self.mtimes = array.array( 'q' )
+        self.sizes = array.array( 'q' )
+        self.interval = interval
+        self.deadline = None
+
+def scan ( path ):
+    """
+    Returns the sorted lists ( names, kinds, mtimes, sizes ) of the entries of the folder. When the path is a file, its
+    only entry is the file itself (with an empty name)
+    """
+    entries = []
+
+    try:
+        with os.scandir( path ) as iterator:
+            for entry in iterator:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed in the meantime
+                    continue
+
+                entries.append( ( entry.name, 1 if entry.is_dir() else 0, stat.st_mtime_ns, stat.st_size ) )
+    except NotADirectoryError:
+        stat = os.stat( path )
+
+        entries.append( ( '', 0, stat.st_mtime_ns, stat.st_size ) )
+
+    entries.sort()
+
+    return (
+        [ entry[ 0 ] for entry in entries ],
+        array.array( 'b', ( entry[ 1 ] for entry in entries ) ),
+        array.array( 'q', ( entry[ 2 ] for entry in entries ) ),
+        array.array( 'q', ( entry[ 3 ] for entry in entries ) )
+    )
+
+class Poller:
+    """
+    Backend with the same interface as Inotify.Inotify, that finds the changes by listing the watched folders from time to
+    time and comparing them with their last snapshot. It needs no kernel resources, so it works for trees of any size (and
+    for file systems without inotify support), at the cost of reporting the changes later.
+    Only the folders whose poll is due are listed each time, and each folder has its own interval, which shrinks when the
+    folder changes and grows while it does not
+    """
+    def __init__ ( self, interval = POLL_INTERVAL, min_interval = MIN_INTERVAL, max_interval = MAX_INTERVAL ):
+        self.interval = interval
+        self.min_interval = min( min_interval, interval )
+        self.max_interval = max( max_interval, interval )
+
+        # Dictionary matching a path to its Folder
+        self.watches = dict()
+        # Heap of ( deadline, sequence, path ). Entries whose deadline no longer matches the folder's are stale and ignored
+        self.deadlines = []
+
+        self.sequence = itertools.count()
+        self.counter = itertools.count( 1 )
+
+    def close ( self ):
+        self.watches.clear()
+        self.deadlines.clear()
+
+    def _schedule ( self, folder, now ):
+        folder.deadline = now + folder.interval
+
+        heapq.heappush( self.deadlines, ( folder.deadline, next( self.sequence ), folder.path ) )
+
+    def add_watch ( self, path, mask = Inotify.IN_ALL_EVENTS ):
+        folder = self.watches.get( path )
+
+        # Like inotify, watching a path again only replaces its mask
+        if folder is not None:
+            folder.mask = mask
+
+            return folder.wd
+
+        folder = Folder( path, mask, next( self.counter ), self.interval )
+
+        try:
+            ( folder.names, folder.kinds, folder.mtimes, folder.sizes ) = scan( path )
+        except FileNotFoundError:
+            raise OSError( errno.ENOENT, os.strerror( errno.ENOENT ), path )
+
+        self.watches[ path ] = folder
+
+        self._schedule( folder, time.monotonic() )
+
+        return folder.wd
+
+    def remove_watch ( self, path, superficial = False ):
+        self.watches.pop( path, None )
+
+    def rename_watch ( self, path, target ):
+        folder = self.watches.pop( path, None )
+
+        if folder is None:
+            return
+
+        folder.path = target
+
+        self.watches[ target ] = folder
+
+        # The entry of the old path in the heap is now stale
+        heapq.heappush( self.deadlines, ( folder.deadline, next( self.sequence ), target ) )
+
+    def timeout ( self, now = None ):
+        """
+        Returns how many seconds until the next folder must be polled, or None if nothing is being watched
+        """
+        now = time.monotonic() if now is None else now
+
+        while self.deadlines:
+            ( deadline, _, path ) = self.deadlines[ 0 ]
+
+            folder = self.watches.get( path )
+
+            if folder is not None and folder.deadline == deadline:
+                return max( deadline - now, 0 )
+
+            heapq.heappop( self.deadlines )
+
+        return None
+
+    def _diff ( self, folder, names, kinds, mtimes, sizes ):
+        """
+        Yields the pairs ( mask, name ) describing what changed between the snapshot of the folder and the new one
+        """
+        i = j = 0
+
+        while i < len( folder.names ) or j < len( names ):
+            if j >= len( names ) or ( i < len( folder.names ) and folder.names[ i ] < names[ j ] ):
+                yield ( Inotify.IN_DELETE | ( Inotify.IN_ISDIR if folder.kinds[ i ] else 0 ), folder.names[ i ] )
+
+                i += 1
+            elif i >= len( folder.names ) or names[ j ] < folder.names[ i ]:
+                yield ( Inotify.IN_CREATE | ( Inotify.IN_ISDIR if kinds[ j ] else 0 ), names[ j ] )
+
+                j += 1
+            else:
+                if folder.kinds[ i ] != kinds[ j ]:
+                    yield ( Inotify.IN_DELETE | ( Inotify.IN_ISDIR if folder.kinds[ i ] else 0 ), names[ j ] )
+                    yield ( Inotify.IN_CREATE | ( Inotify.IN_ISDIR if kinds[ j ] else 0 ), names[ j ] )
+                elif not kinds[ j ] and ( folder.mtimes[ i ] != mtimes[ j ] or folder.sizes[ i ] != sizes[ j ] ):
+                    # There is no way to know if the file is still open, so both kinds of update are reported
+                    yield ( Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE, names[ j ] )
+
+                i += 1
+                j += 1
+
+    def _vanish ( self, folder ):
+        """
+        Returns the events for a folder that is gone, in the same order inotify reports a folder deleted with its contents:
+        the watched subfolders first, then the entries, and then the folder itself. The watches are dropped
+        """
+        events = []
+
+        del self.watches[ folder.path ]
+
+        for name, kind in zip( folder.names, folder.kinds ):
+            child = self.watches.get( os.path.join( folder.path, name ) ) if kind else None
+
+            if child is not None:
+                events.extend( self._vanish( child ) )
+
+            if name and folder.mask & Inotify.IN_DELETE:
+                events.append( ( Inotify.IN_DELETE | ( Inotify.IN_ISDIR if kind else 0 ), 0, folder.path, name ) )
+
+        if folder.mask & Inotify.IN_DELETE_SELF:
+            events.append( ( Inotify.IN_DELETE_SELF, 0, folder.path, '' ) )
+
+        return events
+
+    def _poll ( self, folder, now ):
+        events = []
+
+        try:
+            snapshot = scan( folder.path )
+        except OSError:
+            return self._vanish( folder )
+
+        for ( mask, name ) in self._diff( folder, *snapshot ):
+            # Watched subfolders that were removed are reported right away, before their removal from this folder
+            if mask & Inotify.IN_DELETE and mask & Inotify.IN_ISDIR and os.path.join( folder.path, name ) in self.watches:
+                events.extend( self._vanish( self.watches[ os.path.join( folder.path, name ) ] ) )
+
+            if mask & folder.mask:
+                events.append( ( mask, 0, folder.path, name ) )
+
+        ( folder.names, folder.kinds, folder.mtimes, folder.sizes ) = snapshot
+
+        if events:
+            folder.interval = max( folder.interval / 2, self.min_interval )
+        else:
+            folder.interval = min( folder.interval * 1.5, self.max_interval )
+
+        self._schedule( folder, now )
+
+        return events
+
+    def poll ( self, now = None ):
+        """
+        Polls every folder that is due, and returns the events found in the same format as Inotify.read_events
+        """
+        now = time.monotonic() if now is None else now
+
+        events = []
+
+        while self.deadlines and self.deadlines[ 0 ][ 0 ] <= now:
+            ( deadline, _, path ) = heapq.heappop( self.deadlines )
+
+            folder = self.watches.get( path )
+
+            if folder is not None and folder.deadline == deadline:
+                events.extend( self._poll( folder, now ) )
+
+        return events
+
+    def _delay ( self, timeout ):
+        delay = self.timeout()
+
+        if delay is None:
+            return self.max_interval if timeout is None else timeout
+
+        return delay if timeout is None else min( delay, timeout )
+
+    def read_events ( self, timeout = None ):
+        """
+        Waits until the next folder is due (or up to timeout seconds) and returns the events found
+        """
+        delay = self._delay( timeout )
+
+        if delay > 0:
+            time.sleep( delay )
+
+        return self.poll()
+
+    async def aread_events ( self ):
+        while True:
+            await asyncio.sleep( self._delay( None ) )
+
+            events = self.poll()
+
+            if events:
+                return events
@@ -0,0 +1,349 @@
+from . import BetterInotify
+from collections import Counter
+import asyncio
+import struct
+import time
+import os
+
+# Recordings start with these bytes, and are made of records that each start with their tag (an unsigned byte)
+MAGIC = b'INOTIREC\x01'
+
+# Each run appends a new session: ( tag, seconds since the epoch )
+TAG_START = 0
+# An id returned by add_watch and its glob: ( tag, id, length ) followed by the glob
+TAG_WATCH = 1
+# A path seen for the first time in the session, which gets the next index: ( tag, length ) followed by the path
+TAG_PATH = 2
+# An event: ( tag, seconds since the session started, id, action, type, index of the path )
+TAG_EVENT = 3
+# A move, with the index of the old path at the end
+TAG_MOVE = 4
+# The end of a batch of events (a None yielded by listen): ( tag, seconds since the session started )
+TAG_BATCH = 5
+
+TAG = struct.Struct( '<B' )
+
+RECORDS = {
+    TAG_START: struct.Struct( '<d' ),
+    TAG_WATCH: struct.Struct( '<IH' ),
+    TAG_PATH: struct.Struct( '<H' ),
+    TAG_EVENT: struct.Struct( '<dIBBI' ),
+    TAG_MOVE: struct.Struct( '<dIBBII' ),
+    TAG_BATCH: struct.Struct( '<d' )
+}
+
+# What the steps of Replay mean: sleep for some seconds, or yield the event (or None)
+STEP_SLEEP = 0
+STEP_EMIT = 1
+
+class Recorder:
+    """
+    Appends the events handled by the Inotifile to a recording. Paths are written once per session and the events only
+    refer to their index, so each event takes a few bytes besides the paths
+    """
+    def __init__ ( self, path ):
+        self.file = open( path, 'ab' )
+
+        if self.file.tell() == 0:
+            self.file.write( MAGIC )
+        else:
+            check( path )
+
+        # Dictionary matching each path written in this session to its index
+        self.paths = dict()
+
+        self.start = time.monotonic()
+
+        # True when events were written after the end of the last batch
+        self.pending = False
+
+        self.write( TAG_START, time.time() )
+
+    def write ( self, tag, *fields, data = b'' ):
+        self.file.write( TAG.pack( tag ) + RECORDS[ tag ].pack( *fields ) + data )
+
+    def watch ( self, id, glob ):
+        data = os.fsencode( glob )
+
+        self.write( TAG_WATCH, id, len( data ), data = data )
+
+    def intern ( self, path ):
+        index = self.paths.get( path )
+
+        if index is None:
+            index = self.paths[ path ] = len( self.paths )
+
+            data = os.fsencode( path )
+
+            self.write( TAG_PATH, len( data ), data = data )
+
+        return index
+
+    def record ( self, event ):
+        """
+        Writes an event from BetterInotify.listen. The Nones that end a batch are only written after some event, and the
+        file is flushed with them, so a crash loses at most the batch being handled
+        """
+        moment = time.monotonic() - self.start
+
+        if event is None:
+            if self.pending:
+                self.write( TAG_BATCH, moment )
+
+                self.file.flush()
+
+                self.pending = False
+
+            return
+
+        ( id, action, type, filepath ) = event[ :4 ]
+
+        if len( event ) > 4:
+            self.write( TAG_MOVE, moment, id, action, type, self.intern( filepath ), self.intern( event[ 4 ] ) )
+        else:
+            self.write( TAG_EVENT, moment, id, action, type, self.intern( filepath ) )
+
+        self.pending = True
+
+    def close ( self ):
+        self.record( None )
+
+        self.file.close()
+
+def check ( path ):
+    with open( path, 'rb' ) as file:
+        if file.read( len( MAGIC ) ) != MAGIC:
+            raise Exception( f'{ path } is not a recording of inoti-make.' )
+
+def read ( path ):
+    """
+    Yields the records of a recording as tuples ( tag, seconds since the session started, value ), where the value is
+    the tuple ( id, glob ) for TAG_WATCH and the event (with the paths and the recorded id) for TAG_EVENT and TAG_MOVE.
+    Paths are only used to resolve the events, so TAG_PATH is never yielded. A record cut short (by a crash while
+    recording) ends the recording
+    """
+    check( path )
+
+    with open( path, 'rb' ) as file:
+        file.seek( len( MAGIC ) )
+
+        paths = []
+
+        while True:
+            tag = file.read( TAG.size )
+
+            if not tag:
+                return
+
+            ( tag, ) = TAG.unpack( tag )
+
+            record = RECORDS.get( tag )
+
+            if record is None:
+                raise Exception( f'Unknown record { tag } in the recording { path }.' )
+
+            data = file.read( record.size )
+
+            if len( data ) < record.size:
+                return
+
+            fields = record.unpack( data )
+
+            if tag == TAG_START:
+                paths = []
+
+                yield ( tag, 0, None )
+            elif tag == TAG_WATCH:
+                ( id, length ) = fields
+
+                glob = file.read( length )
+
+                if len( glob ) < length:
+                    return
+
+                yield ( tag, None, ( id, os.fsdecode( glob ) ) )
+            elif tag == TAG_PATH:
+                filepath = file.read( fields[ 0 ] )
+
+                if len( filepath ) < fields[ 0 ]:
+                    return
+
+                paths.append( os.fsdecode( filepath ) )
+            elif tag == TAG_EVENT:
+                ( moment, id, action, type, index ) = fields
+
+                yield ( tag, moment, ( id, action, type, paths[ index ] ) )
+            elif tag == TAG_MOVE:
+                ( moment, id, action, type, index, old ) = fields
+
+                yield ( tag, moment, ( id, action, type, paths[ index ], paths[ old ] ) )
+            else:
+                yield ( tag, fields[ 0 ], None )
+
+class Replay:
+    """
+    Same interface as BetterInotify (for the Inotifile), but the events come from a recording instead of the file system.
+    The recorded ids are matched to the ids of add_watch by their glob (in order, when the same glob was added more than
+    once), so the Inotifile that replays must watch the same patterns. The events are yielded at the speed they were
+    recorded, multiplied by speed (or as fast as possible when speed is 0). The sessions of the recording are played one
+    after the other, and listen ends once the last one is over and nothing else is pending
+    """
+    def __init__ ( self, path, logger = None, speed = 1, block_duration = 1 ):
+        check( path )
+
+        self.path = path
+        self.logger = logger
+        self.speed = speed
+        self.block_duration = block_duration
+
+        # Dictionary matching a glob to the ids returned by add_watch for it
+        self.globs = dict()
+        self.removed = set()
+        # Ids whose events are not logged
+        self.quiet = set()
+
+        self.counter = 0
+
+        self.received = None
+
+    def add_watch ( self, glob, events = None, close_write = False, exclude = (), quiet = False ):
+        id = self.counter
+
+        self.counter += 1
+
+        if quiet:
+            self.quiet.add( id )
+
+        self.globs.setdefault( glob, [] ).append( id )
+
+        if self.logger:
+            self.logger.watch( glob )
+
+        return id
+
+    def remove_watch ( self, id ):
+        self.removed.add( id )
+
+    def load_state ( self, directory ):
+        return []
+
+    def save_state ( self, directory ):
+        pass
+
+    def close ( self ):
+        pass
+
+    def _timeout ( self, timeout ):
+        if callable( timeout ):
+            return timeout()
+
+        return self.block_duration if timeout is None else timeout
+
+    def _records ( self ):
+        """
+        Yields the pairs ( seconds since the recording started, event or None ) with the ids of this run
+        """
+        # Dictionary matching the recorded ids of the session to the ids of this run
+        ids = dict()
+        # How many recorded ids of each glob were matched in this session
+        used = Counter()
+
+        # Where each session starts, since the time of each one starts from zero
+        offset = 0
+        last = 0
+
+        for ( tag, moment, value ) in read( self.path ):
+            if tag == TAG_START:
+                ids = dict()
+                used = Counter()
+
+                offset += last
+                last = 0
+            elif tag == TAG_WATCH:
+                ( id, glob ) = value
+
+                matches = self.globs.get( glob, [] )
+
+                if used[ glob ] < len( matches ):
+                    ids[ id ] = matches[ used[ glob ] ]
+
+                used[ glob ] += 1
+            else:
+                last = moment
+
+                if value is None:
+                    yield ( offset + moment, None )
+
+                    continue
+
+                id = ids.get( value[ 0 ] )
+
+                # Events of patterns this Inotifile does not watch
+                if id is None or id in self.removed:
+                    continue
+
+                yield ( offset + moment, ( id, *value[ 1: ] ) )
+
+    def _steps ( self, timeout ):
+        """
+        Yields the steps shared by listen and alisten: ( STEP_SLEEP, seconds ) and ( STEP_EMIT, event or None )
+        """
+        start = time.monotonic()
+
+        # Events of the same path for more than one id are only logged once in each batch, like BetterInotify does
+        logged = set()
+
+        for ( moment, event ) in self._records():
+            if self.speed:
+                deadline = start + moment / self.speed
+
+                # Waits for the moment of the event, waking up whenever the Inotifile has something pending
+                while time.monotonic() < deadline:
+                    wait = self._timeout( timeout )
+
+                    if wait is None or time.monotonic() + wait >= deadline:
+                        yield ( STEP_SLEEP, deadline - time.monotonic() )
+
+                        break
+
+                    yield ( STEP_SLEEP, wait )
+                    yield ( STEP_EMIT, None )
+
+            if event is None:
+                logged.clear()
+            else:
+                self.received = time.monotonic()
+
+                if self.logger and event[ 0 ] not in self.quiet and event[ 1: ] not in logged:
+                    logged.add( event[ 1: ] )
+
+                    self.logger.event( BetterInotify.event_name( event[ 1 ] ), BetterInotify.type_name( event[ 2 ] ), *event[ 3: ] )
+
+            yield ( STEP_EMIT, event )
+
+        yield ( STEP_EMIT, None )
+
+        # The recording is over, but the debounced events and batches still have to wait for their windows
+        while callable( timeout ):
+            wait = self._timeout( timeout )
+
+            if wait is None:
+                return
+
+            yield ( STEP_SLEEP, wait )
+            yield ( STEP_EMIT, None )
+
+    def listen ( self, ignore_missing_new_folders = False, timeout = None ):
+        for ( step, value ) in self._steps( timeout ):
+            if step == STEP_SLEEP:
+                if value > 0:
+                    time.sleep( value )
+            else:
+                yield value
+
+    async def alisten ( self, timeout = None ):
+        for ( step, value ) in self._steps( timeout ):
+            if step == STEP_SLEEP:
+                await asyncio.sleep( max( value, 0 ) )
+            else:
+                yield value
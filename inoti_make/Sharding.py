@@ -0,0 +1,378 @@
+from . import BetterInotify
+from . import Metrics
+from . import Poller
+from collections import Counter, deque
+import multiprocessing.connection
+import multiprocessing
+import asyncio
+import signal
+import time
+import os
+
+# How often (in seconds) the workers stop waiting for events to run the commands sent by the coordinator
+COMMAND_INTERVAL = 0.1
+# How often (in seconds) the workers send their metrics to the coordinator
+METRICS_INTERVAL = 1
+# Seconds the coordinator waits for each worker to stop before killing it
+STOP_TIMEOUT = 5
+
+class RemoteLogger:
+    """
+    Logger used inside the workers. The calls are only recorded, in the same list as the events, and are made on the real
+    logger by the coordinator, in the same order
+    """
+    def __init__ ( self ):
+        self.records = []
+
+    def flush ( self ):
+        pass
+
+    def __getattr__ ( self, method ):
+        return lambda *args: self.records.append( ( method, args ) )
+
+def watch_root ( glob ):
+    """
+    Returns the folder BetterInotify watches for the glob (globs with the same one share their watchers, however their
+    folders are spelled)
+    """
+    return BetterInotify.watch_folder( os.path.abspath( glob ) )
+
+def worker ( connection, inherited, scan_workers, watch_budget, poll_interval, metrics ):
+    """
+    Runs a BetterInotify for the roots given to this worker. Each batch of events (together with the calls to the logger
+    made while handling it) is sent as the message ( 'events', received, records, metrics ), where the events are the records
+    whose method is None, and metrics is None or what Metrics.take returned (sent every METRICS_INTERVAL when metrics is
+    True). The commands are ( 'add', id, glob, events, close_write, exclude, quiet ), ( 'remove', id ), ( 'resume', directory ),
+    ( 'save', directory ) and ( 'stop', ). Each add is answered with ( 'added', error ), where error is None if the glob is
+    watched
+    """
+    # The ends of the pipes copied from the coordinator are closed, so that the worker notices when the coordinator dies
+    for other in inherited:
+        other.close()
+
+    # Ctrl+C reaches the whole process group, but the workers are stopped by the coordinator
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+
+    logger = RemoteLogger()
+
+    fallback = Poller.Poller( interval = poll_interval ) if poll_interval else None
+
+    metrics = Metrics.Metrics() if metrics else None
+
+    inotify = BetterInotify.BetterInotify( logger = logger, scan_workers = scan_workers, fallback = fallback, watch_budget = watch_budget, metrics = metrics )
+
+    # When the metrics were last sent
+    sent = time.monotonic()
+
+    # Dictionaries matching the ids of the local add_watch to the ids of the coordinator, and back
+    ids = dict()
+    handles = dict()
+
+    def record ( event ):
+        id = ids.get( event[ 0 ] )
+
+        if id is not None:
+            logger.records.append( ( None, ( id, *event[ 1: ] ) ) )
+
+    def send ():
+        nonlocal sent
+
+        taken = None
+
+        if metrics is not None and time.monotonic() - sent >= METRICS_INTERVAL:
+            taken = metrics.take()
+
+            sent = time.monotonic()
+
+        if logger.records or taken is not None:
+            connection.send( ( 'events', inotify.received, logger.records, taken ) )
+
+            logger.records = []
+
+    try:
+        for event in inotify.listen( timeout = COMMAND_INTERVAL ):
+            if event is not None:
+                record( event )
+
+                continue
+
+            send()
+
+            while connection.poll():
+                ( command, *args ) = connection.recv()
+
+                if command == 'add':
+                    ( id, glob, events, close_write, exclude, quiet ) = args
+
+                    error = None
+
+                    try:
+                        handles[ id ] = inotify.add_watch( glob, events = events, close_write = close_write, exclude = exclude, quiet = quiet )
+
+                        ids[ handles[ id ] ] = id
+                    except Exception as exception:
+                        # Raised again by the add_watch of the coordinator
+                        error = exception
+
+                    send()
+
+                    connection.send( ( 'added', error ) )
+                elif command == 'remove':
+                    local = handles.pop( args[ 0 ], None )
+
+                    if local is not None:
+                        inotify.remove_watch( local )
+
+                        del ids[ local ]
+                elif command == 'resume':
+                    inotify.received = time.monotonic()
+
+                    for event in inotify.load_state( args[ 0 ] ):
+                        record( event )
+                elif command == 'save':
+                    inotify.save_state( args[ 0 ] )
+                elif command == 'stop':
+                    return
+
+                send()
+    except EOFError:
+        # The coordinator is gone
+        pass
+    finally:
+        inotify.close()
+
+        connection.close()
+
+class Shard:
+    def __init__ ( self, context, inherited, scan_workers, watch_budget, poll_interval, metrics ):
+        ( self.connection, child ) = context.Pipe()
+
+        self.process = context.Process( target = worker, args = ( child, [ self.connection, *inherited ], scan_workers, watch_budget, poll_interval, metrics ), daemon = True )
+        self.process.start()
+
+        child.close()
+
+        # Number of roots given to this worker
+        self.roots = 0
+
+    def send ( self, *command ):
+        self.connection.send( command )
+
+    def stop ( self ):
+        try:
+            self.send( 'stop' )
+        except OSError:
+            pass
+
+        self.process.join( STOP_TIMEOUT )
+
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+        self.connection.close()
+
+class Shards:
+    """
+    Same interface as BetterInotify (for the Inotifile), but the roots of the globs are split between worker processes,
+    each with its own BetterInotify, so that independent trees parse and match their events on separate cores. Globs with
+    the same root always go to the same worker, and new roots go to the worker with the fewest. This process only logs
+    and yields the events the workers send.
+    Events of different workers are yielded in the order their batches arrive, so the order is only kept for the events
+    of each root. The metrics of the workers are added to the metrics given
+    """
+    def __init__ ( self, shards, logger = None, block_duration = 1, scan_workers = 1, watch_budget = None, poll_interval = None, metrics = None ):
+        # The workers start as copies of this process, so they need nothing pickled besides the arguments
+        context = multiprocessing.get_context( 'fork' )
+
+        budget = None if watch_budget is None else max( watch_budget // shards, 1 )
+
+        self.shards = []
+
+        for _ in range( shards ):
+            self.shards.append( Shard( context, [ shard.connection for shard in self.shards ], scan_workers, budget, poll_interval, metrics is not None ) )
+
+        self.logger = logger
+
+        self.metrics = metrics
+
+        self.block_duration = block_duration
+
+        # Dictionary matching a root folder to the shard that watches it
+        self.roots = dict()
+        # Dictionary matching an id returned by add_watch to its root folder
+        self.handles = dict()
+        # Counts how many ids use each root folder
+        self.uses = Counter()
+
+        self.counter = 0
+
+        # Batches of events received while waiting for the answer to an add, yielded by listen before any other
+        self.pending = deque()
+
+        # When the batch of events being handled was read by its worker (time.monotonic is the same for every process)
+        self.received = None
+
+    def add_watch ( self, glob, events = None, close_write = False, exclude = (), quiet = False ):
+        """
+        Waits for the worker to watch the glob, so its errors are raised here, as with BetterInotify
+        """
+        id = self.counter
+
+        self.counter += 1
+
+        root = watch_root( glob )
+
+        shard = self.roots.get( root )
+
+        if shard is None:
+            shard = self.roots[ root ] = min( self.shards, key = lambda shard: shard.roots )
+
+            shard.roots += 1
+
+        self.uses[ root ] += 1
+
+        self.handles[ id ] = root
+
+        shard.send( 'add', id, glob, events, close_write, tuple( exclude ), quiet )
+
+        while True:
+            message = self._read( shard.connection )
+
+            if message[ 0 ] == 'added':
+                break
+
+            self.pending.append( ( shard.connection, message ) )
+
+        if message[ 1 ] is not None:
+            self._forget( id )
+
+            raise message[ 1 ]
+
+        return id
+
+    def _forget ( self, id ):
+        """
+        Removes the id from the roots, and returns the shard that watched it (None if the id is unknown)
+        """
+        root = self.handles.pop( id, None )
+
+        if root is None:
+            return None
+
+        shard = self.roots[ root ]
+
+        self.uses[ root ] -= 1
+
+        if self.uses[ root ] <= 0:
+            del self.uses[ root ]
+            del self.roots[ root ]
+
+            shard.roots -= 1
+
+        return shard
+
+    def remove_watch ( self, id ):
+        shard = self._forget( id )
+
+        if shard is not None:
+            shard.send( 'remove', id )
+
+    def load_state ( self, directory ):
+        """
+        Each worker resumes its own roots, and the missed events arrive with the others (so none are returned here)
+        """
+        for shard in self.shards:
+            shard.send( 'resume', directory )
+
+        return []
+
+    def save_state ( self, directory ):
+        # The state files are kept for each root folder, so each worker writes the ones of its roots
+        for shard in self.shards:
+            shard.send( 'save', directory )
+
+    def _timeout ( self, timeout ):
+        if callable( timeout ):
+            return timeout()
+
+        return self.block_duration if timeout is None else timeout
+
+    def _read ( self, connection ):
+        try:
+            return connection.recv()
+        except EOFError:
+            raise RuntimeError( 'A shard stopped unexpectedly' )
+
+    def _events ( self, connection, message ):
+        ( _, received, records, taken ) = message
+
+        self.received = received
+
+        if taken is not None and self.metrics is not None:
+            self.metrics.merge( taken, source = connection )
+
+        for method, args in records:
+            if method is None:
+                yield args
+            elif self.logger:
+                getattr( self.logger, method )( *args )
+
+    def _receive ( self, connection ):
+        """
+        Yields the events of the batches received by add_watch, and then the ones of the next batch of the connection (if
+        add_watch did not already read it)
+        """
+        while self.pending:
+            yield from self._events( *self.pending.popleft() )
+
+        if connection is not None and connection.poll():
+            yield from self._events( connection, self._read( connection ) )
+
+    def listen ( self, ignore_missing_new_folders = False, timeout = None ):
+        """
+        Yields the events of every worker, with the same meaning for None and timeout as BetterInotify.listen
+        """
+        connections = [ shard.connection for shard in self.shards ]
+
+        while True:
+            yield from self._receive( None )
+
+            for connection in multiprocessing.connection.wait( connections, self._timeout( timeout ) ):
+                yield from self._receive( connection )
+
+            yield None
+
+    async def alisten ( self, timeout = None ):
+        loop = asyncio.get_running_loop()
+
+        connections = [ shard.connection for shard in self.shards ]
+
+        while True:
+            for event in self._receive( None ):
+                yield event
+
+            future = loop.create_future()
+
+            for connection in connections:
+                loop.add_reader( connection.fileno(), lambda: future.done() or future.set_result( None ) )
+
+            try:
+                await asyncio.wait_for( future, self._timeout( timeout ) )
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                for connection in connections:
+                    loop.remove_reader( connection.fileno() )
+
+            for connection in connections:
+                for event in self._receive( connection ):
+                    yield event
+
+            yield None
+
+    def close ( self ):
+        for shard in self.shards:
+            shard.stop()
+
+        self.shards = []
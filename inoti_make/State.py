@@ -0,0 +1,60 @@
+import hashlib
+import json
+import time
+import os
+
+# Seconds between the saves of the state while running, so that not much is replayed again after a crash
+STATE_INTERVAL = 60
+
+VERSION = 1
+
+def state_file ( directory, folder ):
+    """
+    Returns the file that keeps the state of a root folder. The name depends on the absolute path of the folder, so runs
+    from other folders (where the same relative path means something else) do not share it
+    """
+    name = hashlib.blake2b( os.path.abspath( folder ).encode( 'utf-8', 'surrogateescape' ), digest_size = 10 ).hexdigest()
+
+    return os.path.join( directory, f'{name}.json' )
+
+def load ( directory, folders ):
+    """
+    Returns a dictionary matching each folder that has a saved state to its snapshot (see BetterInotify.snapshots).
+    Missing, unreadable or outdated files are skipped
+    """
+    snapshots = dict()
+
+    for folder in folders:
+        try:
+            with open( state_file( directory, folder ) ) as file:
+                state = json.load( file )
+        except ( OSError, ValueError ):
+            continue
+
+        if state.get( 'version' ) != VERSION or state.get( 'folder' ) != folder:
+            continue
+
+        snapshots[ folder ] = dict( ( filepath, tuple( entry ) ) for ( filepath, *entry ) in state[ 'entries' ] )
+
+    return snapshots
+
+def save ( directory, snapshots ):
+    """
+    Writes one file for each root folder. Each file is replaced at once, so a crash while saving leaves the older state
+    """
+    os.makedirs( directory, exist_ok = True )
+
+    for folder, snapshot in snapshots.items():
+        path = state_file( directory, folder )
+
+        temporary = f'{path}.{os.getpid()}.tmp'
+
+        with open( temporary, 'w' ) as file:
+            json.dump( dict( 
+                version = VERSION, 
+                folder = folder, 
+                time = time.time(), 
+                entries = [ [ filepath, *entry ] for filepath, entry in snapshot.items() ] 
+            ), file, separators = ( ',', ':' ) )
+
+        os.replace( temporary, path )
@@ -2,3 +2,12 @@ from . import BetterInotify
 from . import Executor
 from . import Parser
 from . import Logger
+from . import Debouncer
+from . import Dispatcher
+from . import Inotify
+from . import Poller
+from . import Metrics
+from . import HashCache
+from . import State
+from . import Sharding
+from . import Recording
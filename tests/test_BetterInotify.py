@@ -0,0 +1,252 @@
+from inoti_make import BetterInotify
+from inoti_make import Inotify
+import shutil
+import os
+
+def drain ( inotify ):
+    """
+    Returns the events of the native events pending right now (listen yields a None after each batch)
+    """
+    events = []
+
+    for event in inotify.listen( timeout = 0.2 ):
+        if event is None:
+            return events
+
+        events.append( event )
+
+def watch ( folder, glob = os.path.join( '**', '*.txt' ) ):
+    inotify = BetterInotify.BetterInotify()
+
+    id = inotify.add_watch( os.path.join( folder, glob ) )
+
+    return ( inotify, id )
+
+def test_folder_removed_before_its_watch ( tmp_path ):
+    ( inotify, id ) = watch( str( tmp_path ) )
+
+    try:
+        os.makedirs( tmp_path / 'a' / 'b' )
+
+        shutil.rmtree( tmp_path / 'a' )
+
+        drain( inotify )
+
+        assert str( tmp_path / 'a' ) not in inotify.watchers
+        assert str( tmp_path / 'a' / 'b' ) not in inotify.watchers
+
+        ( tmp_path / 'c.txt' ).write_text( 'c' )
+
+        assert ( id, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'c.txt' ) ) in drain( inotify )
+    finally:
+        inotify.close()
+
+def test_folder_renamed_before_its_watch ( tmp_path ):
+    ( inotify, id ) = watch( str( tmp_path ) )
+
+    try:
+        os.makedirs( tmp_path / 'a' / 'b' )
+
+        os.rename( tmp_path / 'a', tmp_path / 'c' )
+
+        drain( inotify )
+
+        assert str( tmp_path / 'a' ) not in inotify.watchers
+        assert str( tmp_path / 'c' / 'b' ) in inotify.watchers
+
+        ( tmp_path / 'c' / 'b' / 'd.txt' ).write_text( 'd' )
+
+        assert ( id, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'c' / 'b' / 'd.txt' ) ) in drain( inotify )
+    finally:
+        inotify.close()
+
+def test_folder_removed_while_scanning ( tmp_path, monkeypatch ):
+    os.makedirs( tmp_path / 'a' )
+
+    list_folders = BetterInotify.BetterInotify._list_folders
+
+    # Every listing includes a folder that is removed before its watch is added
+    monkeypatch.setattr( BetterInotify.BetterInotify, '_list_folders', lambda self, folder: list_folders( self, folder ) + [ os.path.join( folder, 'gone' ) ] )
+
+    ( inotify, id ) = watch( str( tmp_path ) )
+
+    try:
+        assert str( tmp_path / 'a' ) in inotify.watchers
+        assert not any( os.path.basename( path ) == 'gone' for path in inotify.watchers )
+        assert not any( os.path.basename( path ) == 'gone' for path in inotify.watchers_cache )
+    finally:
+        inotify.close()
+
+def test_nested_roots_share_the_native_watches ( tmp_path ):
+    os.makedirs( tmp_path / 'src' / 'lib' / 'a' )
+
+    inotify = BetterInotify.BetterInotify()
+
+    try:
+        python = inotify.add_watch( os.path.join( tmp_path, 'src', '**', '*.py' ) )
+        javascript = inotify.add_watch( os.path.join( tmp_path, 'src', 'lib', '**', '*.js' ) )
+
+        # Each root folder has its own subtree, but every folder is watched once
+        assert len( inotify.subtrees ) == 2
+        assert len( inotify.watchers[ str( tmp_path / 'src' / 'lib' / 'a' ) ] ) == 2
+        assert sorted( inotify.inotify.watches ) == [ str( tmp_path / 'src' ), str( tmp_path / 'src' / 'lib' ), str( tmp_path / 'src' / 'lib' / 'a' ) ]
+
+        ( tmp_path / 'src' / 'lib' / 'a' / 'b.js' ).write_text( 'b' )
+        ( tmp_path / 'src' / 'lib' / 'a' / 'c.py' ).write_text( 'c' )
+
+        events = drain( inotify )
+
+        assert ( javascript, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'src' / 'lib' / 'a' / 'b.js' ) ) in events
+        assert ( python, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'src' / 'lib' / 'a' / 'c.py' ) ) in events
+        assert not any( event[ 0 ] == python and event[ 3 ].endswith( '.js' ) for event in events )
+
+        inotify.remove_watch( python )
+
+        assert sorted( inotify.inotify.watches ) == [ str( tmp_path / 'src' / 'lib' ), str( tmp_path / 'src' / 'lib' / 'a' ) ]
+    finally:
+        inotify.close()
+def test_overflow_reconciles_the_trees ( tmp_path ):
+    os.makedirs( tmp_path / 'a' )
+
+    ( tmp_path / 'a' / 'old.txt' ).write_text( 'old' )
+
+    ( inotify, id ) = watch( str( tmp_path ) )
+
+    try:
+        inotify.track()
+
+        # The folder is replaced and nothing is read, as if the kernel had lost the events
+        shutil.rmtree( tmp_path / 'a' )
+
+        os.makedirs( tmp_path / 'a' )
+
+        ( tmp_path / 'a' / 'new.txt' ).write_text( 'new' )
+
+        events = list( inotify._receive( [ ( Inotify.IN_Q_OVERFLOW, 0, None, None ) ] ) )
+
+        assert ( id, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'a' / 'new.txt' ) ) in events
+        assert ( id, BetterInotify.EventRemove, BetterInotify.EventFile, str( tmp_path / 'a' / 'old.txt' ) ) in events
+
+        drain( inotify )
+
+        # The new folder is watched in place of the old one
+        ( tmp_path / 'a' / 'newer.txt' ).write_text( 'newer' )
+
+        assert ( id, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'a' / 'newer.txt' ) ) in drain( inotify )
+    finally:
+        inotify.close()
+
+def test_first_overflow_reports_the_files_changed_since_the_last_read ( tmp_path ):
+    os.makedirs( tmp_path / 'a' )
+
+    for name in ( 'old', 'changed' ):
+        ( tmp_path / 'a' / f'{ name }.txt' ).write_text( name )
+
+        os.utime( tmp_path / 'a' / f'{ name }.txt', ( 0, 0 ) )
+
+    ( inotify, id ) = watch( str( tmp_path ) )
+
+    try:
+        ( tmp_path / 'a' / 'new.txt' ).write_text( 'new' )
+
+        os.utime( tmp_path / 'a' / 'new.txt', ( 0, 0 ) )
+
+        # Nothing is stat or listed for the events until the snapshots are needed
+        assert drain( inotify )
+        assert inotify.subtrees[ str( tmp_path ) ].snapshot == {}
+
+        ( tmp_path / 'a' / 'changed.txt' ).write_text( 'changed again' )
+
+        events = list( inotify._receive( [ ( Inotify.IN_Q_OVERFLOW, 0, None, None ) ] ) )
+
+        assert sorted( ( event[ 1 ], os.path.basename( event[ 3 ] ) ) for event in events ) == [ 
+            ( BetterInotify.EventUpdate, 'changed.txt' ) 
+        ]
+
+        # The next overflows know exactly what changed
+        ( tmp_path / 'a' / 'new.txt' ).unlink()
+
+        events = list( inotify._receive( [ ( Inotify.IN_Q_OVERFLOW, 0, None, None ) ] ) )
+
+        assert [ ( event[ 1 ], os.path.basename( event[ 3 ] ) ) for event in events ] == [ ( BetterInotify.EventRemove, 'new.txt' ) ]
+    finally:
+        inotify.close()
+
+def test_state_catches_up_with_the_changes_made_while_stopped ( tmp_path ):
+    os.makedirs( tmp_path / 'tree' / 'a' )
+
+    for name in ( 'kept', 'updated', 'removed' ):
+        ( tmp_path / 'tree' / 'a' / f'{ name }.txt' ).write_text( name )
+
+    ( inotify, id ) = watch( str( tmp_path / 'tree' ) )
+
+    try:
+        inotify.save_state( str( tmp_path / 'state' ) )
+    finally:
+        inotify.close()
+
+    ( tmp_path / 'tree' / 'a' / 'updated.txt' ).write_text( 'updated again' )
+    ( tmp_path / 'tree' / 'a' / 'removed.txt' ).unlink()
+    ( tmp_path / 'tree' / 'a' / 'created.txt' ).write_text( 'created' )
+
+    ( inotify, id ) = watch( str( tmp_path / 'tree' ) )
+
+    try:
+        events = inotify.load_state( str( tmp_path / 'state' ) )
+
+        assert sorted( ( event[ 1 ], os.path.basename( event[ 3 ] ) ) for event in events ) == [ 
+            ( BetterInotify.EventCreate, 'created.txt' ), 
+            ( BetterInotify.EventUpdate, 'updated.txt' ), 
+            ( BetterInotify.EventRemove, 'removed.txt' ) 
+        ]
+
+        # A state saved for other folders (or never saved) has nothing to catch up with
+        assert inotify.load_state( str( tmp_path / 'other' ) ) == []
+    finally:
+        inotify.close()
+
+def test_renames_are_paired_by_their_cookie ( tmp_path ):
+    inotify = BetterInotify.BetterInotify()
+
+    try:
+        moves = inotify.add_watch( os.path.join( tmp_path, '*.txt' ), events = [ BetterInotify.EventCreate, BetterInotify.EventRemove, BetterInotify.EventMove ] )
+        others = inotify.add_watch( os.path.join( tmp_path, '*.txt' ) )
+
+        ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+        drain( inotify )
+
+        os.rename( tmp_path / 'a.txt', tmp_path / 'b.txt' )
+
+        events = drain( inotify )
+
+        # Only the ids that asked for EventMove get a single event, with the old path at the end
+        assert ( moves, BetterInotify.EventMove, BetterInotify.EventFile, str( tmp_path / 'b.txt' ), str( tmp_path / 'a.txt' ) ) in events
+        assert not any( event[ 0 ] == moves and event[ 1 ] != BetterInotify.EventMove for event in events )
+
+        assert ( others, BetterInotify.EventRemove, BetterInotify.EventFile, str( tmp_path / 'a.txt' ) ) in events
+        assert ( others, BetterInotify.EventCreate, BetterInotify.EventFile, str( tmp_path / 'b.txt' ) ) in events
+    finally:
+        inotify.close()
+
+def test_spellings_of_a_folder_share_its_watchers ( tmp_path, monkeypatch ):
+    os.makedirs( tmp_path / 'sub' )
+
+    monkeypatch.chdir( tmp_path )
+
+    inotify = BetterInotify.BetterInotify()
+
+    try:
+        ids = [ inotify.add_watch( glob ) for glob in ( os.path.join( 'sub', '*.txt' ), os.path.join( os.curdir, 'sub', '*.txt' ), str( tmp_path / 'sub' / '*.txt' ) ) ]
+
+        assert list( inotify.subtrees ) == [ str( tmp_path / 'sub' ) ]
+        assert list( inotify.inotify.watches ) == [ str( tmp_path / 'sub' ) ]
+
+        ( tmp_path / 'sub' / 'a.txt' ).write_text( 'a' )
+
+        # Each id receives the paths as its glob spells them
+        paths = [ os.path.join( 'sub', 'a.txt' ), os.path.join( os.curdir, 'sub', 'a.txt' ), str( tmp_path / 'sub' / 'a.txt' ) ]
+
+        assert set( ( event[ 0 ], event[ 3 ] ) for event in drain( inotify ) ) == set( zip( ids, paths ) )
+    finally:
+        inotify.close()
@@ -0,0 +1,95 @@
+from inoti_make import BetterInotify
+from inoti_make import Debouncer
+import pytest
+
+def event ( action, filepath = 'a.txt' ):
+    return ( 0, action, BetterInotify.EventFile, filepath )
+
+def test_debouncer_waits_for_the_whole_window ( ):
+    debouncer = Debouncer.Debouncer()
+
+    debouncer.push( 'a', event( BetterInotify.EventCreate ), 1, payload = 'rule', now = 0 )
+    debouncer.push( 'a', event( BetterInotify.EventUpdate ), 1, payload = 'rule', now = 0.5 )
+
+    # Each event starts the window again
+    assert debouncer.timeout( now = 0.5 ) == 1
+    assert list( debouncer.ready( now = 1.2 ) ) == []
+
+    assert list( debouncer.ready( now = 1.5 ) ) == [ ( event( BetterInotify.EventCreate ), 'rule' ) ]
+    assert len( debouncer ) == 0
+    assert debouncer.timeout( now = 1.5 ) is None
+
+def test_debouncer_keys_have_their_own_windows ( ):
+    debouncer = Debouncer.Debouncer()
+
+    debouncer.push( 'a', event( BetterInotify.EventUpdate, 'a.txt' ), 1, now = 0 )
+    debouncer.push( 'b', event( BetterInotify.EventUpdate, 'b.txt' ), 2, now = 0 )
+
+    assert [ event[ 3 ] for ( event, payload ) in debouncer.ready( now = 1 ) ] == [ 'a.txt' ]
+    assert debouncer.timeout( now = 1 ) == 1
+    assert [ event[ 3 ] for ( event, payload ) in debouncer.ready( now = 2 ) ] == [ 'b.txt' ]
+
+def test_debouncer_drops_files_created_and_removed ( ):
+    debouncer = Debouncer.Debouncer()
+
+    debouncer.push( 'a', event( BetterInotify.EventCreate ), 1, now = 0 )
+    debouncer.push( 'a', event( BetterInotify.EventRemove ), 1, now = 0.5 )
+
+    assert len( debouncer ) == 0
+    assert debouncer.timeout( now = 0.5 ) is None
+    assert list( debouncer.ready( now = 2 ) ) == []
+
+def test_debouncer_flush_ignores_the_windows ( ):
+    debouncer = Debouncer.Debouncer()
+
+    debouncer.push( 'b', event( BetterInotify.EventUpdate, 'b.txt' ), 2, now = 0 )
+    debouncer.push( 'a', event( BetterInotify.EventUpdate, 'a.txt' ), 1, now = 0 )
+
+    assert [ event[ 3 ] for ( event, payload ) in debouncer.flush() ] == [ 'a.txt', 'b.txt' ]
+    assert len( debouncer ) == 0
+    assert debouncer.timeout() is None
+
+def test_batcher_sends_the_batch_when_its_window_ends ( ):
+    batcher = Debouncer.Batcher()
+
+    assert batcher.push( 'rule', event( BetterInotify.EventCreate, 'a.txt' ), 1, payload = 'rule', now = 0 ) is None
+    assert batcher.push( 'rule', event( BetterInotify.EventUpdate, 'a.txt' ), 1, payload = 'rule', now = 0.5 ) is None
+    assert batcher.push( 'rule', event( BetterInotify.EventUpdate, 'b.txt' ), 1, payload = 'rule', now = 0.9 ) is None
+
+    # Unlike the debouncer, the window starts with the first event and does not move
+    assert batcher.timeout( now = 0.9 ) == pytest.approx( 0.1 )
+    assert list( batcher.ready( now = 0.9 ) ) == []
+
+    assert list( batcher.ready( now = 1 ) ) == [ ( [ event( BetterInotify.EventCreate, 'a.txt' ), event( BetterInotify.EventUpdate, 'b.txt' ) ], 'rule' ) ]
+    assert len( batcher ) == 0
+
+def test_batcher_sends_full_batches_right_away ( ):
+    batcher = Debouncer.Batcher()
+
+    assert batcher.push( 'rule', event( BetterInotify.EventUpdate, 'a.txt' ), 1, size = 2, now = 0 ) is None
+    assert batcher.push( 'rule', event( BetterInotify.EventUpdate, 'a.txt' ), 1, size = 2, now = 0 ) is None
+
+    assert batcher.push( 'rule', event( BetterInotify.EventUpdate, 'b.txt' ), 1, size = 2, now = 0 ) == [ event( BetterInotify.EventUpdate, 'a.txt' ), event( BetterInotify.EventUpdate, 'b.txt' ) ]
+
+    # The next event starts a new batch, with a window of its own
+    batcher.push( 'rule', event( BetterInotify.EventUpdate, 'c.txt' ), 1, size = 2, now = 2 )
+
+    assert list( batcher.ready( now = 1 ) ) == []
+    assert [ len( events ) for ( events, payload ) in batcher.ready( now = 3 ) ] == [ 1 ]
+
+def test_batcher_drops_batches_left_empty ( ):
+    batcher = Debouncer.Batcher()
+
+    batcher.push( 'rule', event( BetterInotify.EventCreate ), 1, now = 0 )
+    batcher.push( 'rule', event( BetterInotify.EventRemove ), 1, now = 0 )
+
+    assert list( batcher.ready( now = 1 ) ) == []
+    assert len( batcher ) == 0
+
+def test_batcher_flush_ignores_the_windows ( ):
+    batcher = Debouncer.Batcher()
+
+    batcher.push( 'rule', event( BetterInotify.EventUpdate ), 1, payload = 'rule', now = 0 )
+
+    assert list( batcher.flush() ) == [ ( [ event( BetterInotify.EventUpdate ) ], 'rule' ) ]
+    assert batcher.timeout() is None
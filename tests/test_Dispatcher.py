@@ -0,0 +1,158 @@
+from inoti_make import Dispatcher
+import threading
+import time
+
+class Gate:
+    """
+    Action that records its argument, but only finishes once the gate is opened
+    """
+    def __init__ ( self ):
+        self.opened = threading.Event()
+        self.started = threading.Event()
+        self.runs = []
+
+    def __call__ ( self, value ):
+        self.started.set()
+
+        self.opened.wait( 5 )
+
+        self.runs.append( value )
+
+    def open ( self ):
+        self.opened.set()
+
+def busy_dispatcher ( capacity = 1, **kwargs ):
+    """
+    Dispatcher with a single job, already busy running a gated action of the rule 'busy'
+    """
+    dispatcher = Dispatcher.Dispatcher( jobs = 1, capacity = capacity, **kwargs )
+
+    gate = Gate()
+
+    dispatcher.submit( 'busy', None, gate, 'busy' )
+
+    gate.started.wait( 5 )
+
+    return ( dispatcher, gate )
+
+def test_block_waits_for_room ( ):
+    ( dispatcher, gate ) = busy_dispatcher()
+
+    dispatcher.submit( 'rule', 'a.txt', gate, 'a' )
+
+    submitter = threading.Thread( target = dispatcher.submit, args = ( 'rule', 'b.txt', gate, 'b' ) )
+    submitter.start()
+
+    try:
+        time.sleep( 0.1 )
+
+        assert submitter.is_alive()
+    finally:
+        gate.open()
+
+        submitter.join( 5 )
+
+    dispatcher.join()
+
+    assert gate.runs == [ 'busy', 'a', 'b' ]
+    assert dispatcher.take_drops()[ 2 ][ 'rule' ] == 1
+
+    dispatcher.shutdown()
+
+def test_drop_oldest_drops_the_oldest_of_the_rule ( ):
+    forgotten = []
+
+    ( dispatcher, gate ) = busy_dispatcher( forget = lambda key, args: forgotten.append( args ) )
+
+    dispatcher.prioritize( 'rule', policy = Dispatcher.POLICY_DROP_OLDEST )
+
+    for value in ( 'a', 'b', 'c' ):
+        dispatcher.submit( 'rule', f'{ value }.txt', gate, value )
+
+    gate.open()
+
+    dispatcher.join()
+
+    assert gate.runs == [ 'busy', 'c' ]
+    assert forgotten == [ ( 'a', ), ( 'b', ) ]
+    assert dispatcher.take_drops()[ 0 ][ 'rule' ] == 2
+
+    dispatcher.shutdown()
+
+def test_coalesce_merges_the_actions_of_the_same_path ( ):
+    forgotten = []
+
+    ( dispatcher, gate ) = busy_dispatcher( coalesce = lambda previous, current: ( previous[ 0 ] + current[ 0 ], ), forget = lambda key, args: forgotten.append( args ) )
+
+    dispatcher.prioritize( 'rule', policy = Dispatcher.POLICY_COALESCE )
+
+    dispatcher.submit( 'rule', 'a.txt', gate, 'a' )
+    dispatcher.submit( 'rule', 'a.txt', gate, 'b' )
+
+    # There is no other action for this path, so the oldest one is dropped
+    dispatcher.submit( 'rule', 'c.txt', gate, 'c' )
+
+    gate.open()
+
+    dispatcher.join()
+
+    assert gate.runs == [ 'busy', 'c' ]
+    assert forgotten == [ ( 'a', ), ( 'ab', ) ]
+    assert dispatcher.take_drops()[ :2 ] == ( { 'rule': 1 }, { 'rule': 1 } )
+
+    dispatcher.shutdown()
+
+def test_coalesce_forgets_actions_that_cancel_each_other ( ):
+    forgotten = []
+
+    ( dispatcher, gate ) = busy_dispatcher( coalesce = lambda previous, current: None, forget = lambda key, args: forgotten.append( args ) )
+
+    dispatcher.prioritize( 'rule', policy = Dispatcher.POLICY_COALESCE )
+
+    dispatcher.submit( 'rule', 'a.txt', gate, 'a' )
+    dispatcher.submit( 'rule', 'a.txt', gate, 'b' )
+
+    gate.open()
+
+    dispatcher.join()
+
+    assert gate.runs == [ 'busy' ]
+    assert forgotten == [ ( 'a', ), ( 'b', ) ]
+
+    dispatcher.shutdown()
+
+def test_lower_priorities_are_dropped_first ( ):
+    ( dispatcher, gate ) = busy_dispatcher( capacity = 2 )
+
+    dispatcher.prioritize( 'low', priority = -1, policy = Dispatcher.POLICY_DROP_OLDEST )
+    dispatcher.prioritize( 'high', priority = 1 )
+
+    dispatcher.submit( 'low', 'a.txt', gate, 'low' )
+    dispatcher.submit( 'high', 'a.txt', gate, 'high' )
+    dispatcher.submit( 'high', 'b.txt', gate, 'higher' )
+
+    gate.open()
+
+    dispatcher.join()
+
+    # Higher priorities also go first
+    assert gate.runs == [ 'busy', 'high', 'higher' ]
+    assert dispatcher.take_drops()[ 0 ] == { 'low': 1 }
+
+    dispatcher.shutdown()
+
+def test_shutdown_forgets_the_waiting_actions ( ):
+    forgotten = []
+
+    ( dispatcher, gate ) = busy_dispatcher( capacity = None, forget = lambda key, args: forgotten.append( key ) )
+
+    dispatcher.submit( 'rule', 'a.txt', gate, 'a' )
+
+    dispatcher.shutdown( wait = False )
+
+    gate.open()
+
+    dispatcher.join()
+
+    assert gate.runs == [ 'busy' ]
+    assert forgotten == [ ( 'rule', 'a.txt' ) ]
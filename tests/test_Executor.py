@@ -0,0 +1,310 @@
+from inoti_make import BetterInotify
+from inoti_make import Dispatcher
+from inoti_make import Executor
+from inoti_make import Parser
+from inoti_make import Poller
+import asyncio
+import errno
+import os
+import pytest
+
+class LockedPoller ( Poller.Poller ):
+    """
+    Backend that cannot watch the folders named locked
+    """
+    def add_watch ( self, path, mask = Poller.Inotify.IN_ALL_EVENTS ):
+        if os.path.basename( path ) == 'locked':
+            raise PermissionError( errno.EACCES, os.strerror( errno.EACCES ), path )
+
+        return super().add_watch( path, mask )
+
+def write_inotifile ( path, *patterns ):
+    path.write_text( ''.join( f'{ pattern } : shell\n    echo changed\n' for pattern in patterns ) )
+
+def test_reload_keeps_the_rules_when_a_pattern_cannot_be_watched ( tmp_path ):
+    for folder in ( 'src', 'locked' ):
+        ( tmp_path / folder ).mkdir()
+
+    source = tmp_path / 'Inotifile'
+
+    write_inotifile( source, tmp_path / 'src' / '*.txt' )
+
+    inotifile = Executor.Inotifile( { 'shell': Executor.ShellExecutor() }, Parser.file( str( source ) ), source = str( source ) )
+    inotifile.dispatcher = inotifile.create_dispatcher()
+
+    inotify = BetterInotify.BetterInotify( backend = LockedPoller() )
+
+    try:
+        inotifile.prepare()
+        inotifile.add_watches( inotify )
+
+        rules = list( inotifile.watchers )
+        ids = dict( inotifile.watchers_ids )
+        folders = set( inotify.watchers )
+
+        write_inotifile( source, tmp_path / 'src' / '*.txt', tmp_path / 'other' / '*.txt', tmp_path / 'locked' / '*.txt' )
+
+        inotifile.reload( inotify )
+
+        assert inotifile.watchers == rules
+        assert inotifile.watchers_ids == ids
+        assert set( inotify.watchers ) == folders
+        assert set( inotify.subtrees ) == { str( tmp_path / 'src' ) }
+        assert set( inotifile.programs ) == set( rules )
+
+        # The rules can still be reloaded once the Inotifile is fixed
+        write_inotifile( source, tmp_path / 'src' / '*.txt', tmp_path / 'other' / '*.txt' )
+
+        inotifile.reload( inotify )
+
+        assert len( inotifile.watchers ) == 2
+        assert set( inotify.subtrees ) == { str( tmp_path / 'src' ), str( tmp_path / 'other' ) }
+    finally:
+        inotify.close()
+
+        inotifile.release()
+
+        inotifile.dispatcher.shutdown()
+
+def stub_inotifile ( text, **options ):
+    """
+    Inotifile whose actions take a moment each and run nothing, with its dispatcher ready for submit
+    """
+    inotifile = Executor.Inotifile( { 'shell': Executor.StubExecutor( 0.05 ) }, Parser.parse_inotifile( text ), **options )
+
+    inotifile.prepare()
+
+    inotifile.dispatcher = inotifile.create_dispatcher()
+
+    for watcher in inotifile.watchers:
+        inotifile.limit( watcher )
+
+    return inotifile
+
+def submit_events ( inotifile, paths, action = BetterInotify.EventCreate ):
+    watcher = inotifile.watchers[ 0 ]
+
+    for path in paths:
+        inotifile.submit( watcher, path, ( 0, action, BetterInotify.EventFile, path ), None )
+
+def test_dropped_actions_are_forgotten ( ):
+    inotifile = stub_inotifile( '[overload=drop-oldest] *.txt : shell\n    echo changed\n', queue_size = 1 )
+
+    try:
+        submit_events( inotifile, [ f'{ index }.txt' for index in range( 20 ) ] )
+
+        inotifile.dispatcher.join()
+
+        assert sum( inotifile.dispatcher.take_drops()[ 0 ].values() ) > 0
+        assert inotifile.executions == {}
+    finally:
+        inotifile.dispatcher.shutdown()
+
+def test_coalesced_actions_are_forgotten ( ):
+    inotifile = stub_inotifile( '[overload=coalesce] *.txt : shell\n    echo changed\n', queue_size = 1 )
+
+    try:
+        # A file created and removed again while the queue is full cancels both of its actions
+        submit_events( inotifile, [ 'a.txt', 'b.txt', 'c.txt' ] )
+        submit_events( inotifile, [ 'c.txt' ], BetterInotify.EventRemove )
+
+        inotifile.dispatcher.join()
+
+        assert sum( inotifile.dispatcher.take_drops()[ 1 ].values() ) > 0
+        assert inotifile.executions == {}
+    finally:
+        inotifile.dispatcher.shutdown()
+
+def test_restarted_actions_are_forgotten ( ):
+    inotifile = stub_inotifile( '[on_busy=restart] *.txt : shell\n    echo changed\n' )
+
+    try:
+        submit_events( inotifile, [ 'a.txt', 'b.txt', 'b.txt', 'b.txt' ] )
+
+        inotifile.dispatcher.join()
+
+        assert inotifile.executions == {}
+    finally:
+        inotifile.dispatcher.shutdown()
+
+def finished_statuses ( inotifile, monkeypatch ):
+    statuses = []
+
+    monkeypatch.setattr( inotifile, 'action_finished', lambda watcher, event, received, start, status: statuses.append( status ) )
+
+    return statuses
+
+def run_action ( text, executors ):
+    inotifile = Executor.Inotifile( executors, Parser.parse_inotifile( text ) )
+
+    inotifile.prepare()
+
+    return inotifile
+
+def test_python_actions_past_their_timeout_report_their_status ( monkeypatch ):
+    inotifile = run_action( '[timeout=20ms] *.txt : python\n    import time\n    time.sleep( 0.1 )\n', { 'python': Executor.PythonExecutor() } )
+
+    statuses = finished_statuses( inotifile, monkeypatch )
+
+    assert inotifile.execute( inotifile.watchers[ 0 ], ( 0, BetterInotify.EventCreate, BetterInotify.EventFile, 'a.txt' ) ) == 0
+    assert statuses == [ '0' ]
+
+def test_killed_actions_report_the_timeout ( monkeypatch ):
+    inotifile = run_action( '[timeout=20ms] *.txt : shell\n    sleep 5\n', { 'shell': Executor.ShellExecutor() } )
+
+    statuses = finished_statuses( inotifile, monkeypatch )
+
+    inotifile.execute( inotifile.watchers[ 0 ], ( 0, BetterInotify.EventCreate, BetterInotify.EventFile, 'a.txt' ) )
+
+    assert statuses == [ 'timeout' ]
+
+HASHED_RULES = [ '[hash=yes] *.txt : shell\n    echo text\n', '[hash=yes] *.md : shell\n    echo markdown\n' ]
+
+def hashing_inotifile ( tmp_path, rules ):
+    inotifile = Executor.Inotifile( { 'shell': Executor.StubExecutor() }, Parser.parse_inotifile( ''.join( rules ) ), hash_cache = str( tmp_path / 'hashes.json' ) )
+
+    inotifile.prepare()
+
+    return inotifile
+
+def test_digests_follow_their_rule_when_rules_are_reordered ( tmp_path ):
+    filepath = str( tmp_path / 'a.txt' )
+
+    ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+    inotifile = hashing_inotifile( tmp_path, HASHED_RULES )
+
+    assert inotifile.content_changed( inotifile.watchers[ 0 ], ( 0, BetterInotify.EventCreate, BetterInotify.EventFile, filepath ) )
+
+    inotifile.release()
+
+    inotifile = hashing_inotifile( tmp_path, HASHED_RULES[ ::-1 ] )
+
+    # The rule for *.txt is the second one now, and it still knows the file did not change
+    assert not inotifile.content_changed( inotifile.watchers[ 1 ], ( 0, BetterInotify.EventUpdate, BetterInotify.EventFile, filepath ) )
+    assert inotifile.content_changed( inotifile.watchers[ 0 ], ( 0, BetterInotify.EventUpdate, BetterInotify.EventFile, filepath ) )
+
+def test_rules_written_the_same_way_keep_their_own_digests ( tmp_path ):
+    filepath = str( tmp_path / 'a.txt' )
+
+    ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+    inotifile = hashing_inotifile( tmp_path, HASHED_RULES[ :1 ] * 2 )
+
+    for watcher in inotifile.watchers:
+        assert inotifile.content_changed( watcher, ( 0, BetterInotify.EventCreate, BetterInotify.EventFile, filepath ) )
+
+def test_stopping_runs_the_debounced_events ( tmp_path, monkeypatch ):
+    inotifile = Executor.AsyncInotifile( { 'shell': Executor.StubExecutor() }, Parser.parse_inotifile( f'{ tmp_path }/*.txt : shell\n    echo changed\n' ), debounce = 60 )
+
+    statuses = finished_statuses( inotifile, monkeypatch )
+
+    async def run ():
+        started = asyncio.ensure_future( inotifile.start( logger = None ) )
+
+        try:
+            while inotifile.listener is None:
+                await asyncio.sleep( 0.01 )
+
+            ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+            while not len( inotifile.debouncer ):
+                await asyncio.sleep( 0.01 )
+        finally:
+            await inotifile.stop()
+
+            await started
+
+    asyncio.run( run() )
+
+    assert statuses == [ '0' ]
+
+def test_interrupting_the_listen_runs_the_debounced_events ( tmp_path, monkeypatch ):
+    inotifile = Executor.Inotifile( { 'shell': Executor.StubExecutor() }, Parser.parse_inotifile( f'{ tmp_path }/*.txt : shell\n    echo changed\n' ), debounce = 60 )
+
+    statuses = finished_statuses( inotifile, monkeypatch )
+
+    handle = inotifile.handle
+
+    def interrupt ( inotify, event ):
+        handle( inotify, event )
+
+        # Ctrl+C arrives while the event waits for its window to end
+        if len( inotifile.debouncer ):
+            raise KeyboardInterrupt()
+
+    monkeypatch.setattr( inotifile, 'handle', interrupt )
+
+    # The file is written once the rules are watched
+    monkeypatch.setattr( inotifile, 'watch_source', lambda inotify: ( tmp_path / 'a.txt' ).write_text( 'a' ) )
+
+    with pytest.raises( KeyboardInterrupt ):
+        inotifile.start( logger = None )
+
+    assert statuses == [ '0' ]
+
+def test_asyncio_rejects_the_options_of_the_dispatcher ( ):
+    executors = { 'shell': Executor.StubExecutor() }
+
+    with pytest.raises( Exception, match = 'queue size' ):
+        Executor.AsyncInotifile( executors, Parser.parse_inotifile( '*.txt : shell\n    echo changed\n' ), queue_size = 1 )
+
+    inotifile = Executor.AsyncInotifile( executors, Parser.parse_inotifile( '[priority=1] *.txt : shell\n    echo changed\n' ) )
+
+    with pytest.raises( Exception, match = 'priority' ):
+        inotifile.prepare()
+
+def test_rules_of_the_current_folder_run_with_the_default_source ( tmp_path, monkeypatch ):
+    monkeypatch.chdir( tmp_path )
+
+    write_inotifile( tmp_path / 'Inotifile', tmp_path / '*.txt' )
+
+    inotifile = Executor.Inotifile( { 'shell': Executor.StubExecutor() }, Parser.file( 'Inotifile' ), source = os.path.join( os.curdir, 'Inotifile' ) )
+
+    submitted = []
+
+    monkeypatch.setattr( inotifile, 'submit', lambda watcher, path, event, received: submitted.append( path ) )
+
+    inotify = BetterInotify.BetterInotify()
+
+    try:
+        inotifile.prepare()
+        inotifile.add_watches( inotify )
+        inotifile.watch_source( inotify )
+
+        ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+        write_inotifile( tmp_path / 'Inotifile', tmp_path / '*.txt', tmp_path / '*.md' )
+
+        for event in inotify.listen( timeout = 0.2 ):
+            if event is None:
+                break
+
+            inotifile.handle( inotify, event )
+
+        assert str( tmp_path / 'a.txt' ) in submitted
+        assert inotifile.reload_at is not None
+    finally:
+        inotify.close()
+
+        inotifile.release()
+
+def test_powershell_values_keep_their_quotes_and_backslashes ( ):
+    variables = { 'FILE': "C:\\it's\u2019.txt", 'FILES': [ "a'b" ] }
+
+    script = Executor.PowershellExecutor().script( Executor.Program( [ 'Write-Host $FILE' ] ), variables )
+
+    assert script.splitlines() == [ "$FILE='C:\\it''s\u2019\u2019.txt'", "$FILES=[string[]]@( 'a''b' )", 'Write-Host $FILE' ]
+
+def test_csharp_arguments_keep_their_quotes_and_backslashes ( ):
+    program = Executor.Program( [] )
+
+    program.code = ( 'Rule0', "/tmp/it's/Rule0.dll" )
+
+    variables = dict( ( key, '' ) for key in Executor.VARIABLES )
+
+    variables[ 'FILE' ] = "C:\\it's.txt"
+
+    script = Executor.CSharpExecutor().script( program, variables )
+
+    assert script.splitlines() == [ "Add-Type -Path '/tmp/it''s/Rule0.dll'", "[INotify.Rule0]::Run( 'C:\\it''s.txt', '', '', '', '', '', '' )" ]
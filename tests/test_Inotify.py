@@ -0,0 +1,44 @@
+from inoti_make import Inotify
+import os
+
+def read ( inotify ):
+    return [ ( mask & ~Inotify.IN_ISDIR, path, filename ) for ( mask, cookie, path, filename ) in inotify.read_events( timeout = 0.2 ) ]
+
+def test_every_path_of_a_folder_shares_its_watch ( tmp_path ):
+    os.makedirs( tmp_path / 'folder' )
+
+    os.symlink( tmp_path / 'folder', tmp_path / 'link' )
+
+    inotify = Inotify.Inotify()
+
+    try:
+        folder = str( tmp_path / 'folder' )
+        link = str( tmp_path / 'link' )
+
+        assert inotify.add_watch( folder, Inotify.IN_CREATE ) == inotify.add_watch( link, Inotify.IN_DELETE )
+
+        # Each path receives the events of the folder, and the kernel has the events of both
+        ( tmp_path / 'folder' / 'a' ).write_text( 'a' )
+        ( tmp_path / 'folder' / 'a' ).unlink()
+
+        assert sorted( read( inotify ) ) == sorted( [ 
+            ( Inotify.IN_CREATE, folder, 'a' ), ( Inotify.IN_CREATE, link, 'a' ), 
+            ( Inotify.IN_DELETE, folder, 'a' ), ( Inotify.IN_DELETE, link, 'a' ) 
+        ] )
+
+        # The watch is kept for the other path, with only the events it asked for
+        inotify.remove_watch( link )
+
+        ( tmp_path / 'folder' / 'b' ).write_text( 'b' )
+        ( tmp_path / 'folder' / 'b' ).unlink()
+
+        assert read( inotify ) == [ ( Inotify.IN_CREATE, folder, 'b' ) ]
+
+        inotify.remove_watch( folder )
+
+        ( tmp_path / 'folder' / 'c' ).write_text( 'c' )
+
+        assert read( inotify ) == []
+        assert inotify.paths == {} and inotify.watches == {}
+    finally:
+        inotify.close()
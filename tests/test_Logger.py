@@ -0,0 +1,74 @@
+from inoti_make import Logger
+import errno
+import time
+import os
+
+def test_rotation_counts_bytes ( tmp_path ):
+    path = str( tmp_path / 'log.txt' )
+
+    file = Logger.RotatingFile( path, max_bytes = 100, backups = 2 )
+
+    try:
+        # Each line has 20 characters, but 28 bytes
+        for _ in range( 10 ):
+            file.write( 'ação/' * 4 )
+    finally:
+        file.close()
+
+    for name in ( path, path + '.1', path + '.2' ):
+        assert 0 < os.path.getsize( name ) <= 100
+
+def test_rotation_keeps_the_backups ( tmp_path ):
+    path = str( tmp_path / 'log.txt' )
+
+    file = Logger.RotatingFile( path, max_bytes = 10, backups = 2 )
+
+    try:
+        for index in range( 5 ):
+            file.write( f'line { index }\n' )
+    finally:
+        file.close()
+
+    assert sorted( os.listdir( tmp_path ) ) == [ 'log.txt', 'log.txt.1', 'log.txt.2' ]
+    assert ( tmp_path / 'log.txt' ).read_text() == 'line 4\n'
+
+class FailingFile:
+    """
+    File whose first writes fail, as on a full disk
+    """
+    def __init__ ( self, failures ):
+        self.failures = failures
+        self.written = []
+
+    def write ( self, string ):
+        if self.failures > 0:
+            self.failures -= 1
+
+            raise OSError( errno.ENOSPC, 'No space left on device' )
+
+        self.written.append( string )
+
+    def flush ( self ):
+        pass
+
+    def close ( self ):
+        pass
+
+def test_background_file_survives_failed_writes ( capsys ):
+    file = Logger.BackgroundFile( FailingFile( failures = 3 ), buffer_lines = 2 )
+
+    for index in range( 3 ):
+        file.write( f'lost { index }\n' )
+
+        # Each line is written on its own, so each one fails
+        while not file.queue.empty():
+            time.sleep( 0.01 )
+
+    # More lines than the queue holds, which would block if the writer had stopped
+    for index in range( 10 ):
+        file.write( f'line { index }\n' )
+
+    file.close()
+
+    assert ''.join( file.file.written ).endswith( 'line 9\n' )
+    assert capsys.readouterr().err.count( 'Traceback' ) == 1
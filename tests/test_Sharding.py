@@ -0,0 +1,127 @@
+from inoti_make import BetterInotify
+from inoti_make import Executor
+from inoti_make import Metrics
+from inoti_make import Parser
+from inoti_make import Sharding
+import asyncio
+import errno
+import pytest
+import time
+import os
+
+def pipes ( pid ):
+    """
+    Returns the pipes the process has open (as the targets of their links in /proc)
+    """
+    folder = f'/proc/{ pid }/fd'
+
+    links = set()
+
+    for fd in os.listdir( folder ):
+        try:
+            links.add( os.readlink( os.path.join( folder, fd ) ) )
+        except OSError:
+            pass
+
+    return set( link for link in links if link.startswith( 'pipe:' ) )
+
+def test_shards_do_not_hold_the_pipes_of_persistent_interpreters ( tmp_path ):
+    inotifile = Executor.AsyncInotifile( 
+        { 'shell': Executor.ShellExecutor() }, 
+        Parser.parse_inotifile( f'[persistent=yes] { tmp_path }/*.txt : shell\n    true\n' ), 
+        shards = 2 
+    )
+
+    created = []
+
+    create_inotify = inotifile.create_inotify
+
+    inotifile.create_inotify = lambda logger: created.append( create_inotify( logger ) ) or created[ -1 ]
+
+    async def run ():
+        started = asyncio.ensure_future( inotifile.start( logger = None ) )
+
+        try:
+            while inotifile.listener is None:
+                await asyncio.sleep( 0.01 )
+
+            stdin = inotifile.programs[ inotifile.watchers[ 0 ] ].coprocess.process.stdin
+
+            interpreter = f'pipe:[{ os.fstat( stdin.fileno() ).st_ino }]'
+
+            for shard in created[ 0 ].shards:
+                assert interpreter not in pipes( shard.process.pid )
+        finally:
+            await inotifile.stop()
+
+            await started
+
+    asyncio.run( run() )
+
+def first_event ( shards ):
+    """
+    Returns the first event of the shards, skipping the batches that only had metrics
+    """
+    deadline = time.monotonic() + 5
+
+    for event in shards.listen( timeout = 0.1 ):
+        if event is not None:
+            return event
+
+        assert time.monotonic() < deadline
+
+def test_shards_send_their_metrics ( tmp_path, monkeypatch ):
+    monkeypatch.setattr( Sharding, 'METRICS_INTERVAL', 0 )
+
+    metrics = Metrics.Metrics()
+
+    shards = Sharding.Shards( 2, metrics = metrics )
+
+    try:
+        shards.add_watch( str( tmp_path / '*.txt' ) )
+
+        ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+        first_event( shards )
+
+        deadline = time.monotonic() + 5
+
+        # The event and the metrics that counted it may arrive in separate batches
+        for event in shards.listen( timeout = 0.1 ):
+            if 'events_received_total' in metrics.counters and metrics.counters[ 'events_received_total' ][ 2 ]:
+                break
+
+            assert time.monotonic() < deadline
+
+        assert metrics.counters[ 'events_received_total' ][ 2 ][ ( str( tmp_path ), ) ] > 0
+        assert metrics.gauges[ 'native_watches' ][ 2 ]() == { (): 1 }
+    finally:
+        shards.close()
+
+def test_shards_raise_the_errors_of_their_workers ( tmp_path, monkeypatch ):
+    add_watch = BetterInotify.BetterInotify.add_watch
+
+    def locked_add_watch ( self, glob, **kwargs ):
+        if 'locked' in glob:
+            raise OSError( errno.EACCES, 'Permission denied', glob )
+
+        return add_watch( self, glob, **kwargs )
+
+    # The workers are forked, so they inherit the patched method
+    monkeypatch.setattr( BetterInotify.BetterInotify, 'add_watch', locked_add_watch )
+
+    shards = Sharding.Shards( 2 )
+
+    try:
+        with pytest.raises( OSError ):
+            shards.add_watch( str( tmp_path / 'locked' / '*.txt' ) )
+
+        assert shards.roots == {}
+
+        id = shards.add_watch( str( tmp_path / '*.txt' ) )
+
+        ( tmp_path / 'a.txt' ).write_text( 'a' )
+
+        assert first_event( shards )[ :1 ] == ( id, )
+    finally:
+        shards.close()